@@ -0,0 +1,283 @@
+"""
+Description: This module runs the end-to-end benchmark of the pipeline (extraction -> sampling -> generation
+    -> scoring) on a synthetic git repository with a tiny randomly initialized model, and reports the latency,
+    throughput and peak memory of every stage as JSON, along with the events of the profiling hooks.
+    Reports of two commits can be compared with `--compare`.
+
+Usage (from the repository root):
+    python -m benchmarks.run --files 200 --samples 64 --output bench.json
+    python -m benchmarks.run --files 200 --samples 64 --compare bench.json
+"""
+from contextlib import contextmanager, redirect_stdout
+from generation.utils import RepoExtractor, CodeDataset, FIMGenerator, profiling
+from evaluation.utils import MetricsEngine
+from .synthetic import make_repo, make_model
+import transformers
+import subprocess
+import tempfile
+import platform
+import resource
+import argparse
+import random
+import torch
+import time
+import json
+import sys
+import os
+
+def peak_rss_mb() -> float:
+    """
+    Returns:
+        float: The peak resident memory of the process so far, in MB.
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+    return peak / 1024 ** 2 if sys.platform == "darwin" else peak / 1024
+
+def git_commit() -> str:
+    """
+    Returns:
+        str: The commit of the benchmarked tree (with a "-dirty" suffix if it has changes), or None outside git.
+    """
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+        dirty = subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"],
+                               capture_output=True, text=True, check=True).stdout.strip()
+        return commit + ("-dirty" if dirty else "")
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def percentile(values: list[float], q: float) -> float:
+    """
+    Computes a percentile with linear interpolation.
+
+    Args:
+        values (list[float]): The values.
+        q (float): The percentile, between 0 and 100.
+
+    Returns:
+        float: The percentile, or 0 for no values.
+    """
+    if not values:
+        return 0.0
+    values = sorted(values)
+    position = (len(values) - 1) * q / 100
+    lower = int(position)
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * (position - lower)
+
+class Benchmark:
+    """
+    Benchmark measures the stages of a run and collects the events of the profiling hooks.
+    A stage is any block wrapped in `measure`: its wall time, its throughput (when the block sets
+    the number of items it processed) and the peak memory of the process at its end are recorded.
+    Attributes:
+        stages (dict): The measurements of every stage, by name.
+        events (list[dict]): The events of the profiling hooks.
+    Methods:
+        measure(name: str):
+            Measures the block it wraps.
+        summarize_events() -> dict:
+            Aggregates the events by stage name.
+        report(config: dict) -> dict:
+            Builds the JSON report.
+    """
+
+    def __init__(self) -> None:
+        self.stages = {}
+        self.events = []
+
+    @contextmanager
+    def measure(self, name: str):
+        """
+        Measures the block it wraps. The yielded dict is the record of the stage, so the block can
+        add details such as the number of "items" it processed.
+
+        Args:
+            name (str): The name of the stage.
+
+        Yields:
+            dict: The record of the stage.
+        """
+        record = {}
+        profiling.add_hook(self.events.append)
+        start_time = time.perf_counter()
+        try:
+            yield record
+        finally:
+            record["seconds"] = time.perf_counter() - start_time
+            profiling.remove_hook(self.events.append)
+            if "items" in record:
+                record["items_per_sec"] = record["items"] / record["seconds"] if record["seconds"] > 0 else 0.0
+            record["peak_rss_mb"] = peak_rss_mb()
+            if torch.cuda.is_available():
+                record["peak_cuda_mb"] = torch.cuda.max_memory_allocated() / 1024 ** 2
+            self.stages[name] = record
+
+    def summarize_events(self) -> dict:
+        """
+        Aggregates the events of the profiling hooks by stage name.
+
+        Returns:
+            dict: The count, total and percentile latencies of every stage, and the sum of their numeric details.
+        """
+        summary = {}
+        for name in dict.fromkeys(event["stage"] for event in self.events):
+            events = [event for event in self.events if event["stage"] == name]
+            latencies = [event["seconds"] for event in events]
+            summary[name] = {
+                "count": len(events),
+                "seconds": sum(latencies),
+                "p50_ms": percentile(latencies, 50) * 1000,
+                "p95_ms": percentile(latencies, 95) * 1000,
+                "max_ms": max(latencies) * 1000,
+            }
+            for key in ("items", "new_tokens", "tokens", "bytes"):
+                if any(key in event for event in events):
+                    summary[name][key] = sum(event.get(key, 0) for event in events)
+        return summary
+
+    def report(self, config: dict) -> dict:
+        """
+        Builds the JSON report of the run.
+
+        Args:
+            config (dict): The configuration of the run.
+
+        Returns:
+            dict: The commit, environment, configuration, stages and event summary.
+        """
+        return {
+            "commit": git_commit(),
+            "environment": {
+                "python": platform.python_version(),
+                "torch": torch.__version__,
+                "transformers": transformers.__version__,
+                "platform": platform.platform(),
+                "cpu_count": os.cpu_count(),
+                "torch_threads": torch.get_num_threads(),
+            },
+            "config": config,
+            "stages": self.stages,
+            "events": self.summarize_events(),
+            "total_seconds": sum(stage["seconds"] for stage in self.stages.values()),
+        }
+
+def compare(baseline: dict, current: dict) -> dict:
+    """
+    Compares the stage latencies of two reports.
+
+    Args:
+        baseline (dict): The report of the baseline (e.g. the previous commit).
+        current (dict): The report of the current run.
+
+    Returns:
+        dict: For every stage of both reports, the two latencies and their ratio (above 1 is a slowdown).
+    """
+    comparison = {}
+    for name, stage in current["stages"].items():
+        if name not in baseline["stages"]:
+            continue
+        before, after = baseline["stages"][name]["seconds"], stage["seconds"]
+        comparison[name] = {"baseline_seconds": before, "seconds": after,
+                            "ratio": after / before if before > 0 else None}
+    return comparison
+
+def run(args: argparse.Namespace, work_dir: str) -> dict:
+    """
+    Runs every stage of the pipeline on the synthetic inputs.
+
+    Args:
+        args (argparse.Namespace): The command line arguments.
+        work_dir (str): The directory of the synthetic repository and of the caches.
+
+    Returns:
+        dict: The report of the run.
+    """
+    random.seed(args.seed)
+    torch.manual_seed(args.seed)
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+    benchmark = Benchmark()
+    repo_path = os.path.join(work_dir, "repo")
+
+    with benchmark.measure("make_repo") as record:
+        record.update(make_repo(repo_path, args.files, args.lines, args.notebooks, seed=args.seed))
+        record["items"] = record["files"]
+
+    with benchmark.measure("extract") as record:
+        files = RepoExtractor(repo_path, repo_dir=os.path.join(work_dir, "clone"), checkout=False,
+                              num_workers=args.extract_workers).get_files()
+        record["items"] = len(files)
+
+    cache_dir = os.path.join(work_dir, "extract_cache")
+    for name in ("extract_cache_cold", "extract_cache_warm"):
+        with benchmark.measure(name) as record:
+            extractor = RepoExtractor(repo_path, repo_dir=os.path.join(work_dir, "clone"), cache_dir=cache_dir,
+                                      checkout=False, num_workers=args.extract_workers)
+            record["items"] = len(extractor.get_files())
+            record["cache_hits"] = extractor.cache_hits
+
+    with benchmark.measure("make_model") as record:
+        model, tokenizer = make_model(files, vocab_size=args.vocab_size, hidden_size=args.hidden_size,
+                                      num_layers=args.layers, seed=args.seed)
+        record["parameters"] = sum(parameter.numel() for parameter in model.parameters())
+
+    with benchmark.measure("sample") as record:
+        dataset = CodeDataset(files, num_samples=args.samples)
+        record["items"] = len(dataset)
+
+    with benchmark.measure("generate") as record:
+        generator = FIMGenerator(model, tokenizer, max_new_tokens=args.max_new_tokens, max_batch_size=args.batch_size)
+        generated = generator.generate(dataset)
+        record["items"] = len(generated)
+        record["batches"] = generator.stats["batches"]
+        record["new_tokens"] = generator.stats["mean_new_tokens"] * len(generated)
+
+    records = [{"prefix": prefix, "correct_middle": middle, "suffix": suffix, "generated": output}
+               for (prefix, middle, suffix), output in zip(dataset, generated)]
+    with benchmark.measure("score") as record:
+        MetricsEngine(num_workers=args.score_workers).score(records)
+        record["items"] = len(records)
+
+    generate = benchmark.stages["generate"]
+    generate["tokens_per_sec"] = generate["new_tokens"] / generate["seconds"] if generate["seconds"] > 0 else 0.0
+    return benchmark.report(vars(args))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the pipeline end to end on synthetic inputs.")
+    parser.add_argument("--files", type=int, default=100, help="The number of Python files of the synthetic repository")
+    parser.add_argument("--lines", type=int, default=200, help="The approximate number of lines of every Python file")
+    parser.add_argument("--notebooks", type=int, default=10, help="The number of notebooks of the synthetic repository")
+    parser.add_argument("--samples", type=int, default=64, help="The number of FIM samples")
+    parser.add_argument("--max-new-tokens", type=int, default=16)
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--vocab-size", type=int, default=1000)
+    parser.add_argument("--hidden-size", type=int, default=64)
+    parser.add_argument("--layers", type=int, default=2)
+    parser.add_argument("--extract-workers", type=int, default=1)
+    parser.add_argument("--score-workers", type=int, default=1)
+    parser.add_argument("--threads", type=int, default=None, help="The number of torch threads")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--work-dir", default=None, help="Where the synthetic inputs are written, a temporary directory by default")
+    parser.add_argument("--output", default=None, help="The JSON file of the report, printed if not given")
+    parser.add_argument("--compare", default=None, help="A previous report to compare the stage latencies with")
+    args = parser.parse_args()
+
+    # The progress messages of the stages go to stderr, so that stdout is only the report
+    with redirect_stdout(sys.stderr):
+        if args.work_dir is not None:
+            os.makedirs(args.work_dir, exist_ok=True)
+            report = run(args, tempfile.mkdtemp(dir=args.work_dir))
+        else:
+            with tempfile.TemporaryDirectory() as work_dir:
+                report = run(args, work_dir)
+
+    if args.compare is not None:
+        with open(args.compare, "r") as f:
+            report["comparison"] = compare(json.load(f), report)
+
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=4)
+    print(json.dumps(report, indent=4))
@@ -0,0 +1,166 @@
+"""
+Description: This module builds the synthetic inputs of the benchmarks: local git repositories of generated
+    Python files and notebooks, and a tiny randomly initialized Llama model with a byte-level BPE tokenizer
+    holding the deepseek special and FIM tokens, so that the whole pipeline runs offline and deterministically.
+"""
+from git import Repo, Actor
+from tokenizers import Tokenizer, models, trainers, pre_tokenizers, decoders
+from tokenizers.processors import TemplateProcessing
+from transformers import PreTrainedTokenizerFast, LlamaConfig, LlamaForCausalLM
+from generation.utils.FIMGenerator import FIM_BEGIN, FIM_HOLE, FIM_END
+import random
+import torch
+import json
+import os
+
+BOS_TOKEN = "<｜begin▁of▁sentence｜>"
+EOS_TOKEN = "<｜end▁of▁sentence｜>"
+
+_WORDS = ["data", "value", "index", "result", "count", "items", "node", "path", "config", "buffer",
+          "total", "name", "size", "offset", "cache", "token", "score", "batch", "model", "line"]
+
+def _identifier(rng: random.Random) -> str:
+    return "_".join(rng.sample(_WORDS, rng.randint(1, 3)))
+
+def make_function(rng: random.Random, num_lines: int) -> str:
+    """
+    Generates the source of a Python function with loops, conditions and arithmetic.
+
+    Args:
+        rng (random.Random): The random number generator.
+        num_lines (int): The approximate number of lines of the body.
+
+    Returns:
+        str: The source of the function.
+    """
+    args = [_identifier(rng) for _ in range(rng.randint(1, 3))]
+    lines = [f"def {_identifier(rng)}({', '.join(args)}):", f'    """Computes the {rng.choice(_WORDS)} of {args[0]}."""']
+    variables = list(args)
+    indent = 1
+    for _ in range(num_lines):
+        target, source = _identifier(rng), rng.choice(variables)
+        kind = rng.random()
+        if kind < 0.15 and indent < 3:
+            lines.append("    " * indent + f"for {target} in range(len({source})):")
+            indent += 1
+        elif kind < 0.25 and indent < 3:
+            lines.append("    " * indent + f"if {source} > {rng.randint(0, 100)}:")
+            indent += 1
+        elif kind < 0.35 and indent > 1:
+            indent -= 1
+            lines.append("    " * indent + f"{target} = {source} {rng.choice('+-*')} {rng.randint(1, 9)}")
+        else:
+            lines.append("    " * indent + f"{target} = {source} {rng.choice('+-*')} {rng.choice(variables)}")
+        variables.append(target)
+    lines.append(f"    return {variables[-1]}")
+    return "\n".join(lines) + "\n"
+
+def make_notebook(rng: random.Random, num_cells: int, lines_per_cell: int) -> str:
+    """
+    Generates a Jupyter notebook with code cells, markdown cells and (large) outputs.
+
+    Args:
+        rng (random.Random): The random number generator.
+        num_cells (int): The number of code cells.
+        lines_per_cell (int): The approximate number of lines of each code cell.
+
+    Returns:
+        str: The JSON of the notebook.
+    """
+    cells = []
+    for _ in range(num_cells):
+        cells.append({"cell_type": "markdown", "metadata": {}, "source": [f"## {rng.choice(_WORDS).title()}\n"]})
+        source = make_function(rng, lines_per_cell)
+        cells.append({"cell_type": "code", "execution_count": 1, "metadata": {},
+                      "source": source.splitlines(keepends=True),
+                      # Outputs are skipped by the extraction, they only weigh on the parsing
+                      "outputs": [{"output_type": "display_data", "metadata": {},
+                                   "data": {"image/png": "iVBORw0KGgo" * rng.randint(100, 1000)}}]})
+    return json.dumps({"cells": cells, "metadata": {}, "nbformat": 4, "nbformat_minor": 5}, indent=1)
+
+def make_repo(path: str, num_files: int = 100, lines_per_file: int = 200, num_notebooks: int = 10,
+              seed: int = 0) -> dict:
+    """
+    Creates a local git repository of generated Python files and notebooks, committed on its default branch.
+
+    Args:
+        path (str): The directory of the repository. It must not exist or be empty.
+        num_files (int, optional): The number of Python files. Defaults to 100.
+        lines_per_file (int, optional): The approximate number of lines of each Python file. Defaults to 200.
+        num_notebooks (int, optional): The number of notebooks. Defaults to 10.
+        seed (int, optional): The seed of the generated contents. Defaults to 0.
+
+    Returns:
+        dict: The number of files and bytes written and the commit SHA.
+    """
+    rng = random.Random(seed)
+    repo = Repo.init(path)
+    paths, num_bytes = [], 0
+    for i in range(num_files + num_notebooks):
+        if i < num_files:
+            relative_path = os.path.join(f"package_{i % 8}", f"module_{i}.py")
+            functions, num_lines = [], 0
+            while num_lines < lines_per_file:
+                functions.append(make_function(rng, rng.randint(5, 30)))
+                num_lines += functions[-1].count("\n")
+            content = "import math\n\n\n" + "\n\n".join(functions)
+        else:
+            relative_path = os.path.join("notebooks", f"notebook_{i - num_files}.ipynb")
+            content = make_notebook(rng, rng.randint(3, 10), rng.randint(5, 30))
+
+        os.makedirs(os.path.join(path, os.path.dirname(relative_path)), exist_ok=True)
+        with open(os.path.join(path, relative_path), "w") as f:
+            f.write(content)
+        paths.append(relative_path)
+        num_bytes += len(content.encode("utf-8"))
+
+    repo.index.add(paths)
+    author = Actor("benchmark", "benchmark@example.com")
+    commit = repo.index.commit("Synthetic benchmark repository", author=author, committer=author)
+    return {"files": len(paths), "bytes": num_bytes, "commit": commit.hexsha}
+
+def make_tokenizer(corpus: list[str], vocab_size: int = 1000) -> PreTrainedTokenizerFast:
+    """
+    Trains a byte-level BPE tokenizer with the special tokens of the deepseek coder models.
+
+    Args:
+        corpus (list[str]): The texts the tokenizer is trained on.
+        vocab_size (int, optional): The size of the vocabulary. Defaults to 1000.
+
+    Returns:
+        PreTrainedTokenizerFast: The tokenizer, adding the beginning of sequence token like the deepseek one.
+    """
+    special_tokens = [BOS_TOKEN, EOS_TOKEN, FIM_BEGIN, FIM_HOLE, FIM_END]
+    tokenizer = Tokenizer(models.BPE())
+    tokenizer.pre_tokenizer = pre_tokenizers.ByteLevel(add_prefix_space=False)
+    tokenizer.decoder = decoders.ByteLevel()
+    tokenizer.train_from_iterator(corpus, trainers.BpeTrainer(vocab_size=vocab_size, special_tokens=special_tokens,
+                                                              initial_alphabet=pre_tokenizers.ByteLevel.alphabet(),
+                                                              show_progress=False))
+    tokenizer.post_processor = TemplateProcessing(single=f"{BOS_TOKEN} $A", special_tokens=[(BOS_TOKEN, 0)])
+    return PreTrainedTokenizerFast(tokenizer_object=tokenizer, bos_token=BOS_TOKEN, eos_token=EOS_TOKEN)
+
+def make_model(corpus: list[str], vocab_size: int = 1000, hidden_size: int = 64, num_layers: int = 2,
+               num_heads: int = 4, seed: int = 0) -> tuple:
+    """
+    Builds a tiny randomly initialized Llama model and its tokenizer. Its completions are meaningless,
+    but it exercises the same code paths as the real model at a fraction of the cost.
+
+    Args:
+        corpus (list[str]): The texts the tokenizer is trained on.
+        vocab_size (int, optional): The size of the vocabulary. Defaults to 1000.
+        hidden_size (int, optional): The hidden size of the model. Defaults to 64.
+        num_layers (int, optional): The number of layers. Defaults to 2.
+        num_heads (int, optional): The number of attention heads. Defaults to 4.
+        seed (int, optional): The seed of the weights. Defaults to 0.
+
+    Returns:
+        tuple: The model (in eval mode) and the tokenizer.
+    """
+    tokenizer = make_tokenizer(corpus, vocab_size)
+    torch.manual_seed(seed)
+    config = LlamaConfig(vocab_size=len(tokenizer), hidden_size=hidden_size, intermediate_size=2 * hidden_size,
+                         num_hidden_layers=num_layers, num_attention_heads=num_heads,
+                         bos_token_id=tokenizer.bos_token_id, eos_token_id=tokenizer.eos_token_id,
+                         max_position_embeddings=4096)
+    return LlamaForCausalLM(config).eval(), tokenizer
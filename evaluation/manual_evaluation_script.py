@@ -1,8 +1,205 @@
 import json
+import hashlib
+import os
+from array import array
 import tkinter as tk
 from tkinter import messagebox, filedialog
 from tkinter import PhotoImage
 
+SCORE_KEYS = ["satisfaction", "similarity", "completeness", "errors"]
+
+def sample_id(sample: dict) -> str:
+    """
+    Returns the id of a sample: its "id" field if present, otherwise the same content hash
+    as `generation/utils/GenerationRun.py`, so both always agree.
+
+    Args:
+        sample (dict): The sample, with "prefix", "correct_middle" and "suffix" keys.
+
+    Returns:
+        str: The id of the sample.
+    """
+    if "id" in sample:
+        return sample["id"]
+    return hashlib.sha1(json.dumps([sample["prefix"], sample["correct_middle"], sample["suffix"]]).encode("utf-8")).hexdigest()
+
+class SampleStore:
+    """
+    Gives indexed access to the samples of an outputs file while keeping only one of them in memory.
+    JSONL files are read through a byte-offset index of their lines, saved next to the file as `<file>.idx`
+    together with the size and modification time of the file. The index is rebuilt when the file changed,
+    and only extended when the file just grew (an append-only GenerationRun still in progress).
+    JSON files (a list of samples, e.g. model_outputs.json) are loaded whole, as before.
+    """
+
+    def __init__(self, path: str):
+        """
+        Opens an outputs file.
+
+        Args:
+            path (str): The path of the JSON or JSONL outputs file.
+        """
+        self.path = path
+        self.samples = None
+        self.offsets = array("q")
+        if not path.endswith(".jsonl"):
+            with open(path, "r") as f:
+                self.samples = json.load(f)
+            return
+        self._load_index()
+        self._file = open(path, "rb")
+
+    def _load_index(self):
+        """
+        Loads the index of the JSONL file, rebuilding or extending it if the file changed since it was saved.
+        """
+        index_path = self.path + ".idx"
+        stat = os.stat(self.path)
+        indexed_size = 0
+        if os.path.exists(index_path):
+            with open(index_path, "rb") as f:
+                header = json.loads(f.readline())
+                offsets = array("q")
+                offsets.frombytes(f.read())
+            if header["size"] == stat.st_size and header["mtime_ns"] == stat.st_mtime_ns:
+                self.offsets = offsets
+                return
+            # The file grew: keep the offsets of the lines that were already complete
+            if header["size"] < stat.st_size and self._ends_line(header["size"]):
+                self.offsets, indexed_size = offsets, header["size"]
+
+        with open(self.path, "rb") as f:
+            f.seek(indexed_size)
+            offset = indexed_size
+            for line in f:
+                # A last line without newline is still being written
+                if line.endswith(b"\n") and line.strip():
+                    self.offsets.append(offset)
+                offset += len(line)
+
+        with open(index_path + ".tmp", "wb") as f:
+            f.write((json.dumps({"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}) + "\n").encode("utf-8"))
+            f.write(self.offsets.tobytes())
+        os.replace(index_path + ".tmp", index_path)
+
+    def _ends_line(self, size: int) -> bool:
+        """
+        Checks whether the first `size` bytes of the file end with a complete line.
+
+        Args:
+            size (int): The number of bytes.
+
+        Returns:
+            bool: True if the byte at `size - 1` is a newline.
+        """
+        if size == 0:
+            return True
+        with open(self.path, "rb") as f:
+            f.seek(size - 1)
+            return f.read(1) == b"\n"
+
+    def __len__(self) -> int:
+        return len(self.samples) if self.samples is not None else len(self.offsets)
+
+    def __getitem__(self, idx: int) -> dict:
+        """
+        Reads a sample.
+
+        Args:
+            idx (int): The index of the sample.
+
+        Returns:
+            dict: The sample.
+        """
+        if self.samples is not None:
+            return self.samples[idx]
+        self._file.seek(self.offsets[idx])
+        return json.loads(self._file.readline())
+
+class ScoreJournal:
+    """
+    An append-only journal of the scores of a review session, saved next to the outputs file as
+    `<file>.scores.jsonl`. Each line is either a compact score record ({"id", "index" and the four scores})
+    or a cursor record ({"cursor": index}). Replaying the journal gives the latest scores of every sample
+    and the sample the reviewer was on, so a session resumes where it stopped.
+    """
+
+    def __init__(self, path: str):
+        """
+        Opens (or creates) a journal and replays it.
+
+        Args:
+            path (str): The path of the journal.
+        """
+        self.path = path
+        self.scores = {}
+        self.cursor = 0
+        num_lines = 0
+        if os.path.exists(path):
+            complete_size = 0
+            with open(path, "rb") as f:
+                for line in f:
+                    if not line.endswith(b"\n"):
+                        # A last line cut by a crash, it is dropped below
+                        break
+                    complete_size += len(line)
+                    num_lines += 1
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        print(f"Skipping corrupt line {num_lines} of {path}")
+                        continue
+                    if "cursor" in record:
+                        self.cursor = record["cursor"]
+                    else:
+                        self.scores[record["id"]] = record
+            # Appending after a partial line would merge it with the next record
+            if complete_size < os.path.getsize(path):
+                os.truncate(path, complete_size)
+        self._file = open(path, "a")
+        # Rewriting a journal made mostly of superseded records keeps the replay fast
+        if num_lines > 2 * len(self.scores) + 1000:
+            self._compact()
+
+    def _compact(self):
+        """
+        Rewrites the journal with only the latest record of every sample and the cursor.
+        """
+        self._file.close()
+        with open(self.path + ".tmp", "w") as f:
+            for record in self.scores.values():
+                f.write(json.dumps(record) + "\n")
+            f.write(json.dumps({"cursor": self.cursor}) + "\n")
+        os.replace(self.path + ".tmp", self.path)
+        self._file = open(self.path, "a")
+
+    def _append(self, record: dict):
+        self._file.write(json.dumps(record) + "\n")
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def record_scores(self, record: dict):
+        """
+        Appends the scores of a sample, unless they did not change.
+
+        Args:
+            record (dict): The score record, with "id", "index" and the scores.
+        """
+        if self.scores.get(record["id"]) != record:
+            self.scores[record["id"]] = record
+            self._append(record)
+
+    def record_cursor(self, index: int):
+        """
+        Appends the index of the sample on screen.
+
+        Args:
+            index (int): The index of the sample.
+        """
+        if index != self.cursor:
+            self.cursor = index
+            self._append({"cursor": index})
+
 class CodeEvaluationApp:
     def __init__(self, root: tk.Tk):
         """
@@ -13,9 +210,10 @@ class CodeEvaluationApp:
 
         Attributes:
             root (tk.Tk): The root window of the Tkinter application.
-            data (list): A list to store the JSON data.
+            data (SampleStore): The samples being evaluated, read one at a time.
             current_index (int): The current index of the data being evaluated.
-            scores (list): A list to store the scores for each evaluation.
+            current_sample (dict): The sample on screen.
+            journal (ScoreJournal): The journal where the scores are saved as the reviewer moves between samples.
             empty_star (PhotoImage): The image for an empty star.
             filled_star (PhotoImage): The image for a filled star.
 
@@ -25,16 +223,18 @@ class CodeEvaluationApp:
             create_star_rating(label_text, score_key): Creates a star rating widget.
             set_star_rating(score_key, rating, star_buttons): Sets the star rating for a metric.
             display_sample(): Displays the current sample for evaluation.
-            save_scores(): Saves the scores for the current sample.
+            save_scores(): Saves the scores for the current sample to the journal.
             next_sample(): Displays the next sample for evaluation.
             previous_sample(): Displays the previous sample for evaluation.
             save_scores_to_file(): Saves the scores to a JSON file.
+            close(): Saves the current scores and closes the application.
         """
         self.root = root
         self.root.title("Code Evaluation App")
         self.data = []
         self.current_index = 0
-        self.scores = []
+        self.current_sample = None
+        self.journal = None
 
         # Load JSON data
         self.load_data()
@@ -46,20 +246,23 @@ class CodeEvaluationApp:
         # GUI Layout
         self.create_widgets()
 
+        # The scores of the sample on screen are saved when the window is closed, too
+        self.root.protocol("WM_DELETE_WINDOW", self.close)
+
     def load_data(self):
         """
-        Prompts the user to select a JSON file and loads its content into the `data` attribute.
+        Prompts the user to select a JSON or JSONL file and opens it as the `data` attribute.
         
-        This method uses a file dialog to allow the user to select a JSON file from their filesystem.
-        Once a file is selected, it reads the file and loads its content as JSON into the `data` attribute.
-        Additionally, it initializes the `scores` attribute as a list of empty dictionaries, with one
-        dictionary for each item in the loaded data.
+        This method uses a file dialog to allow the user to select an outputs file from their filesystem.
+        JSONL files are opened through a byte-offset index, so only the sample on screen is read.
+        The score journal of the file is replayed, and the session resumes on the last sample displayed.
         """
-        file_path = filedialog.askopenfilename(title="Select JSON File", filetypes=[("JSON Files", "*.json")])
+        file_path = filedialog.askopenfilename(title="Select JSON File",
+                                               filetypes=[("JSON Files", "*.json *.jsonl"), ("All Files", "*")])
         if file_path:
-            with open(file_path, "r") as f:
-                self.data = json.load(f)
-                self.scores = [{} for _ in self.data]  # Placeholder for scores
+            self.data = SampleStore(file_path)
+            self.journal = ScoreJournal(file_path + ".scores.jsonl")
+            self.current_index = min(self.journal.cursor, max(len(self.data) - 1, 0))
     
     def create_widgets(self):
         """
@@ -170,10 +373,11 @@ class CodeEvaluationApp:
             return
         
         sample = self.data[self.current_index]
+        self.current_sample = sample
         
         # Display prefix + suffix with placeholder
         self.context_text.delete(1.0, tk.END)
-        context = f"{sample["prefix"]} <...> {sample["suffix"]}"
+        context = f"{sample['prefix']} <...> {sample['suffix']}"
         self.context_text.insert(tk.END, context)
 
         # Display correct middle value
@@ -185,34 +389,30 @@ class CodeEvaluationApp:
         self.generated_text.insert(tk.END, sample["generated"])
 
         # Load previous star ratings if available
-        for score_key in ["satisfaction", "similarity", "completeness", "errors"]:
-            rating = self.scores[self.current_index].get(score_key, 0)
+        previous = self.journal.scores.get(sample_id(sample), {})
+        for score_key in SCORE_KEYS:
+            rating = previous.get(score_key, 0)
             self.set_star_rating(score_key, rating, getattr(self, f"{score_key}_stars"))
 
     def save_scores(self):
         """
-        Save the evaluation scores for the current index into the scores dictionary.
+        Save the evaluation scores of the sample on screen to the journal.
 
-        The scores dictionary is updated with the following keys:
+        The journal record holds the following keys:
+        - "id": The id of the sample.
+        - "index": The index of the sample in the outputs file.
         - "satisfaction": The satisfaction score.
         - "similarity": The similarity score.
         - "completeness": The completeness score.
         - "errors": The errors score.
-        - "prefix": The prefix part of the data at the current index.
-        - "suffix": The suffix part of the data at the current index.
-        - "correct_middle": The correct middle part of the data at the current index.
-        - "generated_middle": The generated middle part of the data at the current index.
-        """
-        self.scores[self.current_index] = {
-            "satisfaction": getattr(self, "satisfaction_score"),
-            "similarity": getattr(self, "similarity_score"),
-            "completeness": getattr(self, "completeness_score"),
-            "errors": getattr(self, "errors_score"),
-            "prefix": self.data[self.current_index]["prefix"],
-            "suffix": self.data[self.current_index]["suffix"],
-            "correct_middle": self.data[self.current_index]["correct_middle"],
-            "generated_middle": self.data[self.current_index]["generated"]
-        }
+        Unrated samples and unchanged scores are not written.
+        """
+        if self.current_sample is None:
+            return
+        scores = {score_key: getattr(self, f"{score_key}_score") for score_key in SCORE_KEYS}
+        record = {"id": sample_id(self.current_sample), "index": self.current_index, **scores}
+        if any(scores.values()) or record["id"] in self.journal.scores:
+            self.journal.record_scores(record)
 
     def next_sample(self):
         """
@@ -227,6 +427,8 @@ class CodeEvaluationApp:
         if self.current_index >= len(self.data):
             self.current_index = len(self.data) - 1
         self.display_sample()
+        if self.journal is not None:
+            self.journal.record_cursor(self.current_index)
 
     def previous_sample(self):
         """
@@ -246,23 +448,58 @@ class CodeEvaluationApp:
             self.current_index = 0
             messagebox.showinfo("Info", "This is the first sample.")
         self.display_sample()
+        if self.journal is not None:
+            self.journal.record_cursor(self.current_index)
+
+    def close(self):
+        """
+        Saves the scores of the sample on screen and closes the application.
+        """
+        self.save_scores()
+        self.root.destroy()
 
     def save_scores_to_file(self):
         """
         Prompts the user to select a location and filename to save the scores as a JSON file.
         
         Uses a file dialog to ask the user for a save location and filename with a .json extension.
-        If a valid file path is provided, the method writes the scores to the specified file in JSON format.
+        If a valid file path is provided, the method writes the rated samples, in file order, to the specified
+        file in the format of `manual_scores.json` (the scores along with the prefix, suffix and both middles).
         Displays a message box to inform the user that the scores have been saved successfully.
         
         Returns:
             None
         """
+        self.save_scores()
         file_path = filedialog.asksaveasfilename(defaultextension=".json", filetypes=[("JSON Files", "*.json")])
         if file_path:
+            exported, missing, positions = [], 0, None
+            for record in sorted(self.journal.scores.values(), key=lambda record: record["index"]):
+                if not any(record[score_key] for score_key in SCORE_KEYS):
+                    continue
+                index = record["index"]
+                if index >= len(self.data) or sample_id(self.data[index]) != record["id"]:
+                    # The outputs file was regenerated or reordered, the sample is looked up by id
+                    if positions is None:
+                        positions = {sample_id(self.data[i]): i for i in range(len(self.data))}
+                    index = positions.get(record["id"])
+                    if index is None:
+                        missing += 1
+                        continue
+                sample = self.data[index]
+                exported.append({
+                    **{score_key: record[score_key] for score_key in SCORE_KEYS},
+                    "prefix": sample["prefix"],
+                    "suffix": sample["suffix"],
+                    "correct_middle": sample["correct_middle"],
+                    "generated_middle": sample["generated"]
+                })
             with open(file_path, "w") as f:
-                json.dump(self.scores, f, indent=4)
-            messagebox.showinfo("Info", "Scores saved successfully.")
+                json.dump(exported, f, indent=4)
+            if missing:
+                messagebox.showwarning("Warning", f"Scores saved, but {missing} rated samples are no longer in the file.")
+            else:
+                messagebox.showinfo("Info", "Scores saved successfully.")
 
 if __name__ == "__main__":
     root = tk.Tk()
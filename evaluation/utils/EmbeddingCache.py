@@ -0,0 +1,248 @@
+"""
+Description: This module contains the EmbeddingCache class, a persistent cache of sentence embeddings keyed by
+    model name and text hash, so that re-scoring only encodes the texts never seen before.
+"""
+from collections import OrderedDict
+import numpy as np
+import hashlib
+import json
+import os
+
+class EmbeddingCache:
+    """
+    EmbeddingCache stores embeddings in a memory-mapped float32 array of `max_entries` rows, and keeps an
+    index from the SHA-1 of (model name, text) to the row of its embedding. When texts are encoded, the
+    cached ones are read from the array and only the missing ones are sent to the model, deduplicated and
+    sorted by length so that the batches hold texts of similar length (and little padding). Once the array
+    is full, the least recently used entries are evicted and their rows reused.
+    The index is written whenever new embeddings are cached. Lookups that only change the recency of entries
+    are kept in memory until `flush` or `close` (the cache is also a context manager), since losing them only
+    affects the eviction order.
+    Attributes:
+        path (str): The directory of the cache.
+        model_name (str): The name of the SentenceTransformer model.
+        max_entries (int): The maximum number of cached embeddings.
+        batch_size (int): The batch size of the model.
+        stats (dict): The number of hits, misses and encoded texts since the cache was opened.
+    Methods:
+        encode(texts: list[str]) -> np.ndarray:
+            Returns the embedding of every text, encoding only the cache misses.
+        flush() -> None:
+            Persists the recency of the entries, if it changed.
+        close() -> None:
+            Flushes the cache and releases its array.
+        key(text: str) -> str:
+            Returns the cache key of a text.
+    """
+    INDEX_FILE = "index.json"
+    VECTORS_FILE = "vectors.f32"
+
+    def __init__(self, path: str, model_name: str, model=None, max_entries: int = 100000, batch_size: int = 64) -> None:
+        """
+        Initializes the EmbeddingCache instance, opening the cache in `path` if it exists.
+
+        Args:
+            path (str): The directory of the cache.
+            model_name (str): The name of the SentenceTransformer model, part of every key.
+            model (optional): The loaded model. Defaults to None, the model is then only loaded if some
+                text is missing from the cache.
+            max_entries (int, optional): The maximum number of cached embeddings. Defaults to 100000.
+            batch_size (int, optional): The batch size of the model. Defaults to 64.
+
+        Raises:
+            ValueError: If the cache in `path` was built with another model, or its array does not match its index.
+        """
+        self.path = path
+        self.model_name = model_name
+        self.max_entries = max_entries
+        self.batch_size = batch_size
+        self.stats = {"hits": 0, "misses": 0, "encoded": 0}
+        self._model = model
+        self._vectors = None
+        self._dirty = False
+
+        index_path = os.path.join(path, self.INDEX_FILE)
+        if os.path.exists(index_path):
+            with open(index_path, "r") as f:
+                index = json.load(f)
+            # Keys include the model name, but the embeddings of another model may not even have the same size
+            if index["model"] != model_name:
+                raise ValueError(f"The embedding cache in {path} was built with {index['model']}, not {model_name}")
+            vectors_path = os.path.join(path, self.VECTORS_FILE)
+            expected_size = index["capacity"] * index["dim"] * np.dtype(np.float32).itemsize
+            if not os.path.exists(vectors_path) or os.path.getsize(vectors_path) != expected_size:
+                raise ValueError(f"The embeddings of {path} do not match its index ({index['capacity']} x {index['dim']})")
+            self._dim = index["dim"]
+            self._capacity = index["capacity"]
+            # Entries are stored least recently used first
+            self._entries = OrderedDict(index["entries"])
+            self._free_rows = index["free_rows"]
+            self._vectors = np.memmap(vectors_path, dtype=np.float32, mode="r+", shape=(self._capacity, self._dim))
+            # A smaller bound on reopening evicts the oldest entries
+            while len(self._entries) > self.max_entries:
+                self._free_rows.append(self._entries.popitem(last=False)[1])
+                self._dirty = True
+        else:
+            self._dim, self._capacity = None, max_entries
+            self._entries, self._free_rows = OrderedDict(), []
+
+    @property
+    def model(self):
+        """
+        The SentenceTransformer model, loaded on first use.
+        """
+        if self._model is None:
+            from sentence_transformers import SentenceTransformer
+            self._model = SentenceTransformer(self.model_name)
+        return self._model
+
+    def key(self, text: str) -> str:
+        """
+        Returns the cache key of a text.
+
+        Args:
+            text (str): The text.
+
+        Returns:
+            str: The hex SHA-1 of the model name and the text.
+        """
+        return hashlib.sha1(f"{self.model_name}\0{text}".encode("utf-8")).hexdigest()
+
+    def _open_vectors(self, dim: int) -> None:
+        """
+        Creates the array of embeddings, the first time something is cached.
+
+        Args:
+            dim (int): The dimension of the embeddings.
+        """
+        os.makedirs(self.path, exist_ok=True)
+        self._dim = dim
+        self._vectors = np.memmap(os.path.join(self.path, self.VECTORS_FILE), dtype=np.float32, mode="w+",
+                                  shape=(self._capacity, dim))
+
+    def _allocate_row(self, protected: set) -> int:
+        """
+        Returns a free row, evicting the least recently used entry if the cache is full.
+
+        Args:
+            protected (set): The keys that must not be evicted.
+
+        Returns:
+            int: The row, or None if every entry is protected.
+        """
+        if len(self._entries) >= min(self._capacity, self.max_entries):
+            for key in self._entries:
+                if key not in protected:
+                    return self._entries.pop(key)
+            return None
+        if self._free_rows:
+            return self._free_rows.pop()
+        # Without free rows, the rows in use are exactly the first len(self._entries) ones
+        return len(self._entries)
+
+    def _save_index(self, pending: dict = None) -> None:
+        """
+        Writes the index, through a temporary file so that a crash never leaves it half written.
+
+        Args:
+            pending (dict, optional): The new entries whose embeddings are not written yet. They are saved
+                as free rows. Defaults to None.
+        """
+        pending = pending or {}
+        entries = [(key, row) for key, row in self._entries.items() if key not in pending]
+        index_path = os.path.join(self.path, self.INDEX_FILE)
+        with open(index_path + ".tmp", "w") as f:
+            json.dump({"model": self.model_name, "dim": self._dim, "capacity": self._capacity,
+                       "entries": entries, "free_rows": self._free_rows + list(pending.values())}, f)
+        os.replace(index_path + ".tmp", index_path)
+        self._dirty = False
+
+    def flush(self) -> None:
+        """
+        Persists the recency of the entries, if lookups changed it since the index was last written.
+        """
+        if self._dirty:
+            self._save_index()
+
+    def close(self) -> None:
+        """
+        Flushes the cache and releases its array. The cache can not be used afterwards.
+        """
+        self.flush()
+        self._vectors = None
+
+    def __enter__(self):
+        """
+        Returns:
+            EmbeddingCache: The cache itself, closed when the block ends.
+        """
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        """
+        Closes the cache, even on errors.
+        """
+        self.close()
+
+    def encode(self, texts: list[str]) -> np.ndarray:
+        """
+        Returns the embedding of every text. Cached embeddings are read from disk, and the missing texts
+        are deduplicated, sorted by length and encoded in batches, then cached.
+
+        Args:
+            texts (list[str]): The texts.
+
+        Returns:
+            np.ndarray: A (len(texts), dim) float32 array of embeddings.
+        """
+        keys = [self.key(text) for text in texts]
+        missing = {}
+        for key, text in zip(keys, texts):
+            if key not in self._entries:
+                missing.setdefault(key, text)
+        self.stats["hits"] += len(keys) - sum(1 for key in keys if key in missing)
+        self.stats["misses"] += sum(1 for key in keys if key in missing)
+
+        new_embeddings = {}
+        if missing:
+            ordered = sorted(missing.items(), key=lambda item: len(item[1]))
+            encoded = self.model.encode([text for _, text in ordered], batch_size=self.batch_size,
+                                        convert_to_numpy=True, show_progress_bar=False)
+            encoded = np.asarray(encoded, dtype=np.float32)
+            if self._dim is not None and encoded.shape[1] != self._dim:
+                raise ValueError(f"The model returned embeddings of size {encoded.shape[1]}, the cache holds size {self._dim}")
+            self.stats["encoded"] += len(ordered)
+            new_embeddings = {key: vector for (key, _), vector in zip(ordered, encoded)}
+            if self._vectors is None:
+                self._open_vectors(encoded.shape[1])
+
+        result = np.empty((len(texts), self._dim or 0), dtype=np.float32)
+        for i, key in enumerate(keys):
+            if key in new_embeddings:
+                result[i] = new_embeddings[key]
+            else:
+                result[i] = self._vectors[self._entries[key]]
+                self._entries.move_to_end(key)
+
+        # The embeddings of this call are already in the result, so only the new keys are protected
+        protected = set(new_embeddings)
+        rows, num_entries = {}, len(self._entries)
+        for key in new_embeddings:
+            row = self._allocate_row(protected)
+            if row is None:
+                break
+            self._entries[key] = row
+            rows[key] = row
+
+        if rows:
+            if len(self._entries) < num_entries + len(rows):
+                # Evicted rows are about to be overwritten, the index on disk must not point to them anymore
+                self._save_index(pending=rows)
+            for key, row in rows.items():
+                self._vectors[row] = new_embeddings[key]
+            self._vectors.flush()
+            self._save_index()
+        elif keys:
+            # Only the recency changed, it is persisted by flush or close
+            self._dirty = True
+        return result
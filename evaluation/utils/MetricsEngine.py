@@ -0,0 +1,608 @@
+"""
+Description: This module contains the MetricsEngine class, which scores a whole generation run (JSON or JSONL)
+    in a single pass: every pair is tokenized once, all the registered metrics are computed on chunks of pairs
+    in a worker pool, and the per-sample scores are written to a columnar file next to the aggregates.
+
+Usage (from the repository root):
+    python -m evaluation.utils.MetricsEngine evaluation/model_outputs.json scores.npz --num-workers 4
+"""
+from concurrent.futures import ProcessPoolExecutor
+from collections import Counter
+from typing import Callable
+from .edit_distance import levenshtein
+from .EmbeddingCache import EmbeddingCache
+from .profiling import stage, emit, enabled
+import numpy as np
+import argparse
+import math
+import time
+import json
+import re
+import os
+
+# The regular expressions of the mteval-v13a tokenizer, used by BLEU
+_13A_RULES = [
+    (re.compile(r"([\{-\~\[-\` -\&\(-\+\:-\@\/])"), r" \1 "),
+    (re.compile(r"([^0-9])([\.,])"), r"\1 \2 "),
+    (re.compile(r"([\.,])([^0-9])"), r" \1 \2"),
+    (re.compile(r"([0-9])(-)"), r"\1 \2 "),
+]
+_FALLBACK_TOKENS = re.compile(r"\w+|[^\w\s]")
+
+CHRF_ORDER = 6
+CHRF_BETA = 2
+BLEU_ORDER = 4
+
+def tokenize_13a(text: str) -> list[str]:
+    """
+    Splits a text into words with the mteval-v13a tokenizer, the default tokenizer of BLEU.
+
+    Args:
+        text (str): The text.
+
+    Returns:
+        list[str]: The words.
+    """
+    text = text.replace("<skipped>", "").replace("-\n", "").replace("\n", " ")
+    if "&" in text:
+        text = text.replace("&quot;", '"').replace("&amp;", "&").replace("&lt;", "<").replace("&gt;", ">")
+    text = f" {text} "
+    for pattern, replacement in _13A_RULES:
+        text = pattern.sub(replacement, text)
+    return text.split()
+
+def _ngrams(sequence, order: int) -> Counter:
+    """
+    Counts the n-grams of a given order.
+
+    Args:
+        sequence: A string (character n-grams) or a list of words (word n-grams).
+        order (int): The n-gram order.
+
+    Returns:
+        Counter: The count of every n-gram.
+    """
+    if isinstance(sequence, str):
+        return Counter(sequence[i:i + order] for i in range(len(sequence) - order + 1))
+    return Counter(tuple(sequence[i:i + order]) for i in range(len(sequence) - order + 1))
+
+# ------------------------------------------------------------------------------------------------
+# Built-in metrics. A metric is a pair of functions: `score(pair) -> dict[str, float]` computes the
+# per-sample columns of a pair, `aggregate(columns) -> dict[str, float]` reduces the columns of all
+# the samples to the corpus level scores. Both must be defined at module level to reach the workers.
+# ------------------------------------------------------------------------------------------------
+
+def exact_match_score(pair: dict) -> dict:
+    """
+    Checks whether the generated middle is exactly the reference.
+
+    Args:
+        pair (dict): The pair, with the "generated" and "reference" texts and their "generated_tokens"
+            and "reference_tokens".
+
+    Returns:
+        dict: The "exact_match" column, 1.0 or 0.0.
+    """
+    return {"exact_match": float(pair["generated"] == pair["reference"])}
+
+def exact_match_aggregate(columns: dict) -> dict:
+    """
+    Computes the exact match rate of the corpus.
+
+    Args:
+        columns (dict): The "exact_match" column of every sample.
+
+    Returns:
+        dict: The fraction of exact matches, 0.0 without samples.
+    """
+    return {"exact_match": float(np.mean(columns["exact_match"])) if len(columns["exact_match"]) else 0.0}
+
+def chrf_score(pair: dict) -> dict:
+    """
+    Computes the character n-gram statistics of a pair (whitespace removed, as in sacreBLEU's chrF)
+    and its sentence level chrF.
+
+    Args:
+        pair (dict): The pair, with the "generated" and "reference" texts and their "generated_tokens"
+            and "reference_tokens".
+
+    Returns:
+        dict: The hypothesis, reference and matching n-gram counts of every order
+            ("chrf_hyp_{order}", "chrf_ref_{order}", "chrf_match_{order}") and the "chrf" of the pair.
+    """
+    generated, reference = "".join(pair["generated"].split()), "".join(pair["reference"].split())
+    columns = {}
+    for order in range(1, CHRF_ORDER + 1):
+        generated_ngrams, reference_ngrams = _ngrams(generated, order), _ngrams(reference, order)
+        columns[f"chrf_hyp_{order}"] = float(sum(generated_ngrams.values()))
+        columns[f"chrf_ref_{order}"] = float(sum(reference_ngrams.values()))
+        columns[f"chrf_match_{order}"] = float(sum((generated_ngrams & reference_ngrams).values()))
+    columns["chrf"] = _chrf_from_statistics(columns)
+    return columns
+
+def _chrf_from_statistics(statistics: dict) -> float:
+    """
+    Computes chrF (between 0 and 100) from summed n-gram statistics, with the effective order
+    averaging of sacreBLEU (n-gram orders missing on either side are left out).
+
+    Args:
+        statistics (dict): The hypothesis, reference and matching n-gram counts of every order, as
+            returned by `chrf_score` (or summed over samples).
+
+    Returns:
+        float: The chrF score, 0.0 if no order has n-grams on both sides.
+    """
+    factor = CHRF_BETA ** 2
+    average_precision, average_recall, effective_order = 0.0, 0.0, 0
+    for order in range(1, CHRF_ORDER + 1):
+        hyp, ref, match = (statistics[f"chrf_{kind}_{order}"] for kind in ("hyp", "ref", "match"))
+        if hyp > 0 and ref > 0:
+            average_precision += match / hyp
+            average_recall += match / ref
+            effective_order += 1
+
+    if effective_order == 0:
+        return 0.0
+    average_precision /= effective_order
+    average_recall /= effective_order
+    if average_precision + average_recall == 0:
+        return 0.0
+    return 100 * (1 + factor) * average_precision * average_recall / (factor * average_precision + average_recall)
+
+def chrf_aggregate(columns: dict) -> dict:
+    """
+    Computes corpus chrF from the n-gram statistics summed over the samples, as sacreBLEU does.
+
+    Args:
+        columns (dict): The columns of `chrf_score` for every sample.
+
+    Returns:
+        dict: The corpus "chrf".
+    """
+    return {"chrf": _chrf_from_statistics({key: float(np.sum(values)) for key, values in columns.items()})}
+
+def bleu_score(pair: dict) -> dict:
+    """
+    Computes the word n-gram statistics of a pair, with the 13a tokenizer.
+
+    Args:
+        pair (dict): The pair, with the "generated" and "reference" texts and their "generated_tokens"
+            and "reference_tokens".
+
+    Returns:
+        dict: The word counts of both sides ("bleu_hyp_len", "bleu_ref_len") and, for every order, the
+            clipped n-gram matches ("bleu_match_{order}") and the generated n-grams ("bleu_possible_{order}").
+    """
+    generated, reference = tokenize_13a(pair["generated"]), tokenize_13a(pair["reference"])
+    columns = {"bleu_hyp_len": float(len(generated)), "bleu_ref_len": float(len(reference))}
+    for order in range(1, BLEU_ORDER + 1):
+        overlap = _ngrams(generated, order) & _ngrams(reference, order)
+        columns[f"bleu_match_{order}"] = float(sum(overlap.values()))
+        columns[f"bleu_possible_{order}"] = float(max(len(generated) - order + 1, 0))
+    return columns
+
+def bleu_aggregate(columns: dict) -> dict:
+    """
+    Computes corpus BLEU from the summed statistics, without smoothing (as in `evaluate.load("bleu")`).
+
+    Args:
+        columns (dict): The columns of `bleu_score` for every sample.
+
+    Returns:
+        dict: The "bleu" score, its brevity penalty, the length ratio and the precision of every order.
+    """
+    totals = {key: float(np.sum(values)) for key, values in columns.items()}
+    precisions = [totals[f"bleu_match_{order}"] / totals[f"bleu_possible_{order}"] if totals[f"bleu_possible_{order}"] > 0 else 0.0
+                  for order in range(1, BLEU_ORDER + 1)]
+    geometric_mean = math.exp(sum(math.log(p) for p in precisions) / BLEU_ORDER) if min(precisions) > 0 else 0.0
+
+    ratio = totals["bleu_hyp_len"] / totals["bleu_ref_len"] if totals["bleu_ref_len"] > 0 else 0.0
+    brevity_penalty = 1.0 if ratio > 1.0 else (math.exp(1 - 1 / ratio) if ratio > 0 else 0.0)
+    return {"bleu": geometric_mean * brevity_penalty, "bleu_brevity_penalty": brevity_penalty,
+            "bleu_length_ratio": ratio, **{f"bleu_precision_{i + 1}": p for i, p in enumerate(precisions)}}
+
+def meteor_score(pair: dict) -> dict:
+    """
+    Computes METEOR with nltk, with the parameters of `evaluate.load("meteor")`. It needs the
+    nltk `wordnet` and `punkt` data.
+
+    Args:
+        pair (dict): The pair, with the "generated" and "reference" texts and their "generated_tokens"
+            and "reference_tokens".
+
+    Returns:
+        dict: The "meteor" column.
+    """
+    from nltk.translate.meteor_score import single_meteor_score
+    from nltk import word_tokenize
+    return {"meteor": float(single_meteor_score(word_tokenize(pair["reference"]), word_tokenize(pair["generated"]),
+                                                alpha=0.9, beta=3, gamma=0.5))}
+
+def meteor_aggregate(columns: dict) -> dict:
+    """
+    Averages METEOR over the samples.
+
+    Args:
+        columns (dict): The "meteor" column of every sample.
+
+    Returns:
+        dict: The mean "meteor", 0.0 without samples.
+    """
+    return {"meteor": float(np.mean(columns["meteor"])) if len(columns["meteor"]) else 0.0}
+
+def levenshtein_score(pair: dict) -> dict:
+    """
+    Computes the character and token level Levenshtein distances and similarities of a pair.
+
+    Args:
+        pair (dict): The pair, with the "generated" and "reference" texts and their "generated_tokens"
+            and "reference_tokens".
+
+    Returns:
+        dict: The "levenshtein_char" and "levenshtein_token" distances, their similarities (1 minus the
+            distance over the longest side) and the "length_difference" in characters.
+    """
+    columns = {}
+    for level, generated, reference in (("char", pair["generated"], pair["reference"]),
+                                        ("token", pair["generated_tokens"], pair["reference_tokens"])):
+        distance = levenshtein(reference, generated)
+        longest = max(len(reference), len(generated))
+        columns[f"levenshtein_{level}"] = float(distance)
+        columns[f"levenshtein_{level}_similarity"] = 1.0 - distance / longest if longest else 1.0
+    columns["length_difference"] = float(abs(len(pair["generated"]) - len(pair["reference"])))
+    return columns
+
+def levenshtein_aggregate(columns: dict) -> dict:
+    """
+    Averages the Levenshtein distances and similarities over the samples.
+
+    Args:
+        columns (dict): The columns of `levenshtein_score` for every sample.
+
+    Returns:
+        dict: The mean of every "levenshtein" column, suffixed with "_mean".
+    """
+    return {f"{key}_mean": float(np.mean(values)) if len(values) else 0.0
+            for key, values in columns.items() if key.startswith("levenshtein")}
+
+def token_prf_score(pair: dict) -> dict:
+    """
+    Computes the precision and recall of the set of generated tokens against the set of reference tokens.
+
+    Args:
+        pair (dict): The pair, with the "generated" and "reference" texts and their "generated_tokens"
+            and "reference_tokens".
+
+    Returns:
+        dict: The "token_precision" and "token_recall" columns, 0.0 for an empty side.
+    """
+    generated, reference = set(pair["generated_tokens"]), set(pair["reference_tokens"])
+    intersection = generated & reference
+    return {"token_precision": len(intersection) / len(generated) if generated else 0.0,
+            "token_recall": len(intersection) / len(reference) if reference else 0.0}
+
+def token_prf_aggregate(columns: dict) -> dict:
+    """
+    Averages precision and recall over the samples and derives the F1 score from the averages,
+    like `get_precision_recall_f1` in the analysis notebook.
+
+    Args:
+        columns (dict): The columns of `token_prf_score` for every sample.
+
+    Returns:
+        dict: The mean "token_precision" and "token_recall", and the "token_f1".
+    """
+    precision = float(np.mean(columns["token_precision"])) if len(columns["token_precision"]) else 0.0
+    recall = float(np.mean(columns["token_recall"])) if len(columns["token_recall"]) else 0.0
+    f1 = 2 * precision * recall / (precision + recall) if precision + recall > 0 else 0.0
+    return {"token_precision": precision, "token_recall": recall, "token_f1": f1}
+
+# ------------------------------------------------------------------------------------------------
+# Worker side
+# ------------------------------------------------------------------------------------------------
+
+_worker_state = {}
+
+def _init_worker(tokenizer_name: str, metrics: dict, timed: bool = False) -> None:
+    """
+    Loads the tokenizer once per worker process.
+
+    Args:
+        tokenizer_name (str): The name of the Hugging Face tokenizer, or None to split on words and punctuation.
+        metrics (dict): The metrics to compute, mapping names to (score, aggregate) pairs.
+        timed (bool, optional): Whether the time spent in every metric is measured. Defaults to False.
+    """
+    tokenizer = None
+    if tokenizer_name is not None:
+        from transformers import AutoTokenizer
+        tokenizer = AutoTokenizer.from_pretrained(tokenizer_name, trust_remote_code=True)
+    _worker_state["tokenizer"] = tokenizer
+    _worker_state["metrics"] = metrics
+    _worker_state["timed"] = timed
+
+def _tokenize(text: str) -> list:
+    """
+    Tokenizes a text with the tokenizer of the worker.
+
+    Args:
+        text (str): The text.
+
+    Returns:
+        list: The tokens, or the words and punctuation marks without a tokenizer.
+    """
+    tokenizer = _worker_state["tokenizer"]
+    return tokenizer.tokenize(text) if tokenizer is not None else _FALLBACK_TOKENS.findall(text)
+
+def _score_chunk(records: list[dict]) -> tuple[list[dict], dict]:
+    """
+    Tokenizes the pairs of a chunk once and computes every metric on them. This is the unit of work
+    sent to the pool.
+
+    Args:
+        records (list[dict]): Records with "generated" and "correct_middle" keys, and optionally
+            the pre-tokenized "generated_ids" and "correct_middle_ids".
+
+    Returns:
+        tuple[list[dict], dict]: The per-sample columns of every record, grouped by metric, and the
+            seconds spent in each metric (empty unless the worker is timed).
+    """
+    results, seconds = [], {}
+    metrics, timed = _worker_state["metrics"], _worker_state["timed"]
+    for record in records:
+        pair = {"generated": record["generated"], "reference": record["correct_middle"]}
+        if "generated_ids" in record and "correct_middle_ids" in record:
+            pair["generated_tokens"], pair["reference_tokens"] = record["generated_ids"], record["correct_middle_ids"]
+        else:
+            pair["generated_tokens"], pair["reference_tokens"] = _tokenize(pair["generated"]), _tokenize(pair["reference"])
+
+        if not timed:
+            results.append({name: score(pair) for name, (score, _) in metrics.items()})
+            continue
+        row = {}
+        for name, (score, _) in metrics.items():
+            start_time = time.perf_counter()
+            row[name] = score(pair)
+            seconds[name] = seconds.get(name, 0.0) + time.perf_counter() - start_time
+        results.append(row)
+    return results, seconds
+
+class MetricsEngine:
+    """
+    MetricsEngine computes all the quantitative metrics of the analysis notebook in one pass over a
+    generation run. Records are read in chunks, every pair is tokenized once (with the model tokenizer,
+    loaded once per worker) and the chunks are scored in a process pool. Corpus level metrics (chrF, BLEU)
+    are computed from summed per-sample statistics, so the per-sample columns are enough to recompute
+    them on any subset. The embedding cosine similarity is computed in the main process, in batches, and
+    the embeddings are kept in an EmbeddingCache when `embedding_cache_dir` is set.
+    New metrics are added with `MetricsEngine.register_metric`.
+    Attributes:
+        metrics (list[str]): The names of the metrics to compute.
+        tokenizer_name (str): The tokenizer shared by the token level metrics, or None.
+        num_workers (int): The number of worker processes.
+        chunk_size (int): The number of records per chunk.
+        embedding_model (str): The SentenceTransformer model of the cosine similarity, or None.
+        embedding_cache_dir (str): The directory of the embedding cache, or None.
+        aggregates (dict): The aggregates of the last run.
+    Methods:
+        register_metric(name: str, score: Callable, aggregate: Callable) -> None:
+            Registers a new metric.
+        iter_records(path: str):
+            Reads the records of a JSON or JSONL outputs file.
+        score(records: list[dict]) -> tuple[dict, dict]:
+            Computes the per-sample columns and the aggregates of some records.
+        run(input_path: str, output_path: str) -> dict:
+            Scores an outputs file and writes the columns and the aggregates.
+    """
+    METRICS = {
+        "exact_match": (exact_match_score, exact_match_aggregate),
+        "chrf": (chrf_score, chrf_aggregate),
+        "bleu": (bleu_score, bleu_aggregate),
+        "meteor": (meteor_score, meteor_aggregate),
+        "levenshtein": (levenshtein_score, levenshtein_aggregate),
+        "token_prf": (token_prf_score, token_prf_aggregate),
+    }
+    DEFAULT_METRICS = ["exact_match", "chrf", "bleu", "levenshtein", "token_prf"]
+
+    def __init__(self, metrics: list[str] = None, tokenizer_name: str = None, num_workers: int = 1,
+                 chunk_size: int = 256, embedding_model: str = None, embedding_batch_size: int = 64,
+                 embedding_cache_dir: str = None) -> None:
+        """
+        Initializes the MetricsEngine instance.
+
+        Args:
+            metrics (list[str], optional): The names of the metrics to compute. Defaults to DEFAULT_METRICS
+                (METEOR needs nltk and its data, so it has to be requested explicitly).
+            tokenizer_name (str, optional): The Hugging Face tokenizer of the token level metrics, e.g.
+                "deepseek-ai/deepseek-coder-1.3b-base". Defaults to None (split on words and punctuation).
+            num_workers (int, optional): The number of worker processes. Defaults to 1 (no pool).
+            chunk_size (int, optional): The number of records per chunk. Defaults to 256.
+            embedding_model (str, optional): The SentenceTransformer model of the cosine similarity,
+                e.g. "flax-sentence-embeddings/st-codesearch-distilroberta-base". Defaults to None (not computed).
+            embedding_batch_size (int, optional): The batch size of the embedding model. Defaults to 64.
+            embedding_cache_dir (str, optional): The directory of a persistent EmbeddingCache, so that texts
+                already embedded by a previous run (e.g. the same gold middles) are not encoded again.
+                Defaults to None (no cache).
+        """
+        self.metrics = metrics or list(self.DEFAULT_METRICS)
+        unknown = [name for name in self.metrics if name not in self.METRICS]
+        if unknown:
+            raise ValueError(f"Unknown metrics {unknown}, registered ones are {list(self.METRICS)}")
+        self.tokenizer_name = tokenizer_name
+        self.num_workers = num_workers
+        self.chunk_size = chunk_size
+        self.embedding_model = embedding_model
+        self.embedding_batch_size = embedding_batch_size
+        self.embedding_cache_dir = embedding_cache_dir
+        self.aggregates = {}
+
+    @classmethod
+    def register_metric(cls, name: str, score: Callable, aggregate: Callable) -> None:
+        """
+        Registers a new metric.
+
+        Args:
+            name (str): The name of the metric.
+            score (Callable): Computes the per-sample columns of a pair. It receives a dict with the
+                "generated" and "reference" strings and their "generated_tokens" and "reference_tokens",
+                and returns a dict of floats. It must be defined at module level to be sent to the workers.
+            aggregate (Callable): Reduces a dict of columns (numpy arrays) to a dict of corpus level scores.
+        """
+        cls.METRICS = {**cls.METRICS, name: (score, aggregate)}
+
+    @staticmethod
+    def iter_records(path: str):
+        """
+        Reads the records of an outputs file, either a JSON list (e.g. `model_outputs.json`)
+        or a JSONL file (e.g. a GenerationRun), one line at a time.
+
+        Args:
+            path (str): The path of the file.
+
+        Yields:
+            dict: Each record.
+        """
+        with open(path, "r", encoding="utf-8") as f:
+            first = f.read(1)
+            while first.isspace():
+                first = f.read(1)
+            f.seek(0)
+            if first == "[":
+                yield from json.load(f)
+                return
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+
+    def _iter_chunks(self, records):
+        """
+        Groups the records into chunks, the units of work of the pool.
+
+        Args:
+            records: An iterable of records.
+
+        Yields:
+            list[dict]: Up to `chunk_size` consecutive records.
+        """
+        chunk = []
+        for record in records:
+            chunk.append(record)
+            if len(chunk) == self.chunk_size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+    def _embedding_cosine(self, records: list[dict]) -> np.ndarray:
+        """
+        Computes the cosine similarity between the embeddings of the generated and the reference middles.
+
+        Args:
+            records (list[dict]): The records.
+
+        Returns:
+            np.ndarray: The cosine similarity of each pair.
+        """
+        texts = [r["generated"] for r in records] + [r["correct_middle"] for r in records]
+        if self.embedding_cache_dir is not None:
+            with EmbeddingCache(self.embedding_cache_dir, self.embedding_model, batch_size=self.embedding_batch_size) as cache:
+                embeddings = cache.encode(texts)
+            print(f"Embedding cache: {cache.stats['hits']} hits, {cache.stats['encoded']} texts encoded")
+        else:
+            from sentence_transformers import SentenceTransformer
+            model = SentenceTransformer(self.embedding_model)
+            embeddings = model.encode(texts, batch_size=self.embedding_batch_size, convert_to_numpy=True)
+
+        embeddings = embeddings / np.maximum(np.linalg.norm(embeddings, axis=1, keepdims=True), 1e-12)
+        generated, reference = embeddings[:len(records)], embeddings[len(records):]
+        return np.sum(generated * reference, axis=1)
+
+    def score(self, records) -> tuple[dict, dict]:
+        """
+        Computes the per-sample columns and the aggregates of some records.
+
+        Args:
+            records: An iterable of records with "generated" and "correct_middle" keys.
+
+        Returns:
+            tuple[dict, dict]: The per-sample columns (numpy arrays, in record order) and the aggregates.
+        """
+        metrics = {name: self.METRICS[name] for name in self.metrics}
+        records = list(records)
+        chunks = self._iter_chunks(records)
+
+        rows, metric_seconds = [], {}
+        # Every metric is timed separately only when someone listens to the events
+        timed = enabled()
+        with stage("score", items=len(records), metrics=list(metrics), num_workers=self.num_workers):
+            if self.num_workers <= 1:
+                _init_worker(self.tokenizer_name, metrics, timed)
+                results = list(map(_score_chunk, chunks))
+            else:
+                with ProcessPoolExecutor(max_workers=self.num_workers, initializer=_init_worker,
+                                         initargs=(self.tokenizer_name, metrics, timed)) as pool:
+                    results = list(pool.map(_score_chunk, chunks))
+        for chunk_rows, chunk_seconds in results:
+            rows.extend(chunk_rows)
+            for name, seconds in chunk_seconds.items():
+                metric_seconds[name] = metric_seconds.get(name, 0.0) + seconds
+        # The time of each metric is summed over the workers, so it is CPU time rather than wall time
+        for name, seconds in metric_seconds.items():
+            emit(name, seconds, items=len(rows), num_workers=self.num_workers)
+
+        columns, aggregates = {}, {"num_samples": len(rows)}
+        for name, (_, aggregate) in metrics.items():
+            if not rows:
+                break
+            # Each aggregate only sees the columns of its own metric
+            metric_columns = {key: np.array([row[name][key] for row in rows], dtype=np.float64) for key in rows[0][name]}
+            columns.update(metric_columns)
+            aggregates.update(aggregate(metric_columns))
+
+        if self.embedding_model is not None:
+            with stage("embed", items=len(records)):
+                columns["cosine"] = self._embedding_cosine(records).astype(np.float64)
+            aggregates["cosine_mean"] = float(np.mean(columns["cosine"])) if len(records) else 0.0
+            aggregates["cosine_median"] = float(np.median(columns["cosine"])) if len(records) else 0.0
+
+        if records and all("id" in record for record in records):
+            columns["id"] = np.array([record["id"] for record in records])
+        return columns, aggregates
+
+    def run(self, input_path: str, output_path: str) -> dict:
+        """
+        Scores an outputs file. The per-sample columns are written to `output_path` (a numpy .npz
+        archive, one array per column) and the aggregates next to it, as JSON.
+
+        Args:
+            input_path (str): The JSON or JSONL outputs file.
+            output_path (str): The .npz file of the per-sample columns.
+
+        Returns:
+            dict: The aggregates, also written to `<output_path without .npz>.json`.
+        """
+        start_time = time.perf_counter()
+        columns, aggregates = self.score(self.iter_records(input_path))
+        aggregates["seconds"] = time.perf_counter() - start_time
+        aggregates["samples_per_sec"] = aggregates["num_samples"] / aggregates["seconds"] if aggregates["seconds"] > 0 else 0.0
+
+        np.savez(output_path, **columns)
+        with open(os.path.splitext(output_path)[0] + ".json", "w") as f:
+            json.dump(aggregates, f, indent=4)
+        self.aggregates = aggregates
+        return aggregates
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Score a generation run with all the metrics in one pass.")
+    parser.add_argument("input", help="A JSON or JSONL file of records with 'generated' and 'correct_middle' keys")
+    parser.add_argument("output", help="The .npz file of the per-sample scores, the aggregates are written next to it")
+    parser.add_argument("--metrics", nargs="+", default=None, help=f"Defaults to {MetricsEngine.DEFAULT_METRICS}")
+    parser.add_argument("--tokenizer", default=None, help="e.g. deepseek-ai/deepseek-coder-1.3b-base")
+    parser.add_argument("--embedding-model", default=None, help="e.g. flax-sentence-embeddings/st-codesearch-distilroberta-base")
+    parser.add_argument("--embedding-cache-dir", default=None, help="Directory of a persistent embedding cache")
+    parser.add_argument("--num-workers", type=int, default=1)
+    parser.add_argument("--chunk-size", type=int, default=256)
+    args = parser.parse_args()
+
+    engine = MetricsEngine(args.metrics, args.tokenizer, args.num_workers, args.chunk_size, args.embedding_model,
+                           embedding_cache_dir=args.embedding_cache_dir)
+    print(json.dumps(engine.run(args.input, args.output), indent=4))
@@ -0,0 +1,5 @@
+from .edit_distance import levenshtein, levenshtein_reference, similarity, levenshtein_batch, similarity_batch
+from .EmbeddingCache import EmbeddingCache
+from .MetricsEngine import MetricsEngine
+
+__all__ = ["levenshtein", "levenshtein_reference", "similarity", "levenshtein_batch", "similarity_batch", "EmbeddingCache", "MetricsEngine"]
\ No newline at end of file
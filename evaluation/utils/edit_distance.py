@@ -0,0 +1,208 @@
+"""
+Description: This module computes character and token level Levenshtein distances, and the normalized similarity
+    derived from them, for whole lists of pairs at once.
+
+Usage (from the repository root):
+    python -m evaluation.utils.edit_distance evaluation/model_outputs.json
+"""
+from concurrent.futures import ProcessPoolExecutor
+from typing import Sequence
+from .profiling import stage
+import argparse
+import time
+import json
+import re
+
+def levenshtein(source: Sequence, target: Sequence) -> int:
+    """
+    Computes the Levenshtein distance between two sequences with the bit-parallel algorithm of Myers,
+    in the formulation of Hyyrö. A column of the dynamic programming matrix is encoded as the vertical
+    deltas (+1 / -1) between consecutive cells, held in two Python integers used as bit vectors, so a
+    whole column is updated with a handful of integer operations instead of one interpreted step per cell.
+    The longer sequence is the bit vector and the loop runs over the shorter one.
+
+    Args:
+        source (Sequence): The first sequence, a string or a list of (hashable) tokens.
+        target (Sequence): The second sequence, a string or a list of (hashable) tokens.
+
+    Returns:
+        int: The number of deletions, insertions or substitutions turning the source into the target.
+    """
+    if len(source) < len(target):
+        source, target = target, source
+    if not target:
+        return len(source)
+
+    # Bit i of match_masks[x] is set when source[i] == x
+    match_masks = {}
+    for i, element in enumerate(source):
+        match_masks[element] = match_masks.get(element, 0) | (1 << i)
+
+    length = len(source)
+    mask = (1 << length) - 1
+    last_bit = 1 << (length - 1)
+    positive, negative = mask, 0
+    distance = length
+
+    for element in target:
+        matches = match_masks.get(element, 0)
+        vertical = matches | negative
+        horizontal = (((matches & positive) + positive) ^ positive) | matches
+        horizontal_positive = negative | (~(horizontal | positive) & mask)
+        horizontal_negative = positive & horizontal
+
+        if horizontal_positive & last_bit:
+            distance += 1
+        elif horizontal_negative & last_bit:
+            distance -= 1
+
+        # The first row of the matrix grows by one at every column
+        horizontal_positive = ((horizontal_positive << 1) | 1) & mask
+        horizontal_negative = (horizontal_negative << 1) & mask
+        positive = horizontal_negative | (~(vertical | horizontal_positive) & mask)
+        negative = horizontal_positive & vertical
+
+    return distance
+
+def levenshtein_reference(source: Sequence, target: Sequence) -> int:
+    """
+    Computes the Levenshtein distance with the textbook dynamic programming recurrence, one cell at a time.
+    It is the reference the bit-parallel implementation is checked against.
+
+    Args:
+        source (Sequence): The first sequence.
+        target (Sequence): The second sequence.
+
+    Returns:
+        int: The Levenshtein distance between the two sequences.
+    """
+    previous = list(range(len(target) + 1))
+    for i in range(1, len(source) + 1):
+        current = [i] + [0] * len(target)
+        for j in range(1, len(target) + 1):
+            if source[i - 1] == target[j - 1]:
+                current[j] = previous[j - 1]
+            else:
+                current[j] = min(current[j - 1], previous[j], previous[j - 1]) + 1
+        previous = current
+    return previous[len(target)]
+
+def similarity(source: Sequence, target: Sequence) -> float:
+    """
+    Computes the normalized Levenshtein similarity, 1 - distance / max(len(source), len(target)).
+
+    Args:
+        source (Sequence): The first sequence.
+        target (Sequence): The second sequence.
+
+    Returns:
+        float: The similarity, between 0 and 1. Two empty sequences have a similarity of 1.
+    """
+    longest = max(len(source), len(target))
+    return 1.0 - levenshtein(source, target) / longest if longest else 1.0
+
+def _levenshtein_chunk(pairs: list[tuple]) -> list[int]:
+    """
+    Computes the distances of a chunk of pairs. This is the unit of work sent to the process pool.
+
+    Args:
+        pairs (list[tuple]): The (source, target) pairs.
+
+    Returns:
+        list[int]: The distance of each pair.
+    """
+    return [levenshtein(source, target) for source, target in pairs]
+
+def levenshtein_batch(sources: list[Sequence], targets: list[Sequence], num_workers: int = 1,
+                      chunk_size: int = 64) -> list[int]:
+    """
+    Computes the Levenshtein distance of every (source, target) pair, optionally across processes.
+
+    Args:
+        sources (list[Sequence]): The first sequence of every pair, strings or lists of tokens.
+        targets (list[Sequence]): The second sequence of every pair.
+        num_workers (int, optional): The number of processes. Defaults to 1 (no pool).
+        chunk_size (int, optional): The number of pairs sent to a process at once. Defaults to 64.
+
+    Returns:
+        list[int]: The distance of each pair, in input order.
+    """
+    if len(sources) != len(targets):
+        raise ValueError(f"Got {len(sources)} sources but {len(targets)} targets")
+
+    pairs = list(zip(sources, targets))
+    with stage("levenshtein", items=len(pairs), num_workers=num_workers):
+        if num_workers <= 1 or len(pairs) <= chunk_size:
+            return _levenshtein_chunk(pairs)
+
+        chunks = [pairs[start:start + chunk_size] for start in range(0, len(pairs), chunk_size)]
+        with ProcessPoolExecutor(max_workers=num_workers) as pool:
+            return [distance for chunk in pool.map(_levenshtein_chunk, chunks) for distance in chunk]
+
+def similarity_batch(sources: list[Sequence], targets: list[Sequence], num_workers: int = 1,
+                     chunk_size: int = 64) -> list[float]:
+    """
+    Computes the normalized Levenshtein similarity of every (source, target) pair, optionally across processes.
+
+    Args:
+        sources (list[Sequence]): The first sequence of every pair, strings or lists of tokens.
+        targets (list[Sequence]): The second sequence of every pair.
+        num_workers (int, optional): The number of processes. Defaults to 1 (no pool).
+        chunk_size (int, optional): The number of pairs sent to a process at once. Defaults to 64.
+
+    Returns:
+        list[float]: The similarity of each pair, in input order.
+    """
+    distances = levenshtein_batch(sources, targets, num_workers, chunk_size)
+    return [1.0 - distance / max(len(source), len(target)) if max(len(source), len(target)) else 1.0
+            for distance, source, target in zip(distances, sources, targets)]
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the Levenshtein implementations on generated samples.")
+    parser.add_argument("path", nargs="?", default="evaluation/model_outputs.json",
+                        help="A JSON list of records with 'generated' and 'correct_middle' keys")
+    parser.add_argument("--num-workers", type=int, default=4)
+    args = parser.parse_args()
+
+    with open(args.path, "r") as f:
+        data = json.load(f)
+    gold_answers = [x["correct_middle"] for x in data]
+    generated_answers = [x["generated"] for x in data]
+
+    timings = {}
+    start_time = time.perf_counter()
+    reference = [levenshtein_reference(gold, gen) for gold, gen in zip(gold_answers, generated_answers)]
+    timings["reference"] = time.perf_counter() - start_time
+
+    start_time = time.perf_counter()
+    bit_parallel = levenshtein_batch(gold_answers, generated_answers)
+    timings["bit_parallel"] = time.perf_counter() - start_time
+
+    start_time = time.perf_counter()
+    pooled = levenshtein_batch(gold_answers, generated_answers, num_workers=args.num_workers,
+                               chunk_size=max(1, len(data) // args.num_workers))
+    timings["bit_parallel_pool"] = time.perf_counter() - start_time
+
+    if reference != bit_parallel or reference != pooled:
+        raise AssertionError("The bit-parallel distances differ from the reference ones")
+
+    # Token level, with a simple identifier / punctuation split
+    tokenize = lambda text: re.findall(r"\w+|[^\w\s]", text)
+    gold_tokens, generated_tokens = [tokenize(x) for x in gold_answers], [tokenize(x) for x in generated_answers]
+    start_time = time.perf_counter()
+    token_reference = [levenshtein_reference(gold, gen) for gold, gen in zip(gold_tokens, generated_tokens)]
+    timings["token_reference"] = time.perf_counter() - start_time
+    start_time = time.perf_counter()
+    token_bit_parallel = levenshtein_batch(gold_tokens, generated_tokens)
+    timings["token_bit_parallel"] = time.perf_counter() - start_time
+    if token_reference != token_bit_parallel:
+        raise AssertionError("The bit-parallel token distances differ from the reference ones")
+
+    print(json.dumps({
+        "pairs": len(data),
+        "seconds": timings,
+        "char_speedup": timings["reference"] / timings["bit_parallel"],
+        "char_pool_speedup": timings["reference"] / timings["bit_parallel_pool"],
+        "token_speedup": timings["token_reference"] / timings["token_bit_parallel"],
+        "mean_distance": sum(bit_parallel) / len(bit_parallel) if bit_parallel else 0.0,
+    }, indent=4))
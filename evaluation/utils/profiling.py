@@ -0,0 +1,22 @@
+"""
+Description: This module re-exports the stage-level instrumentation of `generation/utils/profiling.py`,
+    so that the scoring stages report to the same hooks as the rest of the pipeline.
+    The analysis notebook imports this package as `utils`, without the repository root on the path:
+    the implementation is then loaded from its file, since the generation package is not importable.
+"""
+import importlib.util
+import os
+
+try:
+    from generation.utils import profiling as _profiling
+except ImportError:
+    _path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "generation", "utils", "profiling.py")
+    _spec = importlib.util.spec_from_file_location("profiling", _path)
+    _profiling = importlib.util.module_from_spec(_spec)
+    _spec.loader.exec_module(_profiling)
+
+add_hook = _profiling.add_hook
+remove_hook = _profiling.remove_hook
+enabled = _profiling.enabled
+emit = _profiling.emit
+stage = _profiling.stage
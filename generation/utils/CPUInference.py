@@ -0,0 +1,261 @@
+"""
+Description: This module contains the CPUInference class, which loads a causal language model for CPU-only
+    machines with dynamic int8 quantization of its linear layers, and benchmarks it against the fp32 model.
+"""
+from torch.utils.data import Dataset
+from transformers import AutoConfig, AutoModelForCausalLM, AutoTokenizer
+from transformers.modeling_utils import no_init_weights
+from transformers.utils import cached_file
+from .FIMGenerator import FIMGenerator
+import tempfile
+import hashlib
+import torch
+import time
+import io
+import os
+
+class CPUInference:
+    """
+    CPUInference prepares a model for generation on CPU. The `nn.Linear` layers (attention projections,
+    MLP and LM head) are converted to dynamically quantized int8 layers, which roughly quarter their memory
+    and speed up the matrix multiplications, and the number of intra-op threads is set explicitly.
+    Since the conversion takes a while for a 1.3B model, the state dict of the quantized model is saved to
+    `cache_dir` the first time. Afterwards the model is built from its config without initializing its weights,
+    its linear layers are replaced with empty int8 layers and the cached weights are loaded into it, which `torch.load` reads with `weights_only=True`
+    (no code is unpickled). The cache is keyed by model name, checkpoint fingerprint and torch version: a changed
+    checkpoint (a new hub revision or rewritten local weights) is quantized again, and the packed int8 weights
+    are tied to the torch version that produced them.
+    Attributes:
+        model_name (str): The name or local path of the checkpoint.
+        cache_dir (str): The directory where quantized models are cached.
+        num_threads (int): The number of intra-op threads, or None to keep the torch default.
+        quantize (bool): Whether the linear layers are quantized to int8.
+        trust_remote_code (bool): Whether the modeling code of the checkpoint may be downloaded and run.
+        model: The loaded model.
+        tokenizer: The loaded tokenizer.
+    Methods:
+        load() -> tuple:
+            Loads (and quantizes, or reads from the cache) the model and the tokenizer.
+        generate(dataset: Dataset, **generator_options) -> list[str]:
+            Generates the middles of a dataset in inference mode.
+        benchmark(model_name: str, dataset: Dataset, ...) -> dict:
+            Compares latency, memory and output quality of the fp32 and int8 models.
+    """
+
+    def __init__(self, model_name: str, cache_dir: str = "./quantized_models", num_threads: int = None,
+                 quantize: bool = True, trust_remote_code: bool = False) -> None:
+        """
+        Initializes the CPUInference instance.
+
+        Args:
+            model_name (str): The name or local path of the checkpoint.
+            cache_dir (str, optional): The directory where quantized models are cached. Defaults to "./quantized_models".
+            num_threads (int, optional): The number of intra-op threads, usually the number of physical cores.
+                Defaults to None (torch default).
+            quantize (bool, optional): Whether to quantize the linear layers to int8. Defaults to True.
+            trust_remote_code (bool, optional): Whether to run the modeling code shipped with the checkpoint,
+                only needed by architectures unknown to transformers. Defaults to False.
+        """
+        self.model_name = model_name
+        self.cache_dir = cache_dir
+        self.num_threads = num_threads
+        self.quantize = quantize
+        self.trust_remote_code = trust_remote_code
+        self.model = None
+        self.tokenizer = None
+
+    def checkpoint_fingerprint(self) -> str:
+        """
+        Fingerprints the checkpoint without reading its weights: the name, size and modification time of
+        every file of the checkpoint directory. For hub models the directory is the snapshot of the revision
+        in the local cache, so a new revision changes the fingerprint as well. When the hub cannot be reached,
+        the snapshot already in the local cache is used.
+
+        Returns:
+            str: A short hex digest of the checkpoint files.
+        """
+        if os.path.isdir(self.model_name):
+            checkpoint_dir = self.model_name
+        else:
+            try:
+                config_path = cached_file(self.model_name, "config.json")
+            except OSError:
+                config_path = cached_file(self.model_name, "config.json", local_files_only=True)
+            checkpoint_dir = os.path.dirname(config_path)
+        digest = hashlib.sha1(os.path.realpath(checkpoint_dir).encode("utf-8"))
+        for file_name in sorted(os.listdir(checkpoint_dir)):
+            path = os.path.join(checkpoint_dir, file_name)
+            if os.path.isfile(path):
+                stat = os.stat(path)
+                digest.update(f"\0{file_name}\0{stat.st_size}\0{stat.st_mtime_ns}".encode("utf-8"))
+        return digest.hexdigest()[:16]
+
+    def _cache_path(self) -> str:
+        """
+        Returns the path of the cached quantized model.
+
+        Returns:
+            str: The path of the state dict, unique for the model name, the checkpoint fingerprint and the torch version.
+        """
+        name = self.model_name.strip("/").replace("/", "--")
+        version = torch.__version__.replace("+", "_")
+        return os.path.join(self.cache_dir, f"{name}-{self.checkpoint_fingerprint()}-torch{version}-qint8-state.pt")
+
+    def load(self) -> tuple:
+        """
+        Loads the tokenizer and the model. When quantizing, the quantized model is read from the cache
+        if present, and otherwise converted from the fp32 checkpoint and written to the cache.
+
+        Returns:
+            tuple: The model (in eval mode, on CPU) and the tokenizer.
+        """
+        if self.num_threads is not None:
+            torch.set_num_threads(self.num_threads)
+
+        self.tokenizer = AutoTokenizer.from_pretrained(self.model_name, trust_remote_code=self.trust_remote_code)
+        if not self.quantize:
+            self.model = AutoModelForCausalLM.from_pretrained(self.model_name, torch_dtype=torch.float32,
+                                                              trust_remote_code=self.trust_remote_code).eval()
+            return self.model, self.tokenizer
+
+        path = self._cache_path()
+        if os.path.exists(path):
+            start_time = time.perf_counter()
+            config = AutoConfig.from_pretrained(self.model_name, trust_remote_code=self.trust_remote_code)
+            # The weights are overwritten by the cached ones, initializing them would only waste time
+            with no_init_weights():
+                model = AutoModelForCausalLM.from_config(config, torch_dtype=torch.float32,
+                                                         trust_remote_code=self.trust_remote_code).eval()
+            self.model = self._empty_quantized_linear(model)
+            self.model.load_state_dict(torch.load(path, weights_only=True))
+            print(f"Loaded quantized model from {path} in {time.perf_counter() - start_time:.2f}s")
+            return self.model, self.tokenizer
+
+        start_time = time.perf_counter()
+        model = AutoModelForCausalLM.from_pretrained(self.model_name, torch_dtype=torch.float32,
+                                                     trust_remote_code=self.trust_remote_code).eval()
+        self.model = self._quantize_linear(model)
+        print(f"Quantized {self.model_name} in {time.perf_counter() - start_time:.2f}s")
+
+        os.makedirs(self.cache_dir, exist_ok=True)
+        # Writing to a temporary file of its own first never leaves a truncated state dict in the cache,
+        # even with several processes quantizing the same checkpoint
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            torch.save(self.model.state_dict(), f)
+        os.replace(tmp_path, path)
+        return self.model, self.tokenizer
+
+    @staticmethod
+    def _quantize_linear(model):
+        """
+        Replaces the linear layers of a model with dynamically quantized int8 layers.
+
+        Args:
+            model: The fp32 model.
+
+        Returns:
+            The quantized model.
+        """
+        return torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+
+    @staticmethod
+    def _empty_quantized_linear(model):
+        """
+        Replaces the linear layers of a model with empty int8 layers, the same modules as `_quantize_linear`
+        produces, so that the state dict of a quantized model can be loaded into it without quantizing again.
+
+        Args:
+            model: The fp32 model, whose weights may be uninitialized.
+
+        Returns:
+            The model, with the int8 layers to be filled by `load_state_dict`.
+        """
+        for module in list(model.modules()):
+            for name, child in list(module.named_children()):
+                # quantize_dynamic only converts this exact type, subclasses are left as they are
+                if type(child) is torch.nn.Linear:
+                    setattr(module, name, torch.ao.nn.quantized.dynamic.Linear(
+                        child.in_features, child.out_features, bias_=child.bias is not None, dtype=torch.qint8))
+        return model
+
+    def generate(self, dataset: Dataset, **generator_options) -> list[str]:
+        """
+        Generates the middles of all the samples in the dataset in inference mode.
+
+        Args:
+            dataset (Dataset): A dataset whose items are (prefix, middle, suffix) tuples.
+            **generator_options: Additional keyword arguments for FIMGenerator (e.g. `max_new_tokens`).
+
+        Returns:
+            list[str]: The generated middles, in dataset order.
+        """
+        if self.model is None:
+            self.load()
+        with torch.inference_mode():
+            return FIMGenerator(self.model, self.tokenizer, **generator_options).generate(dataset)
+
+    @staticmethod
+    def model_size_mb(model) -> float:
+        """
+        Returns the size of the weights of a model, quantized weights included.
+
+        Args:
+            model: The model.
+
+        Returns:
+            float: The size of the serialized state dict, in MB.
+        """
+        # Packed int8 weights are not parameters, so they are measured through the state dict
+        buffer = io.BytesIO()
+        torch.save(model.state_dict(), buffer)
+        return buffer.tell() / 1024 ** 2
+
+    @classmethod
+    def benchmark(cls, model_name: str, dataset: Dataset, cache_dir: str = "./quantized_models",
+                  num_threads: int = None, trust_remote_code: bool = False, **generator_options) -> dict:
+        """
+        Generates the dataset with the fp32 and the int8 model and compares them. The quality of the int8
+        outputs is measured against the fp32 outputs, with exact match and chrF.
+
+        Args:
+            model_name (str): The name or local path of the checkpoint.
+            dataset (Dataset): A dataset whose items are (prefix, middle, suffix) tuples.
+            cache_dir (str, optional): The directory where quantized models are cached. Defaults to "./quantized_models".
+            num_threads (int, optional): The number of intra-op threads. Defaults to None (torch default).
+            trust_remote_code (bool, optional): Whether to run the modeling code shipped with the checkpoint.
+                Defaults to False.
+            **generator_options: Additional keyword arguments for FIMGenerator.
+
+        Returns:
+            dict: The load time, latency and weight memory of both models, the speedup and the int8 quality.
+        """
+        results, outputs = {}, {}
+        for name, quantize in (("fp32", False), ("int8", True)):
+            inference = cls(model_name, cache_dir=cache_dir, num_threads=num_threads, quantize=quantize,
+                             trust_remote_code=trust_remote_code)
+            start_time = time.perf_counter()
+            inference.load()
+            load_seconds = time.perf_counter() - start_time
+
+            start_time = time.perf_counter()
+            outputs[name] = inference.generate(dataset, **generator_options)
+            elapsed = time.perf_counter() - start_time
+            results[name] = {
+                "load_seconds": load_seconds,
+                "seconds": elapsed,
+                "latency_ms_per_sample": elapsed / len(dataset) * 1000 if len(dataset) else 0.0,
+                "weights_mb": cls.model_size_mb(inference.model),
+            }
+
+        results["speedup"] = results["fp32"]["seconds"] / results["int8"]["seconds"] if results["int8"]["seconds"] > 0 else 0.0
+        results["memory_ratio"] = results["int8"]["weights_mb"] / results["fp32"]["weights_mb"]
+        results["exact_match"] = sum(a == b for a, b in zip(outputs["fp32"], outputs["int8"])) / len(dataset) if len(dataset) else 0.0
+
+        import evaluate
+        chrf = evaluate.load("chrf")
+        results["chrf"] = chrf.compute(predictions=outputs["int8"], references=[[x] for x in outputs["fp32"]])["score"]
+
+        print(f"int8 vs fp32: {results['speedup']:.2f}x faster, {results['memory_ratio']:.2%} of the weight memory, "
+              f"exact match {results['exact_match']:.2%}, chrF {results['chrf']:.2f}")
+        return results
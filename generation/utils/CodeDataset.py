@@ -1,6 +1,39 @@
 from torch.utils.data import Dataset
+from .profiling import stage
 import random
 
+def sample_span(content_length: int, min_lengths: tuple, max_lengths: tuple, rng=random):
+    """
+    Randomly draws the position and the lengths of a prefix, middle and suffix inside a content.
+    Args:
+        content_length (int): The length of the content the span is drawn from.
+        min_lengths (tuple): A tuple (x, y, z) with the min prefix, middle and suffix lengths.
+        max_lengths (tuple): A tuple (x, y, z) with the max prefix, middle and suffix lengths.
+        rng: The random number generator to draw from. Defaults to the `random` module.
+    Returns:
+        tuple: A tuple (cursor_position, prefix_length, middle_length, suffix_length), or None if
+               the drawn middle does not leave enough room for the prefix and the suffix.
+    """
+    min_prefix_length, min_middle_length, min_suffix_length = min_lengths
+    max_prefix_length, max_middle_length, max_suffix_length = max_lengths
+
+    # Randomly select the middle length within the specified range
+    middle_length = rng.randint(min_middle_length, max_middle_length)
+
+    # Randomly select the cursor position ensuring space for middle and suffix
+    max_cursor_position = content_length - middle_length - min_suffix_length
+    if max_cursor_position <= min_prefix_length:
+        return None
+
+    cursor_position = rng.randint(min_prefix_length, max_cursor_position)
+
+    # Randomly determine prefix and suffix lengths based on the cursor position and available space
+    prefix_length = rng.randint(min_prefix_length, min(cursor_position, max_prefix_length))
+    suffix_length = rng.randint(min_suffix_length,
+                                min(content_length - cursor_position - middle_length, max_suffix_length))
+
+    return cursor_position, prefix_length, middle_length, suffix_length
+
 class CodeDataset(Dataset):
     def __init__(self, file_contents: list[str], num_samples: int = 50, 
                  min_lengths: tuple = (20, 10, 20), max_lengths: tuple = (200, 50, 200)):
@@ -14,11 +47,14 @@ class CodeDataset(Dataset):
         self.examples = []
         
         # Unpack the min and max lengths for prefix, middle, and suffix
+        self.min_lengths, self.max_lengths = min_lengths, max_lengths
         self.min_prefix_length, self.min_middle_length, self.min_suffix_length = min_lengths
         self.max_prefix_length, self.max_middle_length, self.max_suffix_length = max_lengths
         
         # Generate code completion examples
-        self._generate_examples(file_contents, num_samples)
+        with stage("sample", files=len(file_contents)) as event:
+            self._generate_examples(file_contents, num_samples)
+            event["items"] = len(self.examples)
     
     def _generate_examples(self, file_contents: list[str], num_samples: int):
         """
@@ -42,20 +78,10 @@ class CodeDataset(Dataset):
                 continue
             
             for _ in range(num_samples):
-                # Randomly select the middle length within the specified range
-                middle_length = random.randint(self.min_middle_length, self.max_middle_length)
-                
-                # Randomly select the cursor position ensuring space for middle and suffix
-                max_cursor_position = content_length - middle_length - self.min_suffix_length
-                if max_cursor_position <= self.min_prefix_length:
+                span = sample_span(content_length, self.min_lengths, self.max_lengths)
+                if span is None:
                     continue
-
-                cursor_position = random.randint(self.min_prefix_length, max_cursor_position)
-                
-                # Randomly determine prefix and suffix lengths based on the cursor position and available space
-                prefix_length = random.randint(self.min_prefix_length, min(cursor_position, self.max_prefix_length))
-                suffix_length = random.randint(self.min_suffix_length, 
-                                               min(content_length - cursor_position - middle_length, self.max_suffix_length))
+                cursor_position, prefix_length, middle_length, suffix_length = span
 
                 # Define the prefix, middle, and suffix
                 prefix = content[cursor_position - prefix_length:cursor_position]
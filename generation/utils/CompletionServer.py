@@ -0,0 +1,309 @@
+"""
+Description: This module contains the CompletionServer class, a small local HTTP service serving FIM completions.
+    Concurrent requests are merged into micro-batches and generated together with a FIMGenerator.
+
+Usage (from the repository root):
+    python -m generation.utils.CompletionServer --model deepseek-ai/deepseek-coder-1.3b-base --port 8000
+    curl -X POST localhost:8000/complete -d '{"prefix": "def add(a, b):\\n", "suffix": "\\n"}'
+    curl localhost:8000/metrics
+"""
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+from .FIMGenerator import FIMGenerator
+import numpy as np
+import argparse
+import asyncio
+import logging
+import json
+import time
+
+logger = logging.getLogger(__name__)
+
+class CompletionServer:
+    """
+    CompletionServer accepts completion requests over HTTP and queues them. A single batching task takes the
+    first queued request, waits at most `max_wait_ms` for more requests (or until `max_batch_size` are queued)
+    and generates the whole micro-batch in a worker thread, so that the event loop keeps accepting requests
+    while the model runs. Each request is answered as soon as its micro-batch is done.
+    Endpoints:
+        POST /complete: `{"prefix": ..., "suffix": ...}` returns `{"generated": ..., "latency_ms": ...}`.
+            `{"samples": [{"prefix": ..., "suffix": ...}, ...]}` streams one JSON line per sample
+            (with its `index`) in completion order, using chunked transfer encoding. A sample that fails gets
+            a `{"index": ..., "error": ...}` line instead, since the status line is already sent.
+        GET /metrics: The number of requests and batches, the queue depth and the p50/p95 latency.
+    Attributes:
+        generator (FIMGenerator): The generator running the micro-batches.
+        max_batch_size (int): The maximum number of requests in a micro-batch.
+        max_wait_ms (float): The maximum time the first request of a micro-batch waits for others.
+    Methods:
+        complete(prefix: str, suffix: str) -> str:
+            Queues a request and waits for its completion.
+        metrics() -> dict:
+            Returns the latency and queue metrics.
+        serve(host: str, port: int) -> None:
+            Serves HTTP requests until cancelled.
+    """
+
+    def __init__(self, generator: FIMGenerator, max_batch_size: int = 8, max_wait_ms: float = 20,
+                 latency_window: int = 1000) -> None:
+        """
+        Initializes the CompletionServer instance.
+
+        Args:
+            generator (FIMGenerator): The generator running the micro-batches.
+            max_batch_size (int, optional): The maximum number of requests in a micro-batch. Defaults to 8.
+            max_wait_ms (float, optional): The maximum time (in ms) the first request of a micro-batch
+                waits for other requests. Defaults to 20.
+            latency_window (int, optional): The number of recent requests the latency percentiles
+                are computed on. Defaults to 1000.
+        """
+        self.generator = generator
+        self.max_batch_size = max_batch_size
+        self.max_wait_ms = max_wait_ms
+        self._queue = None
+        self._latencies = deque(maxlen=latency_window)
+        self._counters = {"requests": 0, "batches": 0, "batched_requests": 0}
+        # A single thread, the model is not meant to run concurrently with itself
+        self._executor = ThreadPoolExecutor(max_workers=1)
+
+    def _generate_batch(self, samples: list[tuple]) -> list[str]:
+        """
+        Generates a micro-batch. Runs in the worker thread.
+
+        Args:
+            samples (list[tuple]): The (prefix, middle, suffix) tuples of the batch.
+
+        Returns:
+            list[str]: The generated middles, in batch order.
+        """
+        results = [None] * len(samples)
+        for indices, outputs in self.generator.generate_batches(samples):
+            for idx, output in zip(indices, outputs):
+                results[idx] = output
+        return results
+
+    async def _batch_loop(self) -> None:
+        """
+        Forms micro-batches out of the queue and generates them, one at a time.
+        """
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            deadline = loop.time() + self.max_wait_ms / 1000
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            samples = [(prefix, "", suffix) for prefix, suffix, _ in batch]
+            try:
+                outputs = await loop.run_in_executor(self._executor, self._generate_batch, samples)
+            except Exception as e:
+                logger.exception("Error generating a batch of %d requests", len(batch))
+                for _, _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+
+            self._counters["batches"] += 1
+            self._counters["batched_requests"] += len(batch)
+            for (_, _, future), output in zip(batch, outputs):
+                if not future.done():
+                    future.set_result(output)
+
+    async def complete(self, prefix: str, suffix: str) -> str:
+        """
+        Queues a request and waits for its completion.
+
+        Args:
+            prefix (str): The code before the hole.
+            suffix (str): The code after the hole.
+
+        Returns:
+            str: The generated middle.
+
+        Raises:
+            RuntimeError: If the server is not running, since only `serve` starts the batching loop.
+        """
+        if self._queue is None:
+            raise RuntimeError("CompletionServer is not running, call serve() before complete()")
+        start_time = time.perf_counter()
+        future = asyncio.get_running_loop().create_future()
+        self._counters["requests"] += 1
+        await self._queue.put((prefix, suffix, future))
+        result = await future
+        self._latencies.append(time.perf_counter() - start_time)
+        return result
+
+    def metrics(self) -> dict:
+        """
+        Returns the latency and queue metrics of the server.
+
+        Returns:
+            dict: The number of requests and batches, the mean batch size, the queue depth and the
+                p50/p95 latency (in ms) of the recent requests.
+        """
+        latencies = np.array(self._latencies) * 1000
+        return {
+            "requests": self._counters["requests"],
+            "batches": self._counters["batches"],
+            "mean_batch_size": self._counters["batched_requests"] / self._counters["batches"] if self._counters["batches"] else 0.0,
+            "queue_depth": self._queue.qsize() if self._queue is not None else 0,
+            "latency_p50_ms": float(np.percentile(latencies, 50)) if len(latencies) else 0.0,
+            "latency_p95_ms": float(np.percentile(latencies, 95)) if len(latencies) else 0.0,
+        }
+
+    @staticmethod
+    async def _write_response(writer: asyncio.StreamWriter, status: str, body: dict) -> None:
+        """
+        Writes a complete JSON response.
+
+        Args:
+            writer (asyncio.StreamWriter): The connection.
+            status (str): The HTTP status, e.g. "200 OK".
+            body (dict): The JSON body.
+        """
+        payload = json.dumps(body).encode("utf-8")
+        writer.write(f"HTTP/1.1 {status}\r\nContent-Type: application/json\r\n"
+                     f"Content-Length: {len(payload)}\r\nConnection: close\r\n\r\n".encode("ascii") + payload)
+        await writer.drain()
+
+    async def _stream_samples(self, writer: asyncio.StreamWriter, samples: list[dict]) -> None:
+        """
+        Queues several samples and streams one JSON line per sample as soon as it is generated.
+
+        Args:
+            writer (asyncio.StreamWriter): The connection.
+            samples (list[dict]): The samples, with "prefix" and "suffix" keys.
+        """
+        async def complete_indexed(index, sample):
+            start_time = time.perf_counter()
+            try:
+                generated = await self.complete(sample["prefix"], sample["suffix"])
+            except Exception as e:
+                # The status line is already sent, so the failure is reported in the line of the sample
+                logger.warning("Error completing sample %d: %s", index, e)
+                return {"index": index, "error": str(e)}
+            return {"index": index, "generated": generated, "latency_ms": (time.perf_counter() - start_time) * 1000}
+
+        def write_chunk(body: dict) -> None:
+            line = (json.dumps(body) + "\n").encode("utf-8")
+            writer.write(f"{len(line):x}\r\n".encode("ascii") + line + b"\r\n")
+
+        writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: application/x-ndjson\r\n"
+                     b"Transfer-Encoding: chunked\r\nConnection: close\r\n\r\n")
+        tasks = [asyncio.ensure_future(complete_indexed(i, sample)) for i, sample in enumerate(samples)]
+        try:
+            try:
+                for task in asyncio.as_completed(tasks):
+                    write_chunk(await task)
+                    await writer.drain()
+            except ConnectionError:
+                raise
+            except Exception as e:
+                # Any other failure ends the stream with an error line, never with a second status line
+                logger.exception("Error streaming samples")
+                write_chunk({"error": str(e)})
+            writer.write(b"0\r\n\r\n")
+            await writer.drain()
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def _handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        """
+        Handles one HTTP request.
+
+        Args:
+            reader (asyncio.StreamReader): The request stream.
+            writer (asyncio.StreamWriter): The response stream.
+        """
+        try:
+            request_line = (await reader.readline()).decode("latin-1").split()
+            headers = {}
+            while True:
+                line = (await reader.readline()).decode("latin-1").strip()
+                if not line:
+                    break
+                name, _, value = line.partition(":")
+                headers[name.strip().lower()] = value.strip()
+            if len(request_line) < 2:
+                return await self._write_response(writer, "400 Bad Request", {"error": "Malformed request line"})
+            method, path = request_line[0], request_line[1]
+
+            if method == "GET" and path == "/metrics":
+                return await self._write_response(writer, "200 OK", self.metrics())
+            if method != "POST" or path != "/complete":
+                return await self._write_response(writer, "404 Not Found", {"error": f"No route for {method} {path}"})
+
+            try:
+                body = json.loads(await reader.readexactly(int(headers.get("content-length", 0))))
+                if "samples" in body:
+                    samples = [{"prefix": str(s["prefix"]), "suffix": str(s.get("suffix", ""))} for s in body["samples"]]
+                    return await self._stream_samples(writer, samples)
+                prefix, suffix = str(body["prefix"]), str(body.get("suffix", ""))
+            except (ValueError, KeyError, TypeError) as e:
+                return await self._write_response(writer, "400 Bad Request", {"error": f"Invalid body: {e}"})
+
+            start_time = time.perf_counter()
+            generated = await self.complete(prefix, suffix)
+            await self._write_response(writer, "200 OK", {"generated": generated,
+                                                          "latency_ms": (time.perf_counter() - start_time) * 1000})
+        except ConnectionError as e:
+            logger.warning("Connection lost: %s", e)
+        except Exception as e:
+            logger.exception("Error handling request")
+            try:
+                await self._write_response(writer, "500 Internal Server Error", {"error": str(e)})
+            except ConnectionError:
+                pass
+        finally:
+            writer.close()
+
+    async def serve(self, host: str = "127.0.0.1", port: int = 8000) -> None:
+        """
+        Serves HTTP requests until cancelled.
+
+        Args:
+            host (str, optional): The address to bind. Defaults to "127.0.0.1".
+            port (int, optional): The port to bind. Defaults to 8000.
+        """
+        self._queue = asyncio.Queue()
+        batch_task = asyncio.create_task(self._batch_loop())
+        server = await asyncio.start_server(self._handle_connection, host, port)
+        logger.info("Serving completions on http://%s:%d", host, port)
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            batch_task.cancel()
+            self._queue = None
+
+if __name__ == "__main__":
+    from transformers import AutoModelForCausalLM, AutoTokenizer
+    import torch
+
+    parser = argparse.ArgumentParser(description="Serve FIM completions over HTTP with dynamic micro-batching.")
+    parser.add_argument("--model", required=True, help="Name or local path of a causal LM checkpoint")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--max-batch-size", type=int, default=8)
+    parser.add_argument("--max-wait-ms", type=float, default=20)
+    parser.add_argument("--max-new-tokens", type=int, default=200)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    tokenizer = AutoTokenizer.from_pretrained(args.model)
+    model = AutoModelForCausalLM.from_pretrained(args.model).to(device).eval()
+    generator = FIMGenerator(model, tokenizer, max_new_tokens=args.max_new_tokens, max_batch_size=args.max_batch_size)
+
+    server = CompletionServer(generator, max_batch_size=args.max_batch_size, max_wait_ms=args.max_wait_ms)
+    try:
+        asyncio.run(server.serve(args.host, args.port))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,311 @@
+"""
+Description: This module contains the DatasetPipeline class, which builds a code completion dataset out of
+    many repositories at once and writes it as size-bounded JSONL shards described by a manifest.
+"""
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
+from collections import deque
+from .RepoExtractor import RepoExtractor
+from .StreamingCodeDataset import StreamingCodeDataset
+import traceback
+import shutil
+import time
+import json
+import os
+
+def _build_repo_samples(repo_url: str, repo_dir: str, num_samples: int, min_lengths: tuple, max_lengths: tuple,
+                        seed: int, extractor_options: dict) -> tuple[list, dict]:
+    """
+    Extracts a repository and draws its code completion examples. This is the unit of work sent to the process pool.
+    The files are streamed from the extractor straight into the reservoir sampling, so only the examples
+    (and not the whole repository) are sent back to the main process.
+
+    Args:
+        repo_url (str): The URL (or local path) of the repository.
+        repo_dir (str): The scratch directory of this repository.
+        num_samples (int): The number of examples to draw from the repository.
+        min_lengths (tuple): The min prefix, middle and suffix lengths.
+        max_lengths (tuple): The max prefix, middle and suffix lengths.
+        seed (int): The seed used to draw the examples.
+        extractor_options (dict): Additional keyword arguments for RepoExtractor.
+
+    Returns:
+        tuple[list, dict]: The (prefix, middle, suffix) examples and the timings of the repository.
+    """
+    stats = {"num_files": 0, "extraction_seconds": 0.0}
+    start_time = time.perf_counter()
+
+    extractor = RepoExtractor(repo_url, repo_dir=repo_dir, lazy=True, **extractor_options)
+
+    def timed_files():
+        # Time spent waiting for the extractor is extraction time, the rest is sampling time
+        files = extractor.iter_files()
+        while True:
+            file_start = time.perf_counter()
+            content = next(files, None)
+            stats["extraction_seconds"] += time.perf_counter() - file_start
+            if content is None:
+                return
+            stats["num_files"] += 1
+            yield content
+
+    samples = StreamingCodeDataset(timed_files, num_samples, min_lengths, max_lengths, seed).sample()
+
+    stats["total_seconds"] = time.perf_counter() - start_time
+    stats["sampling_seconds"] = stats["total_seconds"] - stats["extraction_seconds"]
+    stats["num_samples"] = len(samples)
+    return samples, stats
+
+class DatasetPipeline:
+    """
+    DatasetPipeline extracts many repositories concurrently in a process pool, samples code completion
+    examples from each of them and writes the examples to JSONL shards of bounded size.
+    A repository which fails is retried up to `max_retries` times and then skipped, without aborting the run.
+    An attempt fails when it raises, when it runs longer than `timeout` (its worker is stopped) or when a worker
+    dies (e.g. killed for lack of memory): the pool is then rebuilt and the attempt counts against every repository
+    it was running, since the culprit cannot be told apart.
+    The output directory holds the shards and a `manifest.json` describing them, together with the
+    status, the number of files and samples and the timings of every repository.
+    Attributes:
+        repos (list[str]): The URLs (or local paths) of the repositories.
+        output_dir (str): The directory where the shards and the manifest are written.
+        manifest (dict): The manifest of the last run.
+    Methods:
+        run() -> dict:
+            Builds the dataset and returns its manifest.
+        iter_samples(output_dir: str):
+            Reads back the examples of a built dataset.
+    """
+    MANIFEST_FILE = "manifest.json"
+
+    def __init__(self, repos: list[str], output_dir: str, num_samples: int = 50, min_lengths: tuple = (20, 10, 20),
+                 max_lengths: tuple = (200, 50, 200), num_workers: int = 4, max_retries: int = 1,
+                 shard_size_mb: float = 64, seed: int = None, work_dir: str = "./temp_pipeline",
+                 extractor_options: dict = None, timeout: float = None) -> None:
+        """
+        Initializes the DatasetPipeline instance.
+
+        Args:
+            repos (list[str]): The URLs (or local paths) of the repositories.
+            output_dir (str): The directory where the shards and the manifest are written.
+            num_samples (int, optional): The number of examples drawn from each repository. Defaults to 50.
+            min_lengths (tuple, optional): The min prefix, middle and suffix lengths. Defaults to (20, 10, 20).
+            max_lengths (tuple, optional): The max prefix, middle and suffix lengths. Defaults to (200, 50, 200).
+            num_workers (int, optional): The number of repositories extracted concurrently. Defaults to 4.
+            max_retries (int, optional): The number of times a failed repository is retried. Defaults to 1.
+            shard_size_mb (float, optional): The maximum size of a shard, in MB. Defaults to 64.
+            seed (int, optional): The base seed; repository i is sampled with seed + i. Defaults to None.
+            work_dir (str, optional): The scratch directory where repositories are cloned. Defaults to "./temp_pipeline".
+            extractor_options (dict, optional): Additional keyword arguments for RepoExtractor
+                (e.g. `checkout=False` or `cache_dir`). Defaults to None.
+            timeout (float, optional): The maximum duration of an attempt, in seconds. Defaults to None (no limit).
+        """
+        self.repos = repos
+        self.output_dir = output_dir
+        self.num_samples = num_samples
+        self.min_lengths, self.max_lengths = min_lengths, max_lengths
+        self.num_workers = num_workers
+        self.max_retries = max_retries
+        self.shard_size_bytes = int(shard_size_mb * 1024 ** 2)
+        self.seed = seed
+        self.work_dir = work_dir
+        self.extractor_options = extractor_options or {}
+        self.timeout = timeout
+        self.manifest = {}
+
+        self._shard = None
+        self._shards = []
+        self._repo_dirs = []
+
+    def _write_sample(self, record: dict) -> None:
+        """
+        Appends an example to the current shard, starting a new shard when the current one is full.
+
+        Args:
+            record (dict): The example to write.
+        """
+        line = (json.dumps(record) + "\n").encode("utf-8")
+        # A shard always holds at least one example, even if it is bigger than the shard size
+        shard_full = self._shard is not None and self._shards[-1]["bytes"] + len(line) > self.shard_size_bytes
+        if self._shard is None or shard_full:
+            self._close_shard()
+            name = f"shard-{len(self._shards):05d}.jsonl"
+            self._shard = open(os.path.join(self.output_dir, name), "wb")
+            self._shards.append({"path": name, "num_samples": 0, "bytes": 0})
+
+        self._shard.write(line)
+        self._shards[-1]["num_samples"] += 1
+        self._shards[-1]["bytes"] += len(line)
+
+    def _close_shard(self) -> None:
+        """
+        Closes the current shard, if any.
+        """
+        if self._shard is not None:
+            self._shard.close()
+            self._shard = None
+
+    def _submit(self, pool: ProcessPoolExecutor, index: int):
+        """
+        Submits the extraction of a repository to the pool.
+
+        Args:
+            pool (ProcessPoolExecutor): The pool.
+            index (int): The index of the repository.
+
+        Returns:
+            Future: The future of the extraction.
+        """
+        # Every submission gets a directory of its own, a stopped worker may leave a partial clone behind
+        repo_dir = os.path.join(self.work_dir, f"repo-{index}-{len(self._repo_dirs)}")
+        self._repo_dirs.append(repo_dir)
+        seed = None if self.seed is None else self.seed + index
+        return pool.submit(_build_repo_samples, self.repos[index], repo_dir, self.num_samples,
+                           self.min_lengths, self.max_lengths, seed, self.extractor_options)
+
+    @staticmethod
+    def _terminate(pool: ProcessPoolExecutor) -> None:
+        """
+        Stops the workers of a pool, since a running task cannot be cancelled, and shuts the pool down.
+
+        Args:
+            pool (ProcessPoolExecutor): The pool.
+        """
+        for process in list((pool._processes or {}).values()):
+            process.terminate()
+        pool.shutdown(wait=True, cancel_futures=True)
+
+    def _fail(self, info: dict, index: int, error: str, queue: deque) -> None:
+        """
+        Records a failed attempt of a repository, and queues it again if it has attempts left.
+
+        Args:
+            info (dict): The manifest entry of the repository.
+            index (int): The index of the repository.
+            error (str): The error of the attempt.
+            queue (deque): The repositories waiting for a worker.
+        """
+        info["error"] = error
+        if info["attempts"] <= self.max_retries:
+            print(f"Error extracting {info['repo']} (attempt {info['attempts']}), retrying: {error}")
+            queue.append(index)
+        else:
+            print(f"Error extracting {info['repo']}, skipping it: {error}")
+            info["status"] = "failed"
+
+    def run(self) -> dict:
+        """
+        Builds the dataset: extracts and samples every repository, writes the shards and the manifest.
+
+        Returns:
+            dict: The manifest of the dataset.
+        """
+        os.makedirs(self.output_dir, exist_ok=True)
+        os.makedirs(self.work_dir, exist_ok=True)
+        self._shards = []
+        self._repo_dirs = []
+        repos_info = [{"repo": repo, "status": "pending", "attempts": 0} for repo in self.repos]
+        start_time = time.perf_counter()
+
+        queue = deque(range(len(self.repos)))
+        # The future of every running attempt, with its repository and deadline. At most one attempt per worker
+        # is submitted, so that an attempt starts running when it is submitted and its deadline is meaningful
+        running = {}
+        pool = ProcessPoolExecutor(max_workers=self.num_workers)
+        try:
+            while queue or running:
+                while queue and len(running) < self.num_workers:
+                    index = queue.popleft()
+                    repos_info[index]["attempts"] += 1
+                    deadline = None if self.timeout is None else time.monotonic() + self.timeout
+                    running[self._submit(pool, index)] = (index, deadline)
+
+                deadlines = [deadline for _, deadline in running.values() if deadline is not None]
+                wait_seconds = max(0.0, min(deadlines) - time.monotonic()) if deadlines else None
+                done, _ = wait(running, timeout=wait_seconds, return_when=FIRST_COMPLETED)
+
+                if not done:
+                    # The repositories out of time fail, the others are queued again without losing an attempt
+                    now = time.monotonic()
+                    self._terminate(pool)
+                    for future, (index, deadline) in list(running.items()):
+                        if deadline is not None and deadline <= now:
+                            self._fail(repos_info[index], index, f"Timed out after {self.timeout}s", queue)
+                        else:
+                            repos_info[index]["attempts"] -= 1
+                            queue.appendleft(index)
+                    running = {}
+                    pool = ProcessPoolExecutor(max_workers=self.num_workers)
+                    continue
+
+                broken = False
+                for future in done:
+                    index, _ = running.pop(future)
+                    info = repos_info[index]
+                    try:
+                        samples, stats = future.result()
+                    except BrokenProcessPool as e:
+                        broken = True
+                        self._fail(info, index, f"Worker process died: {e}", queue)
+                        continue
+                    except Exception as e:
+                        self._fail(info, index, "".join(traceback.format_exception_only(type(e), e)).strip(), queue)
+                        continue
+
+                    for prefix, middle, suffix in samples:
+                        self._write_sample({"repo": info["repo"], "prefix": prefix, "correct_middle": middle, "suffix": suffix})
+                    info.update(stats, status="done")
+                    info.pop("error", None)
+                    print(f"Extracted {info['repo']}: {stats['num_files']} files, {stats['num_samples']} samples "
+                          f"in {stats['total_seconds']:.2f}s")
+
+                if broken:
+                    # A broken pool fails all its running attempts, each of them counts
+                    for future, (index, _) in running.items():
+                        self._fail(repos_info[index], index, "Worker process died", queue)
+                    running = {}
+                    self._terminate(pool)
+                    pool = ProcessPoolExecutor(max_workers=self.num_workers)
+        finally:
+            self._terminate(pool)
+            self._close_shard()
+            # Failed extractions may leave their clone behind
+            for repo_dir in self._repo_dirs:
+                shutil.rmtree(repo_dir, ignore_errors=True)
+
+        self.manifest = {
+            "num_samples": sum(shard["num_samples"] for shard in self._shards),
+            "total_seconds": time.perf_counter() - start_time,
+            "config": {
+                "num_samples": self.num_samples,
+                "min_lengths": list(self.min_lengths),
+                "max_lengths": list(self.max_lengths),
+                "seed": self.seed,
+                "timeout": self.timeout,
+            },
+            "shards": self._shards,
+            "repos": repos_info,
+        }
+        with open(os.path.join(self.output_dir, self.MANIFEST_FILE), "w") as f:
+            json.dump(self.manifest, f, indent=4)
+        return self.manifest
+
+    @classmethod
+    def iter_samples(cls, output_dir: str):
+        """
+        Reads back the examples of a built dataset, shard by shard.
+
+        Args:
+            output_dir (str): The output directory of the pipeline.
+
+        Yields:
+            tuple: A tuple containing the prefix, middle, and suffix segments of an example.
+        """
+        with open(os.path.join(output_dir, cls.MANIFEST_FILE), "r") as f:
+            manifest = json.load(f)
+
+        for shard in manifest["shards"]:
+            with open(os.path.join(output_dir, shard["path"]), "r", encoding="utf-8") as f:
+                for line in f:
+                    record = json.loads(line)
+                    yield record["prefix"], record["correct_middle"], record["suffix"]
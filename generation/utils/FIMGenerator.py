@@ -0,0 +1,348 @@
+"""
+Description: This module contains the FIMGenerator class, which runs fill-in-the-middle (FIM) generation
+    over a whole CodeDataset at once by grouping prompts of similar length into left-padded batches.
+"""
+from torch.utils.data import Dataset
+from transformers import StoppingCriteriaList
+from .SuffixStopping import SuffixStoppingCriteria
+from .profiling import stage
+import torch
+import time
+
+FIM_BEGIN = "<｜fim▁begin｜>"
+FIM_HOLE = "<｜fim▁hole｜>"
+FIM_END = "<｜fim▁end｜>"
+
+class FIMGenerator:
+    """
+    FIMGenerator is a class designed to generate the missing middle of many FIM samples
+    in batches instead of calling `model.generate` once per sample.
+    Prompts are tokenized once, grouped into buckets of similar length (so that little
+    compute is wasted on padding), left-padded into batches and generated together.
+    The outputs are then decoded back to the position of the sample they belong to.
+    Items are (prefix, middle, suffix) tuples, or dicts with ready-made prompt `input_ids`
+    (see TokenizedCodeDataset), which are used as they are instead of tokenizing the prompt.
+    Attributes:
+        model: The causal language model used for generation.
+        tokenizer: The tokenizer associated with the model.
+        max_new_tokens (int): The maximum number of tokens generated for each sample.
+        memory_budget_mb (int): The memory (in MB) a single batch is allowed to use.
+        max_batch_size (int): The upper bound on the automatically chosen batch size.
+        bucket_width (int): The width (in tokens) of each prompt length bucket.
+        encode_chunk_size (int): The number of samples encoded and bucketed together.
+        stop_at_suffix (bool): Whether generation stops once the model starts reproducing the suffix.
+        max_lines (int): The line budget of a completion, or None.
+        max_tokens (int): The token budget of a completion, or None.
+        stats (dict): Throughput statistics of the last `generate` call.
+    Methods:
+        build_prompt(prefix: str, suffix: str) -> str:
+            Builds the FIM prompt for a prefix and a suffix.
+        unpack(item) -> tuple:
+            Returns the prefix, middle and suffix of a dataset item.
+        encode_item(tokenizer, item) -> list[int]:
+            Returns the prompt token ids of a dataset item.
+        auto_batch_size(prompt_length: int) -> int:
+            Picks the largest batch size fitting in the memory budget.
+        generate_batches(dataset: Dataset, with_ids: bool):
+            Yields the indices and the generated middles (and token ids) of each batch.
+        generate(dataset: Dataset) -> list[str]:
+            Generates the middles of all the samples in the dataset.
+    """
+
+    def __init__(self, model, tokenizer, max_new_tokens: int = 200, memory_budget_mb: int = 2048,
+                 max_batch_size: int = 32, bucket_width: int = 32, stop_at_suffix: bool = False,
+                 max_lines: int = None, max_tokens: int = None, suffix_match_chars: int = 20,
+                 encode_chunk_size: int = 4096) -> None:
+        """
+        Initializes the FIMGenerator instance.
+
+        Args:
+            model: The causal language model used for generation.
+            tokenizer: The tokenizer associated with the model.
+            max_new_tokens (int, optional): The maximum number of new tokens per sample. Defaults to 200.
+            memory_budget_mb (int, optional): The memory budget (in MB) for a single batch. Defaults to 2048.
+            max_batch_size (int, optional): The maximum batch size. Use 1 to reproduce the per-sample path. Defaults to 32.
+            bucket_width (int, optional): The width (in tokens) of the prompt length buckets. Defaults to 32.
+            stop_at_suffix (bool, optional): If True, a completion is stopped (and trimmed) as soon as it starts
+                reproducing the beginning of its suffix, see SuffixStoppingCriteria. Defaults to False.
+            max_lines (int, optional): The line budget of a completion. Defaults to None (no budget).
+            max_tokens (int, optional): The token budget of a completion, usually smaller than `max_new_tokens`
+                for short holes (e.g. a single line). A batch stops once all its rows are stopped by the suffix,
+                a budget or the end of sequence token. Defaults to None (no budget).
+            suffix_match_chars (int, optional): The number of suffix characters that must be reproduced to stop. Defaults to 20.
+            encode_chunk_size (int, optional): The number of samples whose prompts are encoded and bucketed together.
+                Larger chunks pad less, smaller ones bound the memory of long runs. Defaults to 4096.
+        """
+        self.model = model
+        self.tokenizer = tokenizer
+        self.max_new_tokens = max_new_tokens
+        self.memory_budget_mb = memory_budget_mb
+        self.max_batch_size = max_batch_size
+        self.bucket_width = bucket_width
+        self.stop_at_suffix = stop_at_suffix
+        self.max_lines = max_lines
+        self.max_tokens = max_tokens
+        self.suffix_match_chars = suffix_match_chars
+        self.encode_chunk_size = encode_chunk_size
+        self.stats = {}
+        self._token_stats = {"new_tokens": 0, "decode_steps": 0, "seconds_saved": 0.0}
+
+        # Left padding keeps the last prompt token of every row aligned with the first generated one
+        self.tokenizer.padding_side = "left"
+        if self.tokenizer.pad_token is None:
+            self.tokenizer.pad_token = self.tokenizer.eos_token
+
+    @staticmethod
+    def build_prompt(prefix: str, suffix: str) -> str:
+        """
+        Builds the FIM prompt asking the model to fill the hole between prefix and suffix.
+
+        Args:
+            prefix (str): The code before the hole.
+            suffix (str): The code after the hole.
+
+        Returns:
+            str: The FIM prompt.
+        """
+        return f"{FIM_BEGIN}{prefix}{FIM_HOLE}{suffix}{FIM_END}"
+
+    @staticmethod
+    def unpack(item) -> tuple:
+        """
+        Returns the prefix, middle and suffix of a dataset item.
+
+        Args:
+            item: A (prefix, middle, suffix) tuple, or a dict with "prefix", "middle" and "suffix" keys.
+
+        Returns:
+            tuple: The prefix, middle and suffix.
+        """
+        if isinstance(item, dict):
+            return item["prefix"], item["middle"], item["suffix"]
+        return item
+
+    @classmethod
+    def encode_item(cls, tokenizer, item) -> list[int]:
+        """
+        Returns the prompt token ids of a dataset item, tokenizing the prompt only if the item does not hold them.
+
+        Args:
+            tokenizer: The tokenizer associated with the model.
+            item: A (prefix, middle, suffix) tuple, or a dict with `input_ids`.
+
+        Returns:
+            list[int]: The token ids of the FIM prompt.
+        """
+        if isinstance(item, dict) and "input_ids" in item:
+            return list(item["input_ids"])
+        prefix, _, suffix = cls.unpack(item)
+        return tokenizer(cls.build_prompt(prefix, suffix))["input_ids"]
+
+    def _encode(self, dataset: Dataset, indices: range) -> dict[int, list[int]]:
+        """
+        Tokenizes the FIM prompt of some samples of the dataset. Items which already hold
+        their prompt `input_ids` are not tokenized again.
+
+        Args:
+            dataset (Dataset): A dataset whose items are (prefix, middle, suffix) tuples or dicts with `input_ids`.
+            indices (range): The dataset indices of the samples.
+
+        Returns:
+            dict[int, list[int]]: The token ids of every prompt, by dataset index.
+        """
+        encoded, prompts = {}, {}
+        for i in indices:
+            item = dataset[i]
+            if isinstance(item, dict) and "input_ids" in item:
+                encoded[i] = list(item["input_ids"])
+            else:
+                prefix, _, suffix = self.unpack(item)
+                prompts[i] = self.build_prompt(prefix, suffix)
+
+        if prompts:
+            for i, ids in zip(prompts, self.tokenizer(list(prompts.values()), add_special_tokens=True)["input_ids"]):
+                encoded[i] = ids
+        return encoded
+
+    def _bucketize(self, encoded: dict[int, list[int]]) -> list[list[int]]:
+        """
+        Groups the sample indices by prompt length.
+
+        Args:
+            encoded (dict[int, list[int]]): The token ids of every prompt, by dataset index.
+
+        Returns:
+            list[list[int]]: The buckets of sample indices, shortest prompts first.
+        """
+        buckets = {}
+        for idx, ids in encoded.items():
+            buckets.setdefault(len(ids) // self.bucket_width, []).append(idx)
+
+        # Sorting inside a bucket as well keeps padding to a minimum
+        return [sorted(buckets[key], key=lambda idx: len(encoded[idx])) for key in sorted(buckets)]
+
+    def auto_batch_size(self, prompt_length: int) -> int:
+        """
+        Estimates the memory needed by one sample and picks the largest batch size fitting in the budget.
+        The estimate accounts for the key/value cache of the whole sequence and for the logits and
+        MLP activations of the prompt, which dominate the prefill step.
+
+        Args:
+            prompt_length (int): The (padded) prompt length of the batch.
+
+        Returns:
+            int: The batch size, between 1 and `max_batch_size`.
+        """
+        config = self.model.config
+        num_layers = getattr(config, "num_hidden_layers", 1)
+        hidden_size = getattr(config, "hidden_size", 1)
+        num_heads = getattr(config, "num_attention_heads", 1)
+        num_kv_heads = getattr(config, "num_key_value_heads", None) or num_heads
+        intermediate_size = getattr(config, "intermediate_size", None) or 4 * hidden_size
+        vocab_size = getattr(config, "vocab_size", 1)
+        element_size = next(self.model.parameters()).element_size()
+
+        total_length = prompt_length + self.max_new_tokens
+        kv_bytes = 2 * num_layers * num_kv_heads * (hidden_size // num_heads) * element_size * total_length
+        # Logits are always materialized in float32
+        prefill_bytes = prompt_length * (vocab_size * 4 + intermediate_size * element_size)
+
+        batch_size = (self.memory_budget_mb * 1024 ** 2) // (kv_bytes + prefill_bytes)
+        return int(max(1, min(batch_size, self.max_batch_size)))
+
+    @torch.no_grad()
+    def generate_batches(self, dataset: Dataset, with_ids: bool = False):
+        """
+        Generates the middles of the dataset batch by batch.
+
+        Args:
+            dataset (Dataset): A dataset whose items are (prefix, middle, suffix) tuples or dicts with `input_ids`.
+            with_ids (bool, optional): Whether the token ids of the generated middles are yielded too. Defaults to False.
+
+        Yields:
+            tuple[list[int], list[str]]: The dataset indices of the batch and their generated middles,
+                followed by their token ids (without special tokens) if `with_ids` is set.
+        """
+        # Prompts are encoded one chunk at a time, so memory does not grow with the size of the dataset
+        for chunk_start in range(0, len(dataset), self.encode_chunk_size):
+            chunk = range(chunk_start, min(chunk_start + self.encode_chunk_size, len(dataset)))
+            with stage("encode", items=len(chunk)):
+                encoded = self._encode(dataset, chunk)
+
+            for bucket in self._bucketize(encoded):
+                start = 0
+                while start < len(bucket):
+                    # The bucket is sorted, so the last sample of the batch is the longest one
+                    batch_size = self.auto_batch_size(len(encoded[bucket[min(start + self.max_batch_size, len(bucket)) - 1]]))
+                    indices = bucket[start:start + batch_size]
+                    start += batch_size
+
+                    inputs = self.tokenizer.pad({"input_ids": [encoded[idx] for idx in indices]},
+                                                return_tensors="pt").to(self.model.device)
+                    prompt_length = inputs["input_ids"].shape[1]
+
+                    stopping = None
+                    if self.stop_at_suffix or self.max_lines is not None or self.max_tokens is not None:
+                        # Without suffix matching the rows are only stopped by their budgets
+                        suffixes = [self.unpack(dataset[idx])[2] if self.stop_at_suffix else "" for idx in indices]
+                        stopping = SuffixStoppingCriteria(self.tokenizer, suffixes, prompt_length,
+                                                          match_chars=self.suffix_match_chars, max_lines=self.max_lines,
+                                                          max_tokens=self.max_tokens)
+
+                    with stage("generate", items=len(indices), prompt_tokens=prompt_length) as event:
+                        start_time = time.perf_counter()
+                        outputs = self.model.generate(**inputs, max_new_tokens=self.max_new_tokens,
+                                                      pad_token_id=self.tokenizer.pad_token_id,
+                                                      stopping_criteria=StoppingCriteriaList([stopping]) if stopping else None)
+                        generate_seconds = time.perf_counter() - start_time
+                        row_tokens = self._row_tokens(outputs[:, prompt_length:], stopping)
+                        event["new_tokens"] = sum(row_tokens)
+
+                    num_steps = outputs.shape[1] - prompt_length
+                    self._token_stats["decode_steps"] += num_steps
+                    self._token_stats["new_tokens"] += sum(row_tokens)
+                    if num_steps:
+                        # The steps left to max_new_tokens would have cost about as much as the ones taken
+                        self._token_stats["seconds_saved"] += generate_seconds / num_steps * (self.max_new_tokens - num_steps)
+
+                    # Only the new tokens are decoded, the (padded) prompt and the tokens past the budget are dropped
+                    generated = outputs[:, prompt_length:prompt_length + self.max_tokens] if self.max_tokens else outputs[:, prompt_length:]
+                    with stage("decode", items=len(indices)):
+                        texts = self.tokenizer.batch_decode(generated, skip_special_tokens=True)
+                    if stopping is not None:
+                        trimmed = [SuffixStoppingCriteria.trim(text, suffix, self.suffix_match_chars, max_lines=self.max_lines)
+                                   for text, suffix in zip(texts, suffixes)]
+                    else:
+                        trimmed = texts
+
+                    if not with_ids:
+                        yield indices, trimmed
+                        continue
+                    special_ids = set(self.tokenizer.all_special_ids)
+                    token_ids = []
+                    for row, text, trimmed_text in zip(generated.tolist(), texts, trimmed):
+                        # Only a completion cut by the suffix stopping has to be tokenized again
+                        if trimmed_text != text:
+                            token_ids.append(self.tokenizer(trimmed_text, add_special_tokens=False)["input_ids"])
+                        else:
+                            token_ids.append([token for token in row if token not in special_ids])
+                    yield indices, trimmed, token_ids
+
+    def _row_tokens(self, generated: torch.Tensor, stopping: SuffixStoppingCriteria) -> list[int]:
+        """
+        Counts the tokens each row of a batch generated before it was done: up to its end of sequence token
+        (included) or up to its stopping step, whichever comes first. The padding generated while a row
+        waits for the rest of the batch is not counted.
+
+        Args:
+            generated (torch.Tensor): The generated tokens of the batch, without the prompts.
+            stopping (SuffixStoppingCriteria): The stopping criteria of the batch, or None.
+
+        Returns:
+            list[int]: The number of tokens of each row.
+        """
+        num_steps = generated.shape[1]
+        is_end = generated == self.tokenizer.eos_token_id
+        # argmax returns the first end of sequence token of each row, rows without one run to the end
+        ends = torch.where(is_end.any(dim=1), is_end.int().argmax(dim=1) + 1, num_steps).tolist()
+        if stopping is None:
+            return ends
+        return [min(end, step or num_steps) for end, step in zip(ends, stopping.stop_steps)]
+
+    def generate(self, dataset: Dataset) -> list[str]:
+        """
+        Generates the middles of all the samples in the dataset and reports the throughput.
+
+        Args:
+            dataset (Dataset): A dataset whose items are (prefix, middle, suffix) tuples.
+
+        Returns:
+            list[str]: The generated middles, in dataset order.
+        """
+        results = [None] * len(dataset)
+        num_batches = 0
+        self._token_stats = {"new_tokens": 0, "decode_steps": 0, "seconds_saved": 0.0}
+
+        start_time = time.perf_counter()
+        for indices, outputs in self.generate_batches(dataset):
+            for idx, output in zip(indices, outputs):
+                results[idx] = output
+            num_batches += 1
+        elapsed = time.perf_counter() - start_time
+
+        self.stats = {
+            "samples": len(results),
+            "batches": num_batches,
+            "seconds": elapsed,
+            "samples_per_sec": len(results) / elapsed if elapsed > 0 else 0.0,
+            # Tokens each sample generated before it was stopped (rows of a batch wait for the slowest one)
+            "mean_new_tokens": self._token_stats["new_tokens"] / len(results) if results else 0.0,
+            # Decoding steps avoided with respect to always running up to max_new_tokens
+            "decode_steps_saved": 1 - self._token_stats["decode_steps"] / (num_batches * self.max_new_tokens) if num_batches else 0.0,
+            # Wall-clock time those steps would have taken, from the measured time per step of each batch
+            "seconds_saved": self._token_stats["seconds_saved"],
+        }
+        print(f"Generated {len(results)} samples in {num_batches} batches "
+              f"({self.stats['samples_per_sec']:.2f} samples/sec, {self.stats['mean_new_tokens']:.1f} new tokens/sample, "
+              f"{self.stats['seconds_saved']:.2f}s saved by early stopping)")
+        return results
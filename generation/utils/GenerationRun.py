@@ -0,0 +1,173 @@
+"""
+Description: This module contains the GenerationRun class, which streams the generated samples of a run to an
+    append-only JSONL file so that long runs can be resumed where they stopped.
+"""
+from torch.utils.data import Dataset, Subset
+from .FIMGenerator import FIMGenerator
+import hashlib
+import json
+import time
+import os
+
+def sample_id(prefix: str, middle: str, suffix: str) -> str:
+    """
+    Computes the stable id of a sample from its content.
+
+    Args:
+        prefix (str): The prefix of the sample.
+        middle (str): The middle of the sample.
+        suffix (str): The suffix of the sample.
+
+    Returns:
+        str: The hex SHA-1 of the sample.
+    """
+    # Hashing the JSON list keeps the boundaries between the three parts unambiguous
+    return hashlib.sha1(json.dumps([prefix, middle, suffix]).encode("utf-8")).hexdigest()
+
+class GenerationRun:
+    """
+    GenerationRun writes one JSON line per completed sample to an append-only file, with the same fields as
+    `evaluation/model_outputs.json` plus the sample id (and, for pre-tokenized datasets, the token ids of the
+    generated and correct middles, used by the metrics instead of tokenizing again). Lines are flushed and fsynced every `fsync_every`
+    samples, so a crash loses at most the last few samples. When the run is restarted, the ids already
+    present in the file are skipped, and only the missing samples are generated.
+    Attributes:
+        path (str): The path of the JSONL file.
+        fsync_every (int): The number of samples written between two fsyncs.
+        stats (dict): Statistics of the last `run` call.
+    Methods:
+        run(generator: FIMGenerator, dataset: Dataset) -> dict:
+            Generates the samples of the dataset that are not in the file yet.
+        iter_records(path: str):
+            Reads back the records of a run.
+        export_json(json_path: str) -> None:
+            Writes the records as a JSON list, the format expected by the evaluation tools.
+    """
+
+    def __init__(self, path: str, fsync_every: int = 32) -> None:
+        """
+        Initializes the GenerationRun instance.
+
+        Args:
+            path (str): The path of the JSONL file. It is created if it does not exist.
+            fsync_every (int, optional): The number of samples written between two fsyncs. Defaults to 32.
+        """
+        self.path = path
+        self.fsync_every = fsync_every
+        self.stats = {}
+
+    def _load_done_ids(self) -> set[str]:
+        """
+        Reads the ids of the samples already in the file. A last line left incomplete by a crash (without
+        its final newline) is truncated away, so that the next record starts on a fresh line. Corrupt lines
+        elsewhere are reported and skipped, their samples are generated again.
+
+        Returns:
+            set[str]: The ids of the completed samples.
+        """
+        done_ids = set()
+        if not os.path.exists(self.path):
+            return done_ids
+
+        valid_size, num_lines = 0, 0
+        with open(self.path, "rb") as f:
+            for line in f:
+                if not line.endswith(b"\n"):
+                    break
+                valid_size += len(line)
+                num_lines += 1
+                try:
+                    done_ids.add(json.loads(line)["id"])
+                except (ValueError, KeyError):
+                    print(f"Skipping corrupt record on line {num_lines} of {self.path}")
+
+        if valid_size < os.path.getsize(self.path):
+            print(f"Truncating incomplete record at byte {valid_size} of {self.path}")
+            os.truncate(self.path, valid_size)
+        return done_ids
+
+    def run(self, generator: FIMGenerator, dataset: Dataset) -> dict:
+        """
+        Generates the samples of the dataset whose id is not in the file yet and appends them to it.
+
+        Args:
+            generator (FIMGenerator): The generator used to fill the middles.
+            dataset (Dataset): A dataset whose items are (prefix, middle, suffix) tuples or dicts (see TokenizedCodeDataset).
+
+        Returns:
+            dict: The number of skipped and generated samples and the throughput of the run.
+        """
+        done_ids = self._load_done_ids()
+        pending = [idx for idx in range(len(dataset)) if sample_id(*FIMGenerator.unpack(dataset[idx])) not in done_ids]
+        print(f"Skipping {len(dataset) - len(pending)} completed samples, {len(pending)} left")
+        with_ids = bool(pending) and isinstance(dataset[pending[0]], dict) and "middle_ids" in dataset[pending[0]]
+
+        num_written = 0
+        start_time = time.perf_counter()
+        with open(self.path, "a", encoding="utf-8") as f:
+            for indices, outputs, *token_ids in generator.generate_batches(Subset(dataset, pending), with_ids=with_ids):
+                for i, (idx, output) in enumerate(zip(indices, outputs)):
+                    item = dataset[pending[idx]]
+                    prefix, middle, suffix = FIMGenerator.unpack(item)
+                    record = {
+                        "id": sample_id(prefix, middle, suffix),
+                        "prefix": prefix,
+                        "generated": output,
+                        "correct_middle": middle,
+                        "suffix": suffix
+                    }
+                    if with_ids:
+                        record["generated_ids"] = token_ids[0][i]
+                        record["correct_middle_ids"] = list(item["middle_ids"])
+                    f.write(json.dumps(record) + "\n")
+                    num_written += 1
+
+                    if num_written % self.fsync_every == 0:
+                        f.flush()
+                        os.fsync(f.fileno())
+            f.flush()
+            os.fsync(f.fileno())
+        elapsed = time.perf_counter() - start_time
+
+        self.stats = {
+            "skipped": len(dataset) - len(pending),
+            "generated": num_written,
+            "seconds": elapsed,
+            "samples_per_sec": num_written / elapsed if elapsed > 0 else 0.0,
+        }
+        return self.stats
+
+    @staticmethod
+    def iter_records(path: str):
+        """
+        Reads back the records of a run, one at a time.
+
+        Args:
+            path (str): The path of the JSONL file.
+
+        Yields:
+            dict: The record of each completed sample.
+        """
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                if not line.endswith("\n"):
+                    continue
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    # Corrupt lines are reported (and regenerated) by GenerationRun.run
+                    continue
+
+    def export_json(self, json_path: str) -> None:
+        """
+        Writes the records of the run as a JSON list, streaming them one at a time.
+
+        Args:
+            json_path (str): The path of the JSON file.
+        """
+        with open(json_path, "w", encoding="utf-8") as f:
+            f.write("[")
+            for i, record in enumerate(self.iter_records(self.path)):
+                f.write(",\n" if i else "\n")
+                f.write(json.dumps(record, indent=4))
+            f.write("\n]\n")
@@ -0,0 +1,225 @@
+"""
+Description: This module contains the MappedCorpus and MappedCodeDataset classes, an on-disk corpus format
+    storing all the extracted files in a single memory-mapped buffer and the code completion examples
+    as compact span records over it.
+"""
+from torch.utils.data import Dataset
+from .CodeDataset import sample_span
+from typing import Iterable
+import numpy as np
+import random
+import json
+import os
+
+class MappedCorpus:
+    """
+    MappedCorpus stores the contents of many files in a single UTF-8 buffer on disk, together with
+    an index of the byte offset where each file starts. The buffer is memory-mapped, so opening a
+    corpus is instant and slicing it only reads the pages that are actually needed.
+    The on-disk layout of a corpus directory is:
+        corpus.bin   - the concatenated UTF-8 encoded files.
+        offsets.npy  - an int64 array of num_files + 1 byte offsets into corpus.bin.
+    Attributes:
+        path (str): The directory holding the corpus.
+        offsets (np.ndarray): The byte offset of each file, followed by the total size.
+        buffer (np.memmap): The memory-mapped corpus buffer.
+    Methods:
+        write(file_contents: Iterable[str], path: str) -> MappedCorpus:
+            Writes the given file contents as a corpus and opens it.
+        get_file(file_id: int) -> str:
+            Retrieves the whole content of a file.
+        get_slice(file_id: int, start: int, end: int) -> str:
+            Retrieves the bytes [start, end) of a file, decoded.
+    """
+    BUFFER_FILE = "corpus.bin"
+    OFFSETS_FILE = "offsets.npy"
+
+    def __init__(self, path: str) -> None:
+        """
+        Opens an existing corpus.
+
+        Args:
+            path (str): The directory holding the corpus.
+        """
+        self.path = path
+        self.offsets = np.load(os.path.join(path, self.OFFSETS_FILE), mmap_mode="r")
+        # np.memmap refuses empty files, an empty corpus simply has an empty buffer
+        if self.offsets[-1] > 0:
+            self.buffer = np.memmap(os.path.join(path, self.BUFFER_FILE), dtype=np.uint8, mode="r")
+        else:
+            self.buffer = np.zeros(0, dtype=np.uint8)
+
+    @classmethod
+    def write(cls, file_contents: Iterable[str], path: str) -> "MappedCorpus":
+        """
+        Streams the file contents to a new corpus, holding a single file in memory at a time.
+
+        Args:
+            file_contents (Iterable[str]): The contents of the files.
+            path (str): The directory where the corpus will be written.
+
+        Returns:
+            MappedCorpus: The newly written corpus.
+        """
+        os.makedirs(path, exist_ok=True)
+        offsets = [0]
+        with open(os.path.join(path, cls.BUFFER_FILE), "wb") as f:
+            for content in file_contents:
+                offsets.append(offsets[-1] + f.write(content.encode("utf-8")))
+        np.save(os.path.join(path, cls.OFFSETS_FILE), np.asarray(offsets, dtype=np.int64))
+        return cls(path)
+
+    def __len__(self) -> int:
+        """
+        Returns the number of files in the corpus.
+
+        Returns:
+            int: The number of files.
+        """
+        return len(self.offsets) - 1
+
+    def get_file(self, file_id: int) -> str:
+        """
+        Retrieves the whole content of a file.
+
+        Args:
+            file_id (int): The index of the file.
+
+        Returns:
+            str: The content of the file.
+        """
+        return self.get_slice(file_id, 0, int(self.offsets[file_id + 1] - self.offsets[file_id]))
+
+    def get_slice(self, file_id: int, start: int, end: int) -> str:
+        """
+        Retrieves a slice of a file. The bounds are byte offsets relative to the start of the file.
+
+        Args:
+            file_id (int): The index of the file.
+            start (int): The first byte of the slice.
+            end (int): The byte after the last one of the slice.
+
+        Returns:
+            str: The decoded slice.
+        """
+        base = int(self.offsets[file_id])
+        return self.buffer[base + start:base + end].tobytes().decode("utf-8")
+
+class MappedCodeDataset(Dataset):
+    """
+    MappedCodeDataset holds code completion examples drawn from a MappedCorpus as compact
+    (file_id, cursor, prefix_len, middle_len, suffix_len) records, stored in `samples.npy` next to
+    the corpus. Spans are drawn in characters exactly like CodeDataset does and stored as byte
+    offsets, so the strings are only materialized, already split on character boundaries, in
+    `__getitem__`.
+    Attributes:
+        corpus (MappedCorpus): The corpus the examples are drawn from.
+        samples (np.ndarray): The span records.
+    Methods:
+        build(file_contents, path, num_samples, min_lengths, max_lengths, seed) -> MappedCodeDataset:
+            Writes a corpus and draws its examples.
+    """
+    SAMPLES_FILE = "samples.npy"
+    META_FILE = "meta.json"
+    SAMPLE_DTYPE = np.dtype([
+        ("file_id", np.uint32),
+        ("cursor", np.uint32),
+        ("prefix_len", np.uint32),
+        ("middle_len", np.uint32),
+        ("suffix_len", np.uint32),
+    ])
+
+    def __init__(self, path: str) -> None:
+        """
+        Opens an existing dataset.
+
+        Args:
+            path (str): The directory holding the corpus and the samples.
+        """
+        self.corpus = MappedCorpus(path)
+        self.samples = np.load(os.path.join(path, self.SAMPLES_FILE), mmap_mode="r")
+
+    @classmethod
+    def build(cls, file_contents: Iterable[str], path: str, num_samples: int = 50, min_lengths: tuple = (20, 10, 20),
+              max_lengths: tuple = (200, 50, 200), seed: int = None) -> "MappedCodeDataset":
+        """
+        Writes the file contents to a corpus and draws the examples from it.
+        As in CodeDataset, each file contributes up to `num_samples` candidate spans, of which
+        `num_samples` are kept uniformly at random (with reservoir sampling over the records).
+
+        Args:
+            file_contents (Iterable[str]): The contents of the code files.
+            path (str): The directory where the dataset will be written.
+            num_samples (int): The number of code completion examples to generate.
+            min_lengths (tuple): A tuple (x, y, z) where x is the min prefix length, y is the min middle length, and z is the min suffix length.
+            max_lengths (tuple): A tuple (x, y, z) where x is the max prefix length, y is the max middle length, and z is the max suffix length.
+            seed (int, optional): The seed used to draw the examples. Defaults to None.
+
+        Returns:
+            MappedCodeDataset: The newly built dataset.
+        """
+        corpus = MappedCorpus.write(file_contents, path)
+        rng = random.Random(seed)
+        min_content_length = sum(min_lengths)
+
+        reservoir = np.zeros(num_samples, dtype=cls.SAMPLE_DTYPE)
+        num_candidates = 0
+
+        for file_id in range(len(corpus)):
+            content = corpus.get_file(file_id)
+            content_length = len(content)
+            if content_length < min_content_length:
+                continue
+
+            # Character to byte offsets, only needed when the file is not plain ASCII
+            byte_offsets = None
+            if corpus.offsets[file_id + 1] - corpus.offsets[file_id] != content_length:
+                char_sizes = [len(char.encode("utf-8")) for char in content]
+                byte_offsets = np.concatenate(([0], np.cumsum(char_sizes)))
+
+            for _ in range(num_samples):
+                span = sample_span(content_length, min_lengths, max_lengths, rng)
+                if span is None:
+                    continue
+
+                # Algorithm R: the n-th candidate replaces a random slot with probability k/n
+                slot = num_candidates if num_candidates < num_samples else rng.randint(0, num_candidates)
+                num_candidates += 1
+                if slot >= num_samples:
+                    continue
+
+                cursor, prefix_len, middle_len, suffix_len = span
+                if byte_offsets is not None:
+                    bounds = byte_offsets[[cursor - prefix_len, cursor, cursor + middle_len, cursor + middle_len + suffix_len]]
+                    cursor = bounds[1]
+                    prefix_len, middle_len, suffix_len = np.diff(bounds)
+                reservoir[slot] = (file_id, cursor, prefix_len, middle_len, suffix_len)
+
+        samples = reservoir[:min(num_candidates, num_samples)]
+        np.save(os.path.join(path, cls.SAMPLES_FILE), np.sort(samples, order=["file_id", "cursor"]))
+        with open(os.path.join(path, cls.META_FILE), "w") as f:
+            json.dump({"num_samples": num_samples, "min_lengths": list(min_lengths),
+                       "max_lengths": list(max_lengths), "seed": seed}, f, indent=4)
+        return cls(path)
+
+    def __len__(self) -> int:
+        """
+        Returns the total number of examples in the dataset.
+        Returns:
+            int: The number of examples in the dataset.
+        """
+        return len(self.samples)
+
+    def __getitem__(self, idx) -> tuple:
+        """
+        Materializes the example at the specified index from the memory-mapped corpus.
+        Args:
+            idx (int): The index of the example to retrieve.
+        Returns:
+            tuple: A tuple containing the prefix, middle, and suffix segments of the example.
+        """
+        file_id, cursor, prefix_len, middle_len, suffix_len = (int(value) for value in self.samples[idx])
+        prefix = self.corpus.get_slice(file_id, cursor - prefix_len, cursor)
+        middle = self.corpus.get_slice(file_id, cursor, cursor + middle_len)
+        suffix = self.corpus.get_slice(file_id, cursor + middle_len, cursor + middle_len + suffix_len)
+        return prefix, middle, suffix
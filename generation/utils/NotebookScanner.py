@@ -0,0 +1,313 @@
+"""
+Description: This module contains the NotebookScanner class, an incremental JSON scanner used to read the
+    code cells of Jupyter notebooks without building their outputs in memory.
+"""
+import json
+import re
+
+_WHITESPACE = re.compile(r"[ \t\n\r]*")
+_BRACKETS = "[]{}"
+_SCALAR = re.compile(r"[^,\]}\s]*")
+
+class NotebookScanner:
+    """
+    NotebookScanner walks a JSON document token by token. The caller decides, key by key, whether a
+    value is decoded (`read_value`) or skipped (`skip_value`). Skipped values are only scanned for
+    their closing quote or bracket, so no Python object is ever created for them.
+    Attributes:
+        FULL_PARSE_MAX_CHARS (int): The size up to which `iter_code_cells` decodes the whole notebook with
+            `json.loads`, faster than scanning it in Python. Larger notebooks are scanned, so that their
+            outputs are never built in memory.
+        text (str): The JSON document.
+        pos (int): The current position in the document.
+    Methods:
+        iter_object():
+            Yields the keys of the object at the current position.
+        iter_array():
+            Yields once per element of the array at the current position.
+        read_value():
+            Decodes the value at the current position.
+        skip_value() -> None:
+            Skips the value at the current position.
+        iter_code_cells(text: str):
+            Yields the source of every code cell of a notebook.
+    """
+    FULL_PARSE_MAX_CHARS = 4 * 1024 ** 2
+
+    def __init__(self, text: str) -> None:
+        """
+        Initializes the scanner at the beginning of the document.
+
+        Args:
+            text (str): The JSON document.
+        """
+        self.text = text
+        self.pos = 0
+        self._decoder = json.JSONDecoder()
+
+    def _skip_whitespace(self) -> None:
+        """
+        Moves the position past any whitespace.
+        """
+        self.pos = _WHITESPACE.match(self.text, self.pos).end()
+
+    def _next_char(self) -> str:
+        """
+        Consumes the next non-whitespace character.
+
+        Returns:
+            str: The character.
+
+        Raises:
+            ValueError: If the end of the document is reached.
+        """
+        self._skip_whitespace()
+        if self.pos >= len(self.text):
+            raise ValueError("Unexpected end of JSON document")
+        char = self.text[self.pos]
+        self.pos += 1
+        return char
+
+    def _expect(self, expected: str) -> None:
+        """
+        Consumes the next non-whitespace character, which must be the expected one.
+
+        Args:
+            expected (str): The expected character.
+
+        Raises:
+            ValueError: If another character is found.
+        """
+        char = self._next_char()
+        if char != expected:
+            raise ValueError(f"Expected '{expected}' at position {self.pos - 1}, found '{char}'")
+
+    def _string_end(self, start: int) -> int:
+        """
+        Finds the end of the string starting at the given position. Quotes are searched with
+        `str.find`, which skips long strings (e.g. base64 images) much faster than a regular expression.
+
+        Args:
+            start (int): The position of the opening quote.
+
+        Returns:
+            int: The position right after the closing quote.
+
+        Raises:
+            ValueError: If the string is not terminated.
+        """
+        end = start + 1
+        while True:
+            end = self.text.find('"', end)
+            if end == -1:
+                raise ValueError(f"Unterminated string at position {start}")
+
+            # A quote preceded by an odd number of backslashes is escaped
+            backslash = end - 1
+            while self.text[backslash] == "\\":
+                backslash -= 1
+            if (end - 1 - backslash) % 2 == 0:
+                return end + 1
+            end += 1
+
+    def _iter_container(self, opening: str, closing: str, has_keys: bool):
+        """
+        Walks the object or array at the current position. The value of each key (or each element)
+        must be consumed by the caller before the next iteration.
+
+        Args:
+            opening (str): The opening character of the container.
+            closing (str): The closing character of the container.
+            has_keys (bool): Whether the container is an object.
+
+        Yields:
+            str: The key of each value, or None for array elements.
+        """
+        self._expect(opening)
+        self._skip_whitespace()
+        if self.text.startswith(closing, self.pos):
+            self.pos += 1
+            return
+
+        while True:
+            key = None
+            if has_keys:
+                key = self.read_value()
+                self._expect(":")
+            self._skip_whitespace()
+            yield key
+
+            char = self._next_char()
+            if char == closing:
+                return
+            if char != ",":
+                raise ValueError(f"Expected ',' or '{closing}' at position {self.pos - 1}, found '{char}'")
+
+    def iter_object(self):
+        """
+        Walks the object at the current position.
+
+        Yields:
+            str: The key of each value, which must be read or skipped before the next iteration.
+        """
+        yield from self._iter_container("{", "}", True)
+
+    def iter_array(self):
+        """
+        Walks the array at the current position.
+
+        Yields:
+            None: Once per element, which must be read or skipped before the next iteration.
+        """
+        yield from self._iter_container("[", "]", False)
+
+    def read_value(self):
+        """
+        Decodes the value at the current position.
+
+        Returns:
+            The decoded JSON value.
+        """
+        self._skip_whitespace()
+        value, self.pos = self._decoder.raw_decode(self.text, self.pos)
+        return value
+
+    def _skip_container(self) -> None:
+        """
+        Skips the object or array at the current position. The scan jumps from bracket to bracket with `str.find`,
+        and a bracket is known to be outside of any string from the parity of the quotes before it, so the long
+        outputs of a notebook (arrays of thousands of lines, base64 images) cost a few passes in C rather than one
+        Python iteration per string.
+
+        Raises:
+            ValueError: If the container is truncated.
+        """
+        text, pos, depth = self.text, self.pos, 0
+        # The next position of every bracket character, only searched again once passed
+        next_brackets = [-1] * len(_BRACKETS)
+        while True:
+            for i, bracket in enumerate(_BRACKETS):
+                if next_brackets[i] < pos:
+                    found = text.find(bracket, pos)
+                    next_brackets[i] = len(text) if found == -1 else found
+            bracket_pos = min(next_brackets)
+            if bracket_pos == len(text):
+                raise ValueError("Unexpected end of JSON document")
+
+            # The position is always outside of a string here, so the bracket is inside one
+            # if an odd number of unescaped quotes comes before it
+            string_start = self._last_string_start(pos, bracket_pos)
+            if string_start is not None:
+                pos = self._string_end(string_start)
+                continue
+
+            depth += 1 if text[bracket_pos] in "[{" else -1
+            pos = bracket_pos + 1
+            if depth == 0:
+                self.pos = pos
+                return
+
+    def _last_string_start(self, start: int, end: int) -> int:
+        """
+        Finds the string left open at a position, given a starting position outside of any string.
+
+        Args:
+            start (int): A position outside of any string.
+            end (int): The position to check.
+
+        Returns:
+            int: The position of the opening quote of the string containing `end`, or None if `end` is outside.
+        """
+        text = self.text
+        # The first strings are walked one by one, which is cheaper when there are few (e.g. a base64 image)
+        quote = text.find('"', start, end)
+        for _ in range(16):
+            if quote == -1:
+                return None
+            string_end = self._string_end(quote)
+            if string_end > end:
+                return quote
+            start = string_end
+            quote = text.find('"', start, end)
+
+        if quote != -1 and text.find("\\\\", start, end) == -1:
+            # Many strings (e.g. the lines of a text output) are counted instead. Without escaped backslashes,
+            # a quote is escaped exactly when a backslash precedes it
+            if (text.count('"', start, end) - text.count('\\"', start, end)) % 2 == 0:
+                return None
+            quote = text.rfind('"', start, end)
+            while text[quote - 1] == "\\":
+                quote = text.rfind('"', start, quote)
+            return quote
+
+        while quote != -1:
+            string_end = self._string_end(quote)
+            if string_end > end:
+                return quote
+            quote = text.find('"', string_end, end)
+        return None
+
+    def skip_value(self) -> None:
+        """
+        Skips the value at the current position without decoding it.
+
+        Raises:
+            ValueError: If the value is malformed or truncated.
+        """
+        self._skip_whitespace()
+        char = self.text[self.pos:self.pos + 1]
+
+        if char == '"':
+            self.pos = self._string_end(self.pos)
+        elif char in ("[", "{"):
+            self._skip_container()
+        else:
+            self.pos = _SCALAR.match(self.text, self.pos).end()
+
+    @classmethod
+    def iter_code_cells(cls, text: str):
+        """
+        Yields the source of every code cell of a notebook, reading only the `cell_type` and `source`
+        fields of the cells. The source is rebuilt exactly, since its lines already end with a newline.
+        Notebooks up to FULL_PARSE_MAX_CHARS are simply decoded with `json.loads`.
+
+        Args:
+            text (str): The JSON content of the notebook.
+
+        Yields:
+            str: The source code of each code cell.
+
+        Raises:
+            KeyError: If the notebook has no cells.
+        """
+        if len(text) <= cls.FULL_PARSE_MAX_CHARS:
+            for cell in json.loads(text)["cells"]:
+                source = cell.get("source")
+                if cell.get("cell_type") == "code" and source is not None:
+                    yield source if isinstance(source, str) else "".join(source)
+            return
+
+        scanner = cls(text)
+        found_cells = False
+
+        for key in scanner.iter_object():
+            if key != "cells":
+                scanner.skip_value()
+                continue
+
+            found_cells = True
+            for _ in scanner.iter_array():
+                cell_type, source = None, None
+                for cell_key in scanner.iter_object():
+                    if cell_key == "cell_type":
+                        cell_type = scanner.read_value()
+                    elif cell_key == "source":
+                        source = scanner.read_value()
+                    else:
+                        scanner.skip_value()
+
+                if cell_type == "code" and source is not None:
+                    yield source if isinstance(source, str) else "".join(source)
+
+        if not found_cells:
+            raise KeyError("cells")
@@ -0,0 +1,271 @@
+"""
+Description: This module contains the PrefixCache class, which keeps the past key/values of common prompt
+    prefixes in a token trie, so that FIM prompts sharing a prefix skip its prefill.
+"""
+from collections import OrderedDict
+from torch.utils.data import Dataset
+from transformers import DynamicCache
+from .FIMGenerator import FIMGenerator
+import torch
+import copy
+import time
+
+class _TrieNode:
+    """
+    A node of the prefix trie. Each edge is a block of tokens, so the depth of a node (in tokens) is always
+    a multiple of the block size. A node may hold the key/value cache of the prompt prefix ending at it.
+    """
+    __slots__ = ("parent", "block", "children", "depth", "entry")
+
+    def __init__(self, parent=None, block: tuple = (), depth: int = 0) -> None:
+        self.parent = parent
+        self.block = block
+        self.children = {}
+        self.depth = depth
+        self.entry = None
+
+class PrefixCache:
+    """
+    PrefixCache generates one sample at a time, reusing the past key/values of the longest prompt prefix it
+    has already seen. Prompts are split into blocks of `block_size` tokens and walked down a trie; when a
+    prompt shares some blocks with a cached one, the cached keys/values are copied, cropped to the shared
+    length and only the remaining tokens are prefilled. The cache of each new prompt is stored at its last
+    full block. Entries are evicted in least recently used order once they exceed `memory_cap_mb`.
+    Attributes:
+        model: The causal language model used for generation.
+        tokenizer: The tokenizer associated with the model.
+        max_new_tokens (int): The maximum number of tokens generated for each sample.
+        memory_cap_mb (float): The memory (in MB) the cached key/values are allowed to use.
+        block_size (int): The number of tokens of each trie edge.
+        stats (dict): Hit rate and prefill time saved since the cache was created.
+    Methods:
+        generate_ids(input_ids: list[int]) -> list[int]:
+            Greedily generates the tokens following a prompt.
+        complete(prefix: str, suffix: str) -> str:
+            Generates the middle between a prefix and a suffix.
+        generate(dataset: Dataset) -> list[str]:
+            Generates the middles of all the samples in the dataset.
+        clear() -> None:
+            Drops every cached entry.
+    """
+
+    def __init__(self, model, tokenizer, max_new_tokens: int = 200, memory_cap_mb: float = 1024,
+                 block_size: int = 16) -> None:
+        """
+        Initializes the PrefixCache instance.
+
+        Args:
+            model: The causal language model used for generation.
+            tokenizer: The tokenizer associated with the model.
+            max_new_tokens (int, optional): The maximum number of new tokens per sample. Defaults to 200.
+            memory_cap_mb (float, optional): The memory cap (in MB) of the cached key/values. Defaults to 1024.
+            block_size (int, optional): The granularity (in tokens) of the cached prefixes. Defaults to 16.
+        """
+        self.model = model
+        self.tokenizer = tokenizer
+        self.max_new_tokens = max_new_tokens
+        self.memory_cap_bytes = int(memory_cap_mb * 1024 ** 2)
+        self.block_size = block_size
+        self.clear()
+
+    def clear(self) -> None:
+        """
+        Drops every cached entry and resets the statistics.
+        """
+        self._root = _TrieNode()
+        # Maps the nodes holding an entry to its size in bytes, least recently used first
+        self._lru = OrderedDict()
+        self._cached_bytes = 0
+        self._counters = {"hits": 0, "misses": 0, "tokens_reused": 0, "tokens_prefilled": 0, "prefill_seconds": 0.0}
+
+    @property
+    def stats(self) -> dict:
+        """
+        The statistics of the cache. The prefill time saved is estimated from the measured prefill time per token.
+        """
+        counters = self._counters
+        lookups = counters["hits"] + counters["misses"]
+        seconds_per_token = counters["prefill_seconds"] / counters["tokens_prefilled"] if counters["tokens_prefilled"] else 0.0
+        return {
+            "hits": counters["hits"],
+            "misses": counters["misses"],
+            "hit_rate": counters["hits"] / lookups if lookups else 0.0,
+            "tokens_reused": counters["tokens_reused"],
+            "prefill_seconds": counters["prefill_seconds"],
+            "prefill_seconds_saved": counters["tokens_reused"] * seconds_per_token,
+            "entries": len(self._lru),
+            "cached_mb": self._cached_bytes / 1024 ** 2,
+        }
+
+    def _blocks(self, input_ids: list[int]):
+        """
+        Splits the cacheable part of a prompt into full blocks. The last prompt token is never cached,
+        since its logits are needed to generate the first new token.
+
+        Args:
+            input_ids (list[int]): The token ids of the prompt.
+
+        Yields:
+            tuple[int]: The token ids of each full block.
+        """
+        for start in range(0, (len(input_ids) - 1) // self.block_size * self.block_size, self.block_size):
+            yield tuple(input_ids[start:start + self.block_size])
+
+    def _lookup(self, input_ids: list[int]):
+        """
+        Finds the longest cached prefix of a prompt.
+
+        Args:
+            input_ids (list[int]): The token ids of the prompt.
+
+        Returns:
+            tuple[int, DynamicCache]: The length of the prefix and a private copy of its key/values,
+                or (0, None) if no prefix is cached.
+        """
+        node = self._root
+        for block in self._blocks(input_ids):
+            if block not in node.children:
+                break
+            node = node.children[block]
+
+        # Any entry below the deepest shared node covers the shared prefix
+        while node is not self._root:
+            holder = self._find_entry(node)
+            if holder is not None:
+                self._lru.move_to_end(holder)
+                cache = copy.deepcopy(holder.entry)
+                cache.crop(node.depth)
+                return node.depth, cache
+            node = node.parent
+        return 0, None
+
+    @staticmethod
+    def _find_entry(node: _TrieNode):
+        """
+        Finds a node holding an entry in the subtree of a node.
+
+        Args:
+            node (_TrieNode): The root of the subtree.
+
+        Returns:
+            _TrieNode: The shallowest node holding an entry, or None.
+        """
+        frontier = [node]
+        while frontier:
+            current = frontier.pop(0)
+            if current.entry is not None:
+                return current
+            frontier.extend(current.children.values())
+        return None
+
+    def _store(self, input_ids: list[int], cache: DynamicCache) -> None:
+        """
+        Stores the key/values of a block-aligned prompt prefix and evicts the least recently used
+        entries beyond the memory cap.
+
+        Args:
+            input_ids (list[int]): The token ids of the prefix.
+            cache (DynamicCache): Its key/values. The cache is copied.
+        """
+        node = self._root
+        for start in range(0, len(input_ids), self.block_size):
+            block = tuple(input_ids[start:start + self.block_size])
+            if block not in node.children:
+                node.children[block] = _TrieNode(node, block, node.depth + len(block))
+            node = node.children[block]
+        if node.entry is not None:
+            self._lru.move_to_end(node)
+            return
+
+        node.entry = copy.deepcopy(cache)
+        size = sum(tensor.numel() * tensor.element_size() for tensor in node.entry.key_cache + node.entry.value_cache)
+        self._lru[node] = size
+        self._cached_bytes += size
+
+        while self._cached_bytes > self.memory_cap_bytes and self._lru:
+            evicted, size = self._lru.popitem(last=False)
+            evicted.entry = None
+            self._cached_bytes -= size
+            # Prune the branches left without entries
+            while evicted is not self._root and evicted.entry is None and not evicted.children:
+                del evicted.parent.children[evicted.block]
+                evicted = evicted.parent
+
+    def _prefill(self, input_ids: list[int], cache: DynamicCache) -> None:
+        """
+        Runs the model over some prompt tokens, appending their key/values to the cache.
+
+        Args:
+            input_ids (list[int]): The token ids to prefill.
+            cache (DynamicCache): The key/value cache, extended in place.
+        """
+        start_time = time.perf_counter()
+        self.model(torch.tensor([input_ids], device=self.model.device), past_key_values=cache, use_cache=True)
+        self._counters["prefill_seconds"] += time.perf_counter() - start_time
+        self._counters["tokens_prefilled"] += len(input_ids)
+
+    @torch.no_grad()
+    def generate_ids(self, input_ids: list[int]) -> list[int]:
+        """
+        Greedily generates the tokens following a prompt, skipping the prefill of its longest cached prefix.
+
+        Args:
+            input_ids (list[int]): The token ids of the prompt.
+
+        Returns:
+            list[int]: The generated token ids.
+        """
+        cached_length, cache = self._lookup(input_ids)
+        if cache is None:
+            self._counters["misses"] += 1
+            cache = DynamicCache()
+        else:
+            self._counters["hits"] += 1
+            self._counters["tokens_reused"] += cached_length
+
+        # Prefill up to the last full block and store it for the next prompts
+        block_length = (len(input_ids) - 1) // self.block_size * self.block_size
+        if block_length > cached_length:
+            self._prefill(input_ids[cached_length:block_length], cache)
+            self._store(input_ids[:block_length], cache)
+
+        # generate only runs the tokens which are not in the cache yet
+        inputs = torch.tensor([input_ids], device=self.model.device)
+        outputs = self.model.generate(inputs, attention_mask=torch.ones_like(inputs), past_key_values=cache,
+                                      max_new_tokens=self.max_new_tokens, do_sample=False,
+                                      pad_token_id=self.tokenizer.pad_token_id or self.tokenizer.eos_token_id)
+        return outputs[0, len(input_ids):].tolist()
+
+    def complete(self, prefix: str, suffix: str) -> str:
+        """
+        Generates the middle between a prefix and a suffix.
+
+        Args:
+            prefix (str): The code before the hole.
+            suffix (str): The code after the hole.
+
+        Returns:
+            str: The generated middle.
+        """
+        input_ids = self.tokenizer(FIMGenerator.build_prompt(prefix, suffix))["input_ids"]
+        return self.tokenizer.decode(self.generate_ids(input_ids), skip_special_tokens=True)
+
+    def generate(self, dataset: Dataset) -> list[str]:
+        """
+        Generates the middles of all the samples in the dataset and reports the hit rate of the cache.
+
+        Args:
+            dataset (Dataset): A dataset whose items are (prefix, middle, suffix) tuples or dicts with `input_ids`.
+
+        Returns:
+            list[str]: The generated middles, in dataset order.
+        """
+        results = []
+        for i in range(len(dataset)):
+            input_ids = FIMGenerator.encode_item(self.tokenizer, dataset[i])
+            results.append(self.tokenizer.decode(self.generate_ids(input_ids), skip_special_tokens=True))
+
+        stats = self.stats
+        print(f"Generated {len(results)} samples (hit rate {stats['hit_rate']:.2%}, {stats['tokens_reused']} prompt tokens "
+              f"reused, ~{stats['prefill_seconds_saved']:.2f}s of prefill saved)")
+        return results
@@ -0,0 +1,228 @@
+"""
+Description: This module contains the PromptLookupDecoder class, which speeds up greedy FIM completion with
+    speculative decoding, drafting the next tokens by n-gram lookup in the prompt instead of with a second model.
+"""
+from torch.utils.data import Dataset
+from transformers import DynamicCache
+from .FIMGenerator import FIMGenerator
+import torch
+import time
+
+class PromptLookupDecoder:
+    """
+    PromptLookupDecoder generates one sample at a time with prompt-lookup speculative decoding.
+    FIM middles often copy identifiers and whole lines from the prefix or the suffix, so at every step the last
+    few generated tokens are looked up in the prompt (and in what was generated so far), and the tokens that
+    followed their most recent occurrence are proposed as a draft. The model verifies the whole draft in a
+    single forward pass: the longest prefix of the draft matching its own greedy predictions is accepted,
+    followed by the model's prediction at the first mismatch. The output is therefore the greedy output of
+    `model.generate`, up to floating point differences between single and multi token forward passes.
+    Attributes:
+        model: The causal language model used for generation.
+        tokenizer: The tokenizer associated with the model.
+        max_new_tokens (int): The maximum number of tokens generated for each sample.
+        num_draft_tokens (int): The maximum number of drafted tokens per step.
+        max_ngram_size (int): The longest n-gram looked up in the context.
+        stats (dict): Statistics (acceptance rate, throughput) of the last `generate` call.
+    Methods:
+        generate_ids(input_ids: list[int]) -> list[int]:
+            Greedily generates the tokens following a prompt.
+        complete(prefix: str, suffix: str) -> str:
+            Generates the middle between a prefix and a suffix.
+        generate(dataset: Dataset) -> list[str]:
+            Generates the middles of all the samples in the dataset.
+        benchmark(dataset: Dataset) -> dict:
+            Compares speed and outputs with plain greedy `model.generate`.
+    """
+
+    def __init__(self, model, tokenizer, max_new_tokens: int = 200, num_draft_tokens: int = 10,
+                 max_ngram_size: int = 3) -> None:
+        """
+        Initializes the PromptLookupDecoder instance.
+
+        Args:
+            model: The causal language model used for generation.
+            tokenizer: The tokenizer associated with the model.
+            max_new_tokens (int, optional): The maximum number of new tokens per sample. Defaults to 200.
+            num_draft_tokens (int, optional): The maximum number of drafted tokens per step. Defaults to 10.
+            max_ngram_size (int, optional): The longest n-gram looked up in the context. Defaults to 3.
+        """
+        self.model = model
+        self.tokenizer = tokenizer
+        self.max_new_tokens = max_new_tokens
+        self.num_draft_tokens = num_draft_tokens
+        self.max_ngram_size = max_ngram_size
+        self.stats = {}
+        self._counters = {"drafted": 0, "accepted": 0, "new_tokens": 0, "forward_passes": 0}
+
+    def _find_draft(self, tokens: list[int], max_tokens: int) -> list[int]:
+        """
+        Looks up the last n tokens in the context, from the longest n-gram to single tokens, and
+        returns the tokens that followed their most recent earlier occurrence.
+
+        Args:
+            tokens (list[int]): The prompt followed by the tokens generated so far.
+            max_tokens (int): The maximum length of the draft.
+
+        Returns:
+            list[int]: The drafted tokens, empty if no n-gram was found.
+        """
+        if max_tokens <= 0:
+            return []
+
+        for ngram_size in range(min(self.max_ngram_size, len(tokens) - 1), 0, -1):
+            ngram = tokens[-ngram_size:]
+            # Most recent occurrence first, excluding the n-gram itself
+            for start in range(len(tokens) - ngram_size - 1, -1, -1):
+                if tokens[start:start + ngram_size] == ngram:
+                    return tokens[start + ngram_size:start + ngram_size + max_tokens]
+        return []
+
+    @torch.no_grad()
+    def generate_ids(self, input_ids: list[int]) -> list[int]:
+        """
+        Greedily generates the tokens following a prompt, verifying drafted tokens in a single forward pass.
+
+        Args:
+            input_ids (list[int]): The token ids of the prompt.
+
+        Returns:
+            list[int]: The generated token ids, ending with the end of sequence token if it was generated.
+        """
+        eos_token_id = self.tokenizer.eos_token_id
+        cache = DynamicCache()
+
+        # Prefill: the cache holds every token but the last one generated
+        outputs = self.model(torch.tensor([input_ids], device=self.model.device), past_key_values=cache, use_cache=True)
+        cache = outputs.past_key_values
+        generated = [int(outputs.logits[0, -1].argmax())]
+        tokens = list(input_ids) + generated
+        self._counters["forward_passes"] += 1
+
+        while len(generated) < self.max_new_tokens and generated[-1] != eos_token_id:
+            # Each step yields at most len(draft) + 1 tokens, which must fit in the budget
+            draft = self._find_draft(tokens, min(self.num_draft_tokens, self.max_new_tokens - len(generated) - 1))
+
+            step_input = torch.tensor([[generated[-1]] + draft], device=self.model.device)
+            outputs = self.model(step_input, past_key_values=cache, use_cache=True)
+            cache = outputs.past_key_values
+            predictions = outputs.logits[0].argmax(-1).tolist()
+            self._counters["forward_passes"] += 1
+
+            num_accepted = 0
+            while num_accepted < len(draft) and draft[num_accepted] == predictions[num_accepted]:
+                num_accepted += 1
+            new_tokens = draft[:num_accepted] + [predictions[num_accepted]]
+            self._counters["drafted"] += len(draft)
+            self._counters["accepted"] += num_accepted
+
+            # Drop the cached keys/values of the rejected draft tokens
+            cache.crop(len(tokens) + num_accepted)
+
+            if eos_token_id in new_tokens:
+                new_tokens = new_tokens[:new_tokens.index(eos_token_id) + 1]
+            generated += new_tokens
+            tokens += new_tokens
+
+        self._counters["new_tokens"] += len(generated)
+        return generated
+
+    def complete(self, prefix: str, suffix: str) -> str:
+        """
+        Generates the middle between a prefix and a suffix.
+
+        Args:
+            prefix (str): The code before the hole.
+            suffix (str): The code after the hole.
+
+        Returns:
+            str: The generated middle.
+        """
+        input_ids = self.tokenizer(FIMGenerator.build_prompt(prefix, suffix))["input_ids"]
+        return self.tokenizer.decode(self.generate_ids(input_ids), skip_special_tokens=True)
+
+    def _collect_stats(self, num_samples: int, elapsed: float) -> dict:
+        """
+        Builds the statistics of a run from the counters.
+
+        Args:
+            num_samples (int): The number of generated samples.
+            elapsed (float): The duration of the run, in seconds.
+
+        Returns:
+            dict: The statistics of the run.
+        """
+        counters = self._counters
+        return {
+            "samples": num_samples,
+            "seconds": elapsed,
+            "new_tokens": counters["new_tokens"],
+            "tokens_per_sec": counters["new_tokens"] / elapsed if elapsed > 0 else 0.0,
+            "acceptance_rate": counters["accepted"] / counters["drafted"] if counters["drafted"] else 0.0,
+            "tokens_per_forward_pass": counters["new_tokens"] / counters["forward_passes"] if counters["forward_passes"] else 0.0,
+        }
+
+    def generate(self, dataset: Dataset) -> list[str]:
+        """
+        Generates the middles of all the samples in the dataset and reports the acceptance rate and throughput.
+
+        Args:
+            dataset (Dataset): A dataset whose items are (prefix, middle, suffix) tuples or dicts with `input_ids`.
+
+        Returns:
+            list[str]: The generated middles, in dataset order.
+        """
+        self._counters = {"drafted": 0, "accepted": 0, "new_tokens": 0, "forward_passes": 0}
+        start_time = time.perf_counter()
+        results = []
+        for i in range(len(dataset)):
+            input_ids = FIMGenerator.encode_item(self.tokenizer, dataset[i])
+            results.append(self.tokenizer.decode(self.generate_ids(input_ids), skip_special_tokens=True))
+        self.stats = self._collect_stats(len(results), time.perf_counter() - start_time)
+
+        print(f"Generated {len(results)} samples ({self.stats['tokens_per_sec']:.2f} tokens/sec, "
+              f"acceptance rate {self.stats['acceptance_rate']:.2%})")
+        return results
+
+    @torch.no_grad()
+    def benchmark(self, dataset: Dataset) -> dict:
+        """
+        Generates every sample both with plain greedy `model.generate` and with prompt lookup,
+        and compares their throughput and outputs.
+
+        Args:
+            dataset (Dataset): A dataset whose items are (prefix, middle, suffix) tuples or dicts with `input_ids`.
+
+        Returns:
+            dict: The throughput of both paths, the speedup, the acceptance rate and the share of identical outputs.
+        """
+        prompts = [FIMGenerator.encode_item(self.tokenizer, dataset[i]) for i in range(len(dataset))]
+
+        baseline_outputs, baseline_tokens = [], 0
+        start_time = time.perf_counter()
+        for input_ids in prompts:
+            inputs = torch.tensor([input_ids], device=self.model.device)
+            outputs = self.model.generate(inputs, attention_mask=torch.ones_like(inputs), max_new_tokens=self.max_new_tokens, do_sample=False,
+                                          pad_token_id=self.tokenizer.pad_token_id or self.tokenizer.eos_token_id)
+            baseline_outputs.append(outputs[0, len(input_ids):].tolist())
+            baseline_tokens += len(baseline_outputs[-1])
+        baseline_elapsed = time.perf_counter() - start_time
+
+        self._counters = {"drafted": 0, "accepted": 0, "new_tokens": 0, "forward_passes": 0}
+        start_time = time.perf_counter()
+        lookup_outputs = [self.generate_ids(input_ids) for input_ids in prompts]
+        stats = self._collect_stats(len(prompts), time.perf_counter() - start_time)
+
+        baseline_tokens_per_sec = baseline_tokens / baseline_elapsed if baseline_elapsed > 0 else 0.0
+        results = {
+            "baseline_tokens_per_sec": baseline_tokens_per_sec,
+            "lookup_tokens_per_sec": stats["tokens_per_sec"],
+            "speedup": stats["tokens_per_sec"] / baseline_tokens_per_sec if baseline_tokens_per_sec > 0 else 0.0,
+            "acceptance_rate": stats["acceptance_rate"],
+            "tokens_per_forward_pass": stats["tokens_per_forward_pass"],
+            "identical_outputs": sum(a == b for a, b in zip(baseline_outputs, lookup_outputs)) / len(prompts) if prompts else 0.0,
+        }
+        print(f"Prompt lookup: {results['lookup_tokens_per_sec']:.2f} tokens/sec vs {baseline_tokens_per_sec:.2f} "
+              f"({results['speedup']:.2f}x), acceptance rate {results['acceptance_rate']:.2%}, "
+              f"{results['identical_outputs']:.2%} identical outputs")
+        return results
@@ -4,23 +4,70 @@ Date: 12/07/2024
 Description: This module contains the RepoExtractor class, which is designed to clone a repository from a given URL,
     process files with specific extensions, and retrieve their contents.
 """
-from git import Repo
+from git import Repo, Git, InvalidGitRepositoryError
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from collections import deque
+from .NotebookScanner import NotebookScanner
+from .profiling import stage
+from typing import Callable, Union
+import tempfile
+import hashlib
 import os
 import json
 
+def _run_handler(handler: Union[Callable[[str], str], tuple], file_path: str, file_content: Union[str, bytes]) -> tuple:
+    """
+    Reads and handles a single file. This is the unit of work sent to the worker pool.
+
+    Args:
+        handler (Callable[[str], str] | tuple): The handler to apply, a (class, method name) pair resolved
+            in the worker, or None to return the content unchanged.
+        file_path (str): The path to read the file from, used when `file_content` is None.
+        file_content (str | bytes): The content of the file, if already read. Bytes are decoded as UTF-8.
+
+    Returns:
+        tuple: The handled content and None, or None and the exception raised while processing the file.
+    """
+    try:
+        if isinstance(handler, tuple):
+            handler = getattr(*handler)
+        if file_content is None:
+            with open(file_path, "r", encoding="utf-8") as f:
+                file_content = f.read()
+        elif isinstance(file_content, bytes):
+            file_content = file_content.decode("utf-8")
+        return (handler(file_content) if handler else file_content), None
+    except Exception as e:
+        return None, e
+
 class RepoExtractor:
     """
     RepoExtractor is a class designed to clone a repository from a given URL,
     process files with specific extensions, and retrieve their contents.
     Attributes:
-        PARSERS (dict): A dictionary mapping file extensions to their respective handler methods.
+        PARSERS (dict): A dictionary mapping file extensions to their respective handler methods
+            (by name) or to handler functions. New handlers are added with `register_handler`.
+        HANDLER_VERSIONS (dict): The version of the output of every named handler, used by the extraction cache.
+        cache_hits (int): The number of files served from the extraction cache.
+        cache_misses (int): The number of files read and handled because they were not cached.
     Methods:
-        __init__(repo_url: str, repo_dir: str = "./temp") -> None:
+        __init__(repo_url: str, repo_dir: str = "./temp", cache_dir: str = None, ref: str = "HEAD",
+                 checkout: bool = True, lazy: bool = False, num_workers: int = 1, executor: str = "thread") -> None:
             Initializes the RepoExtractor instance with the repository URL and directory.
+        register_handler(file_ext: str, handler: str | Callable[[str], str]) -> None:
+            Registers the handler of a file extension.
         _get_files() -> list[str]:
             Clones the repository, processes files with allowed extensions, and returns their contents.
+        _iter_odb_files():
+            Streams the processed contents of the allowed files straight from the git object database.
+        _iter_cached_files():
+            Streams the processed contents, reusing the handled contents stored in the extraction cache.
+        iter_files():
+            Streams the processed contents of the allowed files.
         get_files() -> list[str]:
             Retrieves the list of all files' content.
+        _process(tasks):
+            Reads and handles files, in parallel when `num_workers` > 1, preserving their order.
         handle_default(file_content: str) -> str:
         handle_ipynb(file_content: str) -> str:
     """
@@ -30,23 +77,47 @@ class RepoExtractor:
         ".cpp": "handle_default",
         ".hpp": "handle_default",
     }
+    # The version of the output of every named handler, part of the cache key of its contents.
+    # It must be increased whenever a handler produces a different output, so that stale entries are not served.
+    HANDLER_VERSIONS = {
+        "handle_ipynb": 2,
+    }
 
-    def __init__(self, repo_url: str, repo_dir: str = "./temp") -> None:
+    def __init__(self, repo_url: str, repo_dir: str = "./temp", cache_dir: str = None, ref: str = "HEAD",
+                 checkout: bool = True, lazy: bool = False, num_workers: int = 1, executor: str = "thread") -> None:
         """
         Initializes the RepoExtractor instance.
 
         Args:
-            repo_url (str): The URL of the repository to clone.
+            repo_url (str): The URL (or local path) of the repository to clone.
             repo_dir (str, optional): The directory where the repository will be cloned. Defaults to "./temp".
+            cache_dir (str, optional): The directory of the extraction cache. If None, the cache is not used
+                and every file is read and handled again. Defaults to None.
+            ref (str, optional): The branch, tag or commit to extract. Defaults to "HEAD".
+            checkout (bool, optional): If False, the files are read straight from the git object database of a
+                bare clone (or of `repo_url` itself when it is a local repository), without any checkout. Defaults to True.
+            lazy (bool, optional): If True, nothing is extracted until `iter_files` or `get_files` is called. Defaults to False.
+            num_workers (int, optional): The number of workers reading and handling files. Defaults to 1 (no pool).
+            executor (str, optional): The kind of worker pool, either "thread" or "process". A process pool pays off
+                for CPU-bound handlers such as `handle_ipynb` on big notebooks, but needs picklable handlers. Defaults to "thread".
 
         Raises:
             OSError: If the directory cannot be removed.
         """
         self.repo_url = repo_url
         self.repo_dir = repo_dir
+        self.cache_dir = cache_dir
+        self.ref = ref
+        self.checkout = checkout
+        self.num_workers = num_workers
+        self.executor = executor
+        self.cache_hits = 0
+        self.cache_misses = 0
         if os.path.exists(self.repo_dir):
             os.system(f"rm -rf {self.repo_dir}")
-        self.files = self._get_files()
+        self.files = None
+        if not lazy:
+            self.get_files()
 
     def _get_files(self) -> list[str]:
         """
@@ -63,39 +134,358 @@ class RepoExtractor:
         """
         # Clone the repository into the directory
         repo = Repo.clone_from(self.repo_url, self.repo_dir)
+        if self.ref != "HEAD":
+            repo.git.checkout(self.ref)
+
+        # Walk through the repo_dir to find all files with allowed extensions
+        def tasks():
+            for root, _, files in os.walk(self.repo_dir):
+                for file in files:
+                    file_path = os.path.join(root, file)
+                    if os.path.splitext(file_path)[1] in self.PARSERS.keys():
+                        # The file is read by the worker handling it
+                        yield file_path, self._get_handler(file_path), file_path, None
 
         # Initialize an empty list to store the contents of allowed files
         files_content = []
+        for file_path, handled_content, error in self._process(tasks()):
+            if error is not None:
+                print(f"Error reading file {file_path}: {error}")
+            elif handled_content:
+                files_content.append(handled_content)
+
+        # Remove the cloned repository directory
+        os.system(f"rm -rf {self.repo_dir}")
+        
+        # Return the list of files' contents
+        return files_content
+
+    @staticmethod
+    def _is_commit_sha(rev: str) -> bool:
+        """
+        Checks whether a revision is a full commit SHA.
+
+        Args:
+            rev (str): The revision.
+
+        Returns:
+            bool: True if the revision is a full commit SHA.
+        """
+        return len(rev) == 40 and all(c in "0123456789abcdef" for c in rev.lower())
+
+    def _resolve_commit(self) -> str:
+        """
+        Resolves the reference to extract to a commit SHA, without cloning the repository.
+
+        Returns:
+            str: The SHA of the commit.
+
+        Raises:
+            ValueError: If the reference does not exist in the repository.
+        """
+        # Full SHAs are not advertised by ls-remote, they are used as they are
+        if self._is_commit_sha(self.ref):
+            return self.ref.lower()
+
+        output = Git().ls_remote(self.repo_url, self.ref)
+        if not output:
+            raise ValueError(f"Reference {self.ref} not found in {self.repo_url}")
+        return output.splitlines()[0].split()[0]
+
+    def _open_repo(self, rev: str) -> tuple[Repo, bool]:
+        """
+        Gives access to the objects of the repository at the given revision.
+
+        In checkout mode the repository is cloned and `rev` is checked out. Otherwise an existing
+        local repository is opened in place, and a remote one is cloned bare (shallow when `rev`
+        is a branch, a tag or HEAD), so that no working tree is ever written.
+
+        Args:
+            rev (str): The revision whose files will be read.
+
+        Returns:
+            tuple[Repo, bool]: The repository and whether it was cloned into `repo_dir`.
+        """
+        if not self.checkout and os.path.isdir(self.repo_url):
+            try:
+                return Repo(self.repo_url), False
+            except InvalidGitRepositoryError:
+                pass
+
+        if self.checkout:
+            repo = Repo.clone_from(self.repo_url, self.repo_dir)
+            if rev != "HEAD":
+                repo.git.checkout(rev)
+            return repo, True
+
+        # Commits can only be fetched from a full clone, branches and tags from a shallow one
+        clone_options = {"bare": True}
+        if not self._is_commit_sha(rev):
+            clone_options["depth"] = 1
+            if rev != "HEAD":
+                clone_options["branch"] = rev
+        return Repo.clone_from(self.repo_url, self.repo_dir, **clone_options), True
+
+    def _list_entries(self, repo: Repo, rev: str) -> list[dict]:
+        """
+        Walks the tree of a revision and lists the allowed files, without reading them.
+
+        Args:
+            repo (Repo): The repository.
+            rev (str): The revision whose tree is walked.
+
+        Returns:
+            list[dict]: The path, blob hash and handler key of every allowed file.
+        """
+        entries = []
+        # NUL-terminated records keep the paths verbatim, without the quoting of unusual characters
+        for record in repo.git.ls_tree("-r", "-z", rev).split("\0"):
+            if not record:
+                continue
+            info, file_path = record.split("\t", 1)
+            _, object_type, blob = info.split()
+            file_ext = os.path.splitext(file_path)[1]
+            if object_type == "blob" and file_ext in self.PARSERS.keys():
+                entries.append({"path": file_path, "blob": blob, "handler": self._handler_key(self.PARSERS[file_ext])})
+        return entries
+
+    def _entry_task(self, repo: Repo, entry: dict) -> tuple:
+        """
+        Builds the task reading and handling a file, from the checkout or straight from the object database.
+        Blobs are read here, since the object database of a repository cannot be shared between workers,
+        and decoded by the worker.
+
+        Args:
+            repo (Repo): The repository.
+            entry (dict): The entry of the file, as returned by `_list_entries`.
+
+        Returns:
+            tuple: The (entry, handler, file path, file content) task.
+        """
+        handler = self._get_handler(entry["path"])
+        if self.checkout:
+            return entry, handler, os.path.join(self.repo_dir, entry["path"]), None
+        return entry, handler, None, repo.odb.stream(bytes.fromhex(entry["blob"])).read()
+
+    def _iter_odb_files(self):
+        """
+        Streams the processed contents of the allowed files of `ref` straight from the git
+        object database, without checking out a working tree.
+
+        Yields:
+            str: The processed content of each allowed file.
+        """
+        repo, cloned = self._open_repo(self.ref)
+        try:
+            tasks = (self._entry_task(repo, entry) for entry in self._list_entries(repo, self.ref))
+            for entry, handled_content, error in self._process(tasks):
+                if error is not None:
+                    print(f"Error reading file {entry['path']}: {error}")
+                elif handled_content:
+                    yield handled_content
+        finally:
+            if cloned:
+                os.system(f"rm -rf {self.repo_dir}")
+
+    def _cache_path(self, *parts: str) -> str:
+        """
+        Builds a path inside the extraction cache, creating its parent directory.
 
-        # Walk through the repo_dir to find all files
-        for root, _, files in os.walk(self.repo_dir):
-            for file in files:
+        Args:
+            *parts (str): The components of the path, relative to the cache directory.
+
+        Returns:
+            str: The path inside the cache.
+        """
+        path = os.path.join(self.cache_dir, *parts)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        return path
+
+    @staticmethod
+    def _write_atomic(path: str, content: str) -> None:
+        """
+        Writes a cache file through a temporary file of its own, so that an interrupted run never leaves a partial
+        entry and concurrent extractions sharing the cache never write to the same temporary file.
+
+        Args:
+            path (str): The path of the cache file.
+            content (str): The content to write.
+        """
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                f.write(content)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+
+    def _iter_cached_files(self):
+        """
+        Streams the processed contents of the allowed files through the extraction cache.
+
+        The cache has two levels:
+        - A manifest per (repository URL, commit SHA), listing the blob hash of every allowed file.
+          When the manifest of the requested commit exists, nothing is cloned at all.
+        - A content-addressed store of handled contents, keyed by handler and blob hash.
+          When a new commit is extracted, only the files whose blob changed are read and handled again.
+
+        Yields:
+            str: The processed content of each allowed file.
+        """
+        commit = self._resolve_commit()
+        url_key = hashlib.sha1(self.repo_url.encode("utf-8")).hexdigest()
+        manifest_path = self._cache_path("repos", url_key, f"{commit}.json")
+
+        # The repository is only opened (or cloned) when some file has to be read from it
+        source = {"repo": None, "cloned": False}
+        if os.path.exists(manifest_path):
+            with open(manifest_path, "r") as f:
+                manifest = json.load(f)
+        else:
+            # List the blob of every allowed file of the commit
+            source["repo"], source["cloned"] = self._open_repo(commit)
+            manifest = self._list_entries(source["repo"], commit)
+
+        def tasks():
+            for entry in manifest:
+                blob_path = self._cache_path("blobs", entry["handler"], entry["blob"][:2], entry["blob"])
+                if os.path.exists(blob_path):
+                    # Cached contents are already handled, they only need to be read
+                    yield (entry, blob_path, True), None, blob_path, None
+                else:
+                    # A cached manifest whose blob entry was removed still needs the repository
+                    if source["repo"] is None:
+                        source["repo"], source["cloned"] = self._open_repo(commit)
+                    _, handler, file_path, file_content = self._entry_task(source["repo"], entry)
+                    yield (entry, blob_path, False), handler, file_path, file_content
+
+        try:
+            cached_entries = []
+            for (entry, blob_path, hit), handled_content, error in self._process(tasks()):
                 try:
-                    # Get the file path
-                    file_path = os.path.join(root, file)
+                    if error is not None:
+                        raise error
+                    if hit:
+                        self.cache_hits += 1
+                    else:
+                        self.cache_misses += 1
+                        self._write_atomic(blob_path, handled_content or "")
+
+                    cached_entries.append(entry)
+                    if handled_content:
+                        yield handled_content
+                except Exception as e:
+                    print(f"Error reading file {entry['path']}: {e}")
 
-                    # Get the file extension
-                    file_ext = os.path.splitext(file_path)[1]
+            # Files that could not be handled are left out, so a cached commit never needs a checkout
+            if not os.path.exists(manifest_path):
+                self._write_atomic(manifest_path, json.dumps(cached_entries))
+        finally:
+            # Remove the cloned repository directory
+            if source["cloned"]:
+                os.system(f"rm -rf {self.repo_dir}")
 
-                    # Check if the file extension is allowed
-                    if file_ext in self.PARSERS.keys():
-                        # Read the file content
-                        with open(file_path, "r") as f:
-                            file_content = f.read()
+    @classmethod
+    def register_handler(cls, file_ext: str, handler: Union[str, Callable[[str], str]]) -> None:
+        """
+        Registers the handler of a file extension, replacing the previous one if any.
+        The registration only affects this class and its subclasses.
 
-                        # Get the handler for the file extension
-                        handler = getattr(self, self.PARSERS[file_ext])
-                        handled_content = handler(file_content)
+        Args:
+            file_ext (str): The file extension, including the dot (e.g. ".rs").
+            handler (str | Callable[[str], str]): The name of a handler method of the class, or a function
+                taking the file content and returning the processed content. With a process pool the
+                function must be picklable (i.e. defined at module level), and a named handler must be
+                a static method, since only the class and the name are sent to the workers.
+        """
+        cls.PARSERS = {**cls.PARSERS, file_ext: handler}
+
+    def _get_handler(self, file_path: str) -> Union[Callable[[str], str], tuple]:
+        """
+        Retrieves the handler of a file from its extension.
+
+        Args:
+            file_path (str): The path of the file.
+
+        Returns:
+            Callable[[str], str] | tuple: The handler, or the (class, method name) pair of a named handler
+                when the workers are processes.
+        """
+        handler = self.PARSERS[os.path.splitext(file_path)[1]]
+        if not isinstance(handler, str):
+            return handler
+        # A bound method would pickle the whole extractor (files included) with every task
+        return (type(self), handler) if self.executor == "process" else getattr(self, handler)
 
-                        if handled_content:
-                            files_content.append(handled_content)
+    @classmethod
+    def _handler_key(cls, handler: Union[str, Callable[[str], str]]) -> str:
+        """
+        Builds the name under which the contents produced by a handler are cached.
+
+        Args:
+            handler (str | Callable[[str], str]): The handler, as stored in PARSERS. The version of a named handler
+                is read from HANDLER_VERSIONS, the one of a function from its `version` attribute (1 by default).
+
+        Returns:
+            str: The name of the handler, followed by its version when above 1.
+        """
+        if isinstance(handler, str):
+            name, version = handler, cls.HANDLER_VERSIONS.get(handler, 1)
+        else:
+            name, version = f"{handler.__module__}.{handler.__qualname__}", getattr(handler, "version", 1)
+        return name if version == 1 else f"{name}.v{version}"
+
+    def _process(self, tasks):
+        """
+        Reads and handles files, in a pool of `num_workers` workers when it is greater than 1.
+        Results are yielded in the order of the tasks, and only a bounded number of tasks is in
+        flight at any time, so the tasks can be produced lazily.
+
+        Args:
+            tasks (Iterable[tuple]): The (key, handler, file path, file content) tasks, as taken by `_run_handler`.
+
+        Yields:
+            tuple: The key of the task, the handled content and the exception raised, if any.
+        """
+        if self.num_workers <= 1:
+            for key, handler, file_path, file_content in tasks:
+                yield (key, *_run_handler(handler, file_path, file_content))
+            return
+
+        pool_class = ProcessPoolExecutor if self.executor == "process" else ThreadPoolExecutor
+        with pool_class(max_workers=self.num_workers) as pool:
+            pending = deque()
+
+            def next_result():
+                key, future = pending.popleft()
+                try:
+                    return (key, *future.result())
                 except Exception as e:
-                    print(f"Error reading file {file_path}: {e}")
-        # Remove the cloned repository directory
-        os.system(f"rm -rf {self.repo_dir}")
-        
-        # Return the list of files' contents
-        return files_content
+                    # The task could not even be sent to the worker (e.g. an unpicklable handler)
+                    return key, None, e
+
+            for key, handler, file_path, file_content in tasks:
+                pending.append((key, pool.submit(_run_handler, handler, file_path, file_content)))
+                if len(pending) >= 4 * self.num_workers:
+                    yield next_result()
+            while pending:
+                yield next_result()
+
+    def iter_files(self):
+        """
+        Streams the processed contents of the allowed files, so that later stages can start
+        consuming them before the extraction is over.
+
+        Yields:
+            str: The processed content of each allowed file.
+        """
+        if self.cache_dir:
+            yield from self._iter_cached_files()
+        elif self.checkout:
+            yield from self._get_files()
+        else:
+            yield from self._iter_odb_files()
 
     def get_files(self) -> list[str]:
         """
@@ -104,9 +494,15 @@ class RepoExtractor:
         Returns:
             list[str]: A list of strings containing the content of all files.
         """
+        if self.files is None:
+            with stage("extract", repo=self.repo_url) as event:
+                self.files = list(self.iter_files())
+                event["items"] = len(self.files)
+                event["bytes"] = sum(len(content) for content in self.files)
         return self.files
     
-    def handle_default(self, file_content: str) -> str:
+    @staticmethod
+    def handle_default(file_content: str) -> str:
         """
         Handles the default case by returning the provided file content unchanged.
 
@@ -118,26 +514,16 @@ class RepoExtractor:
         """
         return file_content
     
-    def handle_ipynb(self, file_content: str) -> str:
+    @staticmethod
+    def handle_ipynb(file_content: str) -> str:
         """
         Extracts and concatenates the source code from all code cells in a Jupyter notebook.
+        The notebook is scanned incrementally: only the type and the source of the cells are decoded,
+        while outputs (e.g. base64 images) are skipped without being built in memory.
         Args:
             file_content (str): The JSON content of the Jupyter notebook as a string.
         Returns:
-            str: A single string containing the concatenated source code from all code cells.
+            str: A single string containing the source code of all code cells, one cell after the other.
         """
-        # Extracting only the code cells from the notebook
-        notebook = json.loads(file_content)
-
-        # Initialize an empty string to store the code cells
-        code_cells = []
-
-        # Loop through the cells in the notebook
-        for cell in notebook["cells"]:
-            # Check if the cell is a code cell
-            if cell["cell_type"] == "code":
-                # Extract the source code from the cell
-                code_cells.append("\n".join(cell["source"]))
-        
-        return "".join(code_cells)
-
+        # Cells are separated by a newline so that the last line of a cell is not merged with the next cell
+        return "\n".join(NotebookScanner.iter_code_cells(file_content))
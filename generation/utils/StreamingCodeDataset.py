@@ -0,0 +1,120 @@
+"""
+Description: This module contains the StreamingCodeDataset class, a constant-memory variant of CodeDataset
+    which draws its code completion examples lazily from a stream of file contents.
+"""
+from torch.utils.data import IterableDataset, get_worker_info
+from .CodeDataset import sample_span
+from typing import Callable, Iterable, Union
+import random
+
+class StreamingCodeDataset(IterableDataset):
+    """
+    StreamingCodeDataset draws the same kind of (prefix, middle, suffix) examples as CodeDataset,
+    but without building every candidate example in memory.
+    Each file still contributes up to `num_samples` candidate spans, but the spans are drawn one at a
+    time and kept with reservoir sampling, so only `num_samples` examples are held at any moment and
+    the strings of a candidate are sliced only if it enters the reservoir.
+    When used with several DataLoader workers, the files are sharded between the workers (the i-th file
+    goes to worker i % num_workers) and every worker draws its share of the examples from its own files,
+    so the sampling work is split instead of repeated. Each worker still iterates the stream to find its
+    files, but only slices and samples those. The examples are seeded and reproducible for a given number
+    of workers, but differ from a single-process run (each shard contributes a fixed share of them).
+    Attributes:
+        num_samples (int): The number of code completion examples to generate.
+        min_lengths (tuple): The min prefix, middle and suffix lengths.
+        max_lengths (tuple): The max prefix, middle and suffix lengths.
+        seed (int): The seed of the random number generator.
+    Methods:
+        sample(worker_id: int, num_workers: int) -> list[tuple[str, str, str]]:
+            Runs the reservoir sampling over the stream of files, or over the shard of a worker.
+    """
+
+    def __init__(self, file_contents: Union[Iterable[str], Callable[[], Iterable[str]]], num_samples: int = 50,
+                 min_lengths: tuple = (20, 10, 20), max_lengths: tuple = (200, 50, 200), seed: int = None):
+        """
+        Args:
+            file_contents (Iterable[str] | Callable[[], Iterable[str]]): The contents of the code files, or a
+                function returning a fresh iterable of them (e.g. a generator over a repository). A one-shot
+                generator can only be iterated once.
+            num_samples (int): The number of code completion examples to generate.
+            min_lengths (tuple): A tuple (x, y, z) where x is the min prefix length, y is the min middle length, and z is the min suffix length.
+            max_lengths (tuple): A tuple (x, y, z) where x is the max prefix length, y is the max middle length, and z is the max suffix length.
+            seed (int, optional): The seed used to draw the examples. If None, a random seed is picked once
+                so that every pass and every worker still draws the same examples.
+        """
+        self.file_contents = file_contents
+        self.num_samples = num_samples
+        self.min_lengths, self.max_lengths = min_lengths, max_lengths
+        self.seed = seed if seed is not None else random.randrange(2 ** 32)
+
+    def _iter_contents(self) -> Iterable[str]:
+        """
+        Returns an iterable over the file contents.
+        Returns:
+            Iterable[str]: The contents of the code files.
+        """
+        if callable(self.file_contents):
+            return self.file_contents()
+        return self.file_contents
+
+    def sample(self, worker_id: int = 0, num_workers: int = 1) -> list[tuple[str, str, str]]:
+        """
+        Draws the examples from the stream of file contents with reservoir sampling.
+        Every valid candidate span has the same probability of being kept, as with the
+        `random.sample` over all candidates done by CodeDataset.
+        Args:
+            worker_id (int): The shard to sample, the files whose position modulo `num_workers` is `worker_id`.
+            num_workers (int): The number of shards. With the defaults the whole stream is sampled.
+        Returns:
+            list[tuple[str, str, str]]: The (prefix, middle, suffix) examples, in stream order.
+        """
+        rng = random.Random(self.seed + worker_id)
+        min_content_length = sum(self.min_lengths)
+        # The examples are split as evenly as possible between the shards
+        num_samples = self.num_samples // num_workers + (worker_id < self.num_samples % num_workers)
+
+        # Each slot holds (candidate number, example) so that the stream order can be restored
+        reservoir = []
+        num_candidates = 0
+
+        for file_index, content in enumerate(self._iter_contents()):
+            if file_index % num_workers != worker_id:
+                continue
+            content_length = len(content)
+
+            # Ensure the content is long enough to generate examples with min lengths
+            if content_length < min_content_length:
+                continue
+
+            for _ in range(self.num_samples):
+                span = sample_span(content_length, self.min_lengths, self.max_lengths, rng)
+                if span is None:
+                    continue
+
+                # Algorithm R: the n-th candidate replaces a random slot with probability k/n
+                if num_candidates < num_samples:
+                    slot = len(reservoir)
+                    reservoir.append(None)
+                else:
+                    slot = rng.randint(0, num_candidates)
+                num_candidates += 1
+                if slot >= num_samples:
+                    continue
+
+                cursor_position, prefix_length, middle_length, suffix_length = span
+                prefix = content[cursor_position - prefix_length:cursor_position]
+                middle = content[cursor_position:cursor_position + middle_length]
+                suffix = content[cursor_position + middle_length:cursor_position + middle_length + suffix_length]
+                reservoir[slot] = (num_candidates, (prefix, middle, suffix))
+
+        return [example for _, example in sorted(reservoir, key=lambda item: item[0])]
+
+    def __iter__(self):
+        """
+        Iterates over the examples. With DataLoader workers, each worker yields the examples of its shard of files.
+        Yields:
+            tuple: A tuple containing the prefix, middle, and suffix segments of an example.
+        """
+        worker_info = get_worker_info()
+        worker_id, num_workers = (0, 1) if worker_info is None else (worker_info.id, worker_info.num_workers)
+        yield from self.sample(worker_id, num_workers)
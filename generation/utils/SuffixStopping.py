@@ -0,0 +1,119 @@
+"""
+Description: This module contains the SuffixStoppingCriteria class, which stops FIM generation as soon as the
+    model starts reproducing the known suffix, or when the completion exceeds its line or token budget.
+"""
+from transformers import StoppingCriteria
+import torch
+
+class SuffixStoppingCriteria(StoppingCriteria):
+    """
+    SuffixStoppingCriteria checks, after every decoding step, the text generated so far for each row of a batch.
+    A row is done once its text contains the beginning of its suffix (the model filled the hole and
+    moved on to the code that follows it), once it has `max_lines` complete lines, or once it has
+    generated `max_tokens` tokens. Generation stops when every row is done, and `trim` cuts each
+    completion back to the hole.
+    Attributes:
+        suffixes (list[str]): The suffix of each row.
+        prompt_length (int): The (padded) length of the prompts.
+        match_chars (int): The number of suffix characters that must be reproduced to stop.
+        max_lines (int): The line budget of a completion, or None.
+        max_tokens (int): The token budget of a completion, or None.
+        stop_steps (list[int]): The number of tokens each row had generated when it was done, or None.
+    Methods:
+        trim(text: str, suffix: str, match_chars: int, min_match_chars: int, max_lines: int) -> str:
+            Cuts a completion where the suffix starts being reproduced.
+    """
+
+    def __init__(self, tokenizer, suffixes: list[str], prompt_length: int, match_chars: int = 20,
+                 min_match_chars: int = 8, max_lines: int = None, max_tokens: int = None) -> None:
+        """
+        Initializes the SuffixStoppingCriteria instance.
+
+        Args:
+            tokenizer: The tokenizer used to decode the generated tokens.
+            suffixes (list[str]): The suffix of each row of the batch.
+            prompt_length (int): The (padded) length of the prompts, the tokens after it are the generated ones.
+            match_chars (int, optional): The number of characters at the start of the suffix (ignoring leading
+                whitespace) that must appear in the completion to stop. Defaults to 20.
+            min_match_chars (int, optional): Suffixes shorter than this are not matched, to avoid stopping on
+                common snippets such as a lone closing bracket. Defaults to 8.
+            max_lines (int, optional): The line budget of a completion. Defaults to None (no budget).
+            max_tokens (int, optional): The token budget of a completion. Defaults to None (no budget).
+        """
+        self.tokenizer = tokenizer
+        self.suffixes = suffixes
+        self.prompt_length = prompt_length
+        self.match_chars = match_chars
+        self.max_lines = max_lines
+        self.max_tokens = max_tokens
+        self.suffix_heads = [self._suffix_head(suffix, match_chars, min_match_chars) for suffix in suffixes]
+        self.stop_steps = [None] * len(suffixes)
+
+    @staticmethod
+    def _suffix_head(suffix: str, match_chars: int, min_match_chars: int) -> str:
+        """
+        Returns the beginning of a suffix that a completion must reproduce to be stopped.
+
+        Args:
+            suffix (str): The suffix.
+            match_chars (int): The number of characters to match.
+            min_match_chars (int): The minimum number of characters to match.
+
+        Returns:
+            str: The beginning of the suffix, or None if it is too short to be matched reliably.
+        """
+        head = suffix.lstrip()[:match_chars]
+        return head if len(head) >= min_match_chars else None
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs) -> torch.BoolTensor:
+        """
+        Checks which rows are done after the last decoding step.
+
+        Args:
+            input_ids (torch.LongTensor): The prompts followed by the tokens generated so far.
+            scores (torch.FloatTensor): The prediction scores of the last step.
+
+        Returns:
+            torch.BoolTensor: Whether each row is done.
+        """
+        num_generated = input_ids.shape[1] - self.prompt_length
+        texts = self.tokenizer.batch_decode(input_ids[:, self.prompt_length:], skip_special_tokens=True)
+
+        for row, text in enumerate(texts):
+            if self.stop_steps[row] is not None:
+                continue
+            head = self.suffix_heads[row]
+            if ((head is not None and head in text)
+                    or (self.max_lines is not None and text.count("\n") >= self.max_lines)
+                    or (self.max_tokens is not None and num_generated >= self.max_tokens)):
+                self.stop_steps[row] = num_generated
+
+        return torch.tensor([step is not None for step in self.stop_steps], dtype=torch.bool, device=input_ids.device)
+
+    @classmethod
+    def trim(cls, text: str, suffix: str, match_chars: int = 20, min_match_chars: int = 8, max_lines: int = None) -> str:
+        """
+        Cuts a completion where it starts reproducing the suffix, including the whitespace the suffix
+        starts with, and then to its line budget.
+
+        Args:
+            text (str): The generated completion.
+            suffix (str): The suffix of the sample.
+            match_chars (int, optional): The number of suffix characters to look for. Defaults to 20.
+            min_match_chars (int, optional): Suffixes shorter than this are not looked for. Defaults to 8.
+            max_lines (int, optional): The line budget of a completion. Defaults to None (no budget).
+
+        Returns:
+            str: The trimmed completion.
+        """
+        head = cls._suffix_head(suffix, match_chars, min_match_chars)
+        if head is not None and head in text:
+            cut = text.index(head)
+            leading_whitespace = suffix[:len(suffix) - len(suffix.lstrip())]
+            if text[:cut].endswith(leading_whitespace):
+                cut -= len(leading_whitespace)
+            text = text[:cut]
+
+        if max_lines is not None:
+            text = "".join(text.splitlines(keepends=True)[:max_lines])
+        return text
@@ -0,0 +1,216 @@
+"""
+Description: This module contains the TokenizedCodeDataset class, the token level counterpart of CodeDataset,
+    which cuts the code completion examples on token boundaries and caches the token ids of the files on disk.
+"""
+from torch.utils.data import Dataset
+from .CodeDataset import sample_span
+from .FIMGenerator import FIM_BEGIN, FIM_HOLE, FIM_END
+from .profiling import stage
+import numpy as np
+import hashlib
+import random
+import os
+
+def tokenizer_key(tokenizer) -> str:
+    """
+    Computes a key identifying a tokenizer, so that cached ids are never reused with a different vocabulary.
+    Args:
+        tokenizer: The Hugging Face tokenizer.
+    Returns:
+        str: A short hex digest of the tokenizer class and of its full state (or vocabulary).
+    """
+    if getattr(tokenizer, "is_fast", False):
+        state = tokenizer.backend_tokenizer.to_str()
+    else:
+        state = repr(sorted(tokenizer.get_vocab().items()))
+    return hashlib.sha1(f"{type(tokenizer).__name__}\0{state}".encode("utf-8")).hexdigest()[:16]
+
+class TokenizedCodeDataset(Dataset):
+    """
+    TokenizedCodeDataset is the token level counterpart of CodeDataset. Every file is tokenized once, and
+    its ids are cached on disk (as .npy files keyed by tokenizer and content hash) so that later runs skip
+    the tokenization entirely. Prefix, middle and suffix are cut on token boundaries, with their lengths
+    measured in tokens, and every item carries the ready-made FIM `input_ids`, so the generation does not
+    tokenize the prompts again and the prompt lengths are known in advance.
+    A character may be split across several tokens (e.g. non-ASCII characters with byte-level tokenizers):
+    span boundaries falling inside such a character are moved back to the previous token boundary that
+    decodes cleanly, so the decoded segments never contain U+FFFD replacement characters, and spans whose
+    lengths then fall outside the min and max lengths are dropped.
+    Items are dicts with the keys:
+        prefix, middle, suffix (str): The decoded segments, as in the tuples of CodeDataset.
+        prefix_ids, middle_ids, suffix_ids (list[int]): The token ids of the segments.
+        input_ids (list[int]): The FIM prompt, [bos] <fim_begin> prefix <fim_hole> suffix <fim_end>.
+    """
+
+    def __init__(self, file_contents: list[str], tokenizer, num_samples: int = 50,
+                 min_lengths: tuple = (20, 5, 20), max_lengths: tuple = (100, 20, 100),
+                 cache_dir: str = "./token_cache", add_bos: bool = True):
+        """
+        Args:
+            file_contents (list[str]): A list of strings, where each string is the content of a code file.
+            tokenizer: The tokenizer of the model the samples are generated with.
+            num_samples (int): The number of code completion examples to generate.
+            min_lengths (tuple): A tuple (x, y, z) with the min prefix, middle and suffix lengths, in tokens.
+            max_lengths (tuple): A tuple (x, y, z) with the max prefix, middle and suffix lengths, in tokens.
+            cache_dir (str): The directory where the token ids of the files are cached, or None to disable the cache.
+            add_bos (bool): Whether the prompts start with the beginning of sequence token, as the
+                tokenizer does for the prompts of FIMGenerator.
+        Raises:
+            ValueError: If the tokenizer has no FIM tokens.
+        """
+        self.tokenizer = tokenizer
+        self.min_lengths, self.max_lengths = min_lengths, max_lengths
+        self.cache_dir = None if cache_dir is None else os.path.join(cache_dir, tokenizer_key(tokenizer))
+        self.cache_hits, self.cache_misses = 0, 0
+
+        fim_ids = tokenizer.convert_tokens_to_ids([FIM_BEGIN, FIM_HOLE, FIM_END])
+        # Unknown tokens are mapped to the unknown token id, or to None without one
+        if any(fim_id is None or fim_id == tokenizer.unk_token_id for fim_id in fim_ids):
+            raise ValueError(f"The tokenizer has no FIM tokens ({FIM_BEGIN}, {FIM_HOLE}, {FIM_END})")
+        self.fim_begin_id, self.fim_hole_id, self.fim_end_id = fim_ids
+        self.bos_ids = [tokenizer.bos_token_id] if add_bos and tokenizer.bos_token_id is not None else []
+        self._token_texts = {}
+
+        with stage("tokenize", items=len(file_contents)) as event:
+            self.files = [self._tokenize(content) for content in file_contents]
+            event["cache_hits"], event["tokens"] = self.cache_hits, sum(len(ids) for ids in self.files)
+        self.examples = []
+        with stage("sample", files=len(file_contents)) as event:
+            self._generate_examples(num_samples)
+            event["items"] = len(self.examples)
+
+    def _tokenize(self, content: str) -> np.ndarray:
+        """
+        Returns the token ids of a file, from the cache if present.
+        Args:
+            content (str): The content of the file.
+        Returns:
+            np.ndarray: The token ids, without special tokens.
+        """
+        path = None
+        if self.cache_dir is not None:
+            digest = hashlib.sha1(content.encode("utf-8")).hexdigest()
+            path = os.path.join(self.cache_dir, digest[:2], digest + ".npy")
+            if os.path.exists(path):
+                self.cache_hits += 1
+                return np.load(path)
+
+        self.cache_misses += 1
+        ids = np.array(self.tokenizer(content, add_special_tokens=False)["input_ids"], dtype=np.int32)
+        if path is not None:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # Writing to a temporary file first never leaves a truncated array in the cache
+            with open(path + ".tmp", "wb") as f:
+                np.save(f, ids)
+            os.replace(path + ".tmp", path)
+        return ids
+
+    def _generate_examples(self, num_samples: int):
+        """
+        Draws the spans of the examples, on token boundaries, the same way CodeDataset does on characters.
+        Args:
+            num_samples (int): The number of samples to generate.
+        Returns:
+            None: The spans, as (file_index, cursor, prefix_length, middle_length, suffix_length) tuples,
+                  are stored in the `self.examples` attribute.
+        """
+        for file_index, ids in enumerate(self.files):
+            # Ensure the file is long enough to generate examples with min lengths
+            if len(ids) < sum(self.min_lengths):
+                continue
+
+            for _ in range(num_samples):
+                span = sample_span(len(ids), self.min_lengths, self.max_lengths)
+                if span is not None:
+                    span = self._snap_span(ids, *span)
+                if span is not None:
+                    self.examples.append((file_index, *span))
+
+        # Restrict the dataset to num_samples by randomly selecting if necessary
+        if len(self.examples) > num_samples:
+            self.examples = random.sample(self.examples, num_samples)
+
+    def _token_text(self, token_id: int) -> str:
+        """
+        Decodes a single token, with a cache since the same tokens come back at many boundaries.
+        Args:
+            token_id (int): The token id.
+        Returns:
+            str: The text of the token, with U+FFFD for the bytes of characters it only holds part of.
+        """
+        if token_id not in self._token_texts:
+            self._token_texts[token_id] = self.tokenizer.decode([token_id])
+        return self._token_texts[token_id]
+
+    def _is_clean_boundary(self, ids: np.ndarray, position: int) -> bool:
+        """
+        Checks whether cutting the ids before a position keeps every character whole.
+        Args:
+            ids (np.ndarray): The token ids of the file.
+            position (int): The position of the cut.
+        Returns:
+            bool: False if the tokens on both sides of the cut hold parts of the same character.
+        """
+        if position <= 0 or position >= len(ids):
+            return True
+        return not (self._token_text(int(ids[position - 1])).endswith("\ufffd")
+                    or self._token_text(int(ids[position])).startswith("\ufffd"))
+
+    def _snap_span(self, ids: np.ndarray, cursor_position: int, prefix_length: int, middle_length: int,
+                   suffix_length: int):
+        """
+        Moves the boundaries of a span back to the closest positions that do not split a character.
+        Args:
+            ids (np.ndarray): The token ids of the file.
+            cursor_position (int): The start of the middle.
+            prefix_length (int): The length of the prefix.
+            middle_length (int): The length of the middle.
+            suffix_length (int): The length of the suffix.
+        Returns:
+            tuple: The snapped (cursor_position, prefix_length, middle_length, suffix_length), or None if
+                   a length is no longer between the min and max lengths.
+        """
+        start = cursor_position - prefix_length
+        boundaries = [start, cursor_position, cursor_position + middle_length, cursor_position + middle_length + suffix_length]
+        for i, position in enumerate(boundaries):
+            lower = 0 if i == 0 else boundaries[i - 1]
+            while position > lower and not self._is_clean_boundary(ids, position):
+                position -= 1
+            boundaries[i] = position
+
+        lengths = [end - begin for begin, end in zip(boundaries, boundaries[1:])]
+        if any(not low <= length <= high for length, low, high in zip(lengths, self.min_lengths, self.max_lengths)):
+            return None
+        return boundaries[1], *lengths
+
+    def __len__(self) -> int:
+        """
+        Returns the total number of examples in the dataset.
+        Returns:
+            int: The number of examples in the dataset.
+        """
+        return len(self.examples)
+
+    def __getitem__(self, idx) -> dict:
+        """
+        Retrieves the example at the specified index.
+        Args:
+            idx (int): The index of the example to retrieve.
+        Returns:
+            dict: The segments of the example, their token ids and the FIM prompt ids.
+        """
+        file_index, cursor_position, prefix_length, middle_length, suffix_length = self.examples[idx]
+        ids = self.files[file_index]
+        prefix_ids = ids[cursor_position - prefix_length:cursor_position].tolist()
+        middle_ids = ids[cursor_position:cursor_position + middle_length].tolist()
+        suffix_ids = ids[cursor_position + middle_length:cursor_position + middle_length + suffix_length].tolist()
+
+        return {
+            "prefix": self.tokenizer.decode(prefix_ids),
+            "middle": self.tokenizer.decode(middle_ids),
+            "suffix": self.tokenizer.decode(suffix_ids),
+            "prefix_ids": prefix_ids,
+            "middle_ids": middle_ids,
+            "suffix_ids": suffix_ids,
+            "input_ids": self.bos_ids + [self.fim_begin_id] + prefix_ids + [self.fim_hole_id] + suffix_ids + [self.fim_end_id],
+        }
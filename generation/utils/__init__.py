@@ -1,4 +1,16 @@
 from .RepoExtractor import RepoExtractor
 from .CodeDataset import CodeDataset
+from .StreamingCodeDataset import StreamingCodeDataset
+from .TokenizedCodeDataset import TokenizedCodeDataset
+from .MappedCorpus import MappedCorpus, MappedCodeDataset
+from .SuffixStopping import SuffixStoppingCriteria
+from .FIMGenerator import FIMGenerator
+from .GenerationRun import GenerationRun
+from .DatasetPipeline import DatasetPipeline
+from .PromptLookupDecoder import PromptLookupDecoder
+from .PrefixCache import PrefixCache
+from .CompletionServer import CompletionServer
+from .CPUInference import CPUInference
+from . import profiling
 
-__all__ = ["RepoExtractor", "CodeDataset"]
\ No newline at end of file
+__all__ = ["RepoExtractor", "CodeDataset", "StreamingCodeDataset", "TokenizedCodeDataset", "MappedCorpus", "MappedCodeDataset", "SuffixStoppingCriteria", "FIMGenerator", "GenerationRun", "DatasetPipeline", "PromptLookupDecoder", "PrefixCache", "CompletionServer", "CPUInference", "profiling"]
\ No newline at end of file
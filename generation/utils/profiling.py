@@ -0,0 +1,92 @@
+"""
+Description: This module contains the stage-level instrumentation of the pipeline. The extraction, sampling,
+    generation and scoring code paths wrap their work in `stage(...)`, and every registered hook receives a
+    timing event when a stage ends. Without hooks a stage costs a single check, so the instrumentation stays
+    in place during real runs.
+
+Usage:
+    from generation.utils import profiling
+    events = []
+    profiling.add_hook(events.append)
+    ...  # run the pipeline, events are dicts like {"stage": "generate", "seconds": 0.42, "items": 8}
+    profiling.remove_hook(events.append)
+
+This is the only implementation: `evaluation/utils/profiling.py` re-exports it, so a hook registered through
+either module receives the events of the whole pipeline.
+"""
+from contextlib import contextmanager
+from typing import Callable
+import time
+
+_hooks = []
+
+def add_hook(hook: Callable[[dict], None]) -> None:
+    """
+    Registers a hook, called with the event of every stage that ends from now on.
+
+    Args:
+        hook (Callable[[dict], None]): A function taking the event, a dict with the "stage" name, its "start"
+            time (time.perf_counter), its duration in "seconds" and the details given by the instrumented code
+            (e.g. "items", the number of files, samples or pairs it processed).
+    """
+    if hook not in _hooks:
+        _hooks.append(hook)
+
+def remove_hook(hook: Callable[[dict], None]) -> None:
+    """
+    Unregisters a hook, if registered.
+
+    Args:
+        hook (Callable[[dict], None]): The hook given to `add_hook`.
+    """
+    if hook in _hooks:
+        _hooks.remove(hook)
+
+def enabled() -> bool:
+    """
+    Returns:
+        bool: Whether any hook is registered, i.e. whether stages are timed at all.
+    """
+    return bool(_hooks)
+
+def emit(name: str, seconds: float, **details) -> None:
+    """
+    Sends the event of a stage timed elsewhere (e.g. summed over worker processes) to the hooks.
+
+    Args:
+        name (str): The name of the stage.
+        seconds (float): The duration of the stage.
+        **details: Details added to the event.
+    """
+    if not _hooks:
+        return
+    event = {"stage": name, "start": time.perf_counter() - seconds, "seconds": seconds, **details}
+    for hook in list(_hooks):
+        hook(event)
+
+@contextmanager
+def stage(name: str, **details):
+    """
+    Times the block it wraps and sends the event to the hooks when it ends, even on errors.
+    The yielded dict is the event itself, so the block can add details only known at its end
+    (e.g. `event["items"] = len(files)`).
+
+    Args:
+        name (str): The name of the stage, e.g. "extract", "sample", "generate" or "score".
+        **details: Details added to the event.
+
+    Yields:
+        dict: The event of the stage.
+    """
+    event = {"stage": name, **details}
+    if not _hooks:
+        yield event
+        return
+
+    event["start"] = time.perf_counter()
+    try:
+        yield event
+    finally:
+        event["seconds"] = time.perf_counter() - event["start"]
+        for hook in list(_hooks):
+            hook(event)